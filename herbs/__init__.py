@@ -24,5 +24,15 @@ For Others
 
 """
 
-from .run_herbs import run_herbs
-from .czi_reader import CZIReader
\ No newline at end of file
+# the GUI and the CZI reader are imported on first use, so headless tools like herbs.atlas_cli do not load them.
+# The names are re-bound after the import, otherwise they would point to the sub-modules of the same name.
+def __getattr__(name):
+    if name == 'run_herbs':
+        from .run_herbs import run_herbs
+        globals()['run_herbs'] = run_herbs
+        return run_herbs
+    if name == 'CZIReader':
+        from .czi_reader import CZIReader
+        globals()['CZIReader'] = CZIReader
+        return CZIReader
+    raise AttributeError("module 'herbs' has no attribute '{}'".format(name))
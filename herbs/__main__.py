@@ -0,0 +1,9 @@
+import multiprocessing
+
+from herbs.run_herbs import run_herbs
+
+
+# python -m herbs
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    run_herbs()
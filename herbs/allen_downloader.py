@@ -15,9 +15,11 @@ import numpy as np
 import pandas as pd
 
 from .atlas_loader import process_atlas_raw_data
-from .uuuuuu import hex2rgb, obj_data_to_mesh3d, make_contour_img
-from .obj_items import render_volume, render_small_volume
+from .uuuuuu import hex2rgb, obj_data_to_mesh3d
+from .obj_items import render_volume
 from .atlas_downloader import DownloadThread
+from .atlas_store import get_label_dtype, load_atlas_store, save_store_array, save_store_info
+from .atlas_pipeline import process_atlas_stages
 
 
 class WorkerProcessAllen(QObject):
@@ -181,35 +183,31 @@ class WorkerProcessAllen(QObject):
         ]
         self.progress.emit(49)
 
-        atlas = {'data': self.atlas_data, 'info': self.atlas_info}
-
-        outfile = open(os.path.join(self.saving_folder, 'atlas_pre_made.pkl'), 'wb')
-        pickle.dump(atlas, outfile)
-        outfile.close()
+        save_store_array(self.saving_folder, 'atlas', self.atlas_data)
+        save_store_info(self.saving_folder, atlas_info=self.atlas_info)
         self.progress.emit(53)
 
         self.segmentation_data = np.transpose(label_data[::-1, ::-1, :], (2, 0, 1))
-        self.segmentation_data = self.segmentation_data.astype(int)
+        self.segmentation_data = self.segmentation_data.astype(get_label_dtype(self.segmentation_data))
         print(self.segmentation_data.shape)
 
         self.progress.emit(54)
 
-        segment = {'data': self.segmentation_data, 'unique_label': self.unique_label}
-
-        outfile = open(os.path.join(self.saving_folder, 'segment_pre_made.pkl'), 'wb')
-        pickle.dump(segment, outfile)
-        outfile.close()
+        save_store_array(self.saving_folder, 'segment', self.segmentation_data)
+        save_store_info(self.saving_folder, unique_label=self.unique_label)
+        self.atlas_data = None
+        self.segmentation_data = None
 
         self.progress.emit(58)
 
-        if missing_mesh_index:
-            for da_ind in missing_mesh_index:
-                render_small_volume(da_ind, mesh_path, self.atlas_data, self.segmentation_data, factor=2, level=0.1)
+        # missing region meshes and the contour volumes only read the store volumes, run them as parallel stages
+        process_atlas_stages(self.saving_folder, label_ids=missing_mesh_index, brain_mesh=False, factor=2, level=0.1,
+                             progress=lambda frac: self.progress.emit(58 + 30 * frac))
 
-        self.progress.emit(60)
+        self.progress.emit(88)
 
         file_list = os.listdir(mesh_path)
-        progress_step = np.linspace(60, 68, len(file_list))
+        progress_step = np.linspace(88, 98, len(file_list))
         for i in range(len(file_list)):
             self.progress.emit(progress_step[i])
             da_file = file_list[i]
@@ -225,49 +223,10 @@ class WorkerProcessAllen(QObject):
         outfile = open(os.path.join(self.saving_folder, 'atlas_small_meshdata.pkl'), 'wb')
         pickle.dump(self.small_mesh_list, outfile)
         outfile.close()
-        self.progress.emit(70)
-
-        segment_data_shape = self.segmentation_data.shape
-
-        sagital_contour_img = np.zeros(segment_data_shape, 'i')
-        coronal_contour_img = np.zeros(segment_data_shape, 'i')
-        horizontal_contour_img = np.zeros(segment_data_shape, 'i')
-
-        # pre-process boundary ----- todo: change this part as optional
-        process_index = np.linspace(70, 78, segment_data_shape[0])
-        for i in range(segment_data_shape[0]):
-            self.progress.emit(process_index[i])
-            da_slice = self.segmentation_data[i, :, :].copy()
-            contour_img = make_contour_img(da_slice)
-            sagital_contour_img[i, :, :] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'sagital_contour_pre_made.pkl'), 'wb')
-        pickle.dump(sagital_contour_img, outfile_ct)
-        outfile_ct.close()
-        self.progress.emit(80)
-
-        process_index = np.linspace(80, 88, segment_data_shape[1])
-        for i in range(segment_data_shape[1]):
-            self.progress.emit(process_index[i])
-            da_slice = self.segmentation_data[:, i, :].copy()
-            contour_img = make_contour_img(da_slice)
-            coronal_contour_img[:, i, :] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'coronal_contour_pre_made.pkl'), 'wb')
-        pickle.dump(coronal_contour_img, outfile_ct)
-        outfile_ct.close()
-        self.progress.emit(90)
-
-        process_index = np.linspace(90, 98, segment_data_shape[2])
-        for i in range(segment_data_shape[2]):
-            self.progress.emit(process_index[i])
-            da_slice = self.segmentation_data[:, :, i].copy()
-            contour_img = make_contour_img(da_slice)
-            horizontal_contour_img[:, :, i] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'horizontal_contour_pre_made.pkl'), 'wb')
-        pickle.dump(horizontal_contour_img, outfile_ct)
-        outfile_ct.close()
+
+        # hand the compact store volumes (region indices instead of structure ids) to the viewer
+        self.atlas_data, self.atlas_info, self.segmentation_data, self.unique_label, self.boundary = \
+            load_atlas_store(self.saving_folder)
         self.progress.emit(100)
 
         # boundary = {'s_contour': sagital_contour_img,
@@ -0,0 +1,93 @@
+import os
+import sys
+import argparse
+
+# no window is ever opened, Qt is only loaded as a library
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from .atlas_pipeline import process_custom_atlas
+
+
+# same choices as the CSys Selector of the Atlas Processor window
+axis_direction_vals = {'LR': 'L.H. --> R.H.', 'RL': 'R.H. --> L.H.',
+                       'PA': 'Post. --> Ant.', 'AP': 'Ant. --> Post.',
+                       'SI': 'Sup. --> Inf.', 'IS': 'Inf. --> Sup.'}
+axis_direction_groups = {'LR': 0, 'RL': 0, 'PA': 1, 'AP': 1, 'SI': 2, 'IS': 2}
+
+
+def get_axis_transform(directions):
+    """
+    Axis flips and transpose order of a volume, the same as the Atlas Processor window makes from its selectors.
+
+    :param directions: direction code of each volume axis, e.g. ['PA', 'SI', 'LR']
+    :return: direction_change, transpose_order
+    """
+    dir_goal = ['PA', 'IS', 'LR']
+    transpose_order = [axis_direction_groups[val] for val in directions]
+    if len(set(transpose_order)) != 3:
+        raise ValueError('Axis directions cannot be duplicated.')
+    direction_change = [val not in dir_goal for val in directions]
+    return direction_change, transpose_order
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m herbs.atlas_cli',
+        description='Pre-process a volume atlas for HERBS without the graphical interface. Input files are looked up '
+                    'in the atlas folder, the processed atlas is written into it.')
+    parser.add_argument('folder', help='atlas folder')
+    parser.add_argument('--atlas', required=True, help='atlas volume file name (.nii, .nrrd or .pkl)')
+    parser.add_argument('--segmentation', required=True, help='segmentation volume file name')
+    parser.add_argument('--labels', required=True, help='label table file name (.csv or .xlsx)')
+    parser.add_argument('--mask', default=None, help='brain mask file name')
+    parser.add_argument('--axes', nargs=3, required=True, choices=list(axis_direction_vals.keys()),
+                        metavar='DIR', help='direction of the x, y and z axis of the volume, one of '
+                                            '{}'.format(', '.join(['{} ({})'.format(key, val) for key, val in
+                                                                    axis_direction_vals.items()])))
+    parser.add_argument('--voxel-size', type=float, required=True, help='voxel size in um')
+    parser.add_argument('--bregma', type=int, nargs=3, default=[0, 0, 0], metavar='VOXEL',
+                        help='Bregma voxel coordinates, 0 means center')
+    parser.add_argument('--lambda', dest='lambda_coord', type=int, nargs=3, default=[0, 0, 0], metavar='VOXEL',
+                        help='Lambda voxel coordinates')
+    parser.add_argument('--factor', type=int, default=2, help='down-sampling factor of the meshes, at least 2')
+    parser.add_argument('--no-boundary', dest='boundary', action='store_false',
+                        help='do not store the contour volumes, HERBS then draws the contours of every slice on '
+                             'the fly')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes for meshes and contours, default is the number of cores')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if not os.path.isdir(args.folder):
+        print('Atlas folder {} does not exist.'.format(args.folder), file=sys.stderr)
+        return 1
+    if args.voxel_size <= 0:
+        print('Voxel size has to be positive.', file=sys.stderr)
+        return 1
+    if args.factor < 2:
+        print('Factor has to be at least 2.', file=sys.stderr)
+        return 1
+    try:
+        direction_change, transpose_order = get_axis_transform(args.axes)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    def report_progress(val):
+        print('Processing atlas... {:.0f}%'.format(val), flush=True)
+
+    msg = process_custom_atlas(args.folder, args.atlas, args.segmentation, args.labels, direction_change,
+                               transpose_order, args.bregma, args.voxel_size, mask_local=args.mask, factor=args.factor,
+                               l_val=args.lambda_coord, n_workers=args.workers, progress=report_progress,
+                               boundary=args.boundary)
+    if msg is not None:
+        print(msg, file=sys.stderr)
+        return 1
+    print('Atlas saved in {}.'.format(args.folder))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,7 +13,8 @@ import shutil
 import requests
 
 from .atlas_loader import process_atlas_raw_data
-from .obj_items import render_volume, render_small_volume
+from .atlas_store import load_atlas_store
+from .atlas_pipeline import process_atlas_stages
 
 
 class DownloadThread(QThread):
@@ -94,44 +95,25 @@ class WorkerProcessData(QObject):
             process_atlas_raw_data(self.saving_folder, data_file=self.data_local,
                                    segmentation_file=self.segmentation_local, mask_file=self.mask_local,
                                    bregma_coordinates=self.b_val, lambda_coordinates=self.l_val,
-                                   voxel_size=self.vox_size)
+                                   voxel_size=self.vox_size, with_boundary=False)
 
         if msg == 'Atlas loaded successfully.':
             self.progress.emit(40)
-            self.mesh_data = render_volume(self.atlas_data, self.saving_folder, factor=2, level=0.1)
-            self.progress.emit(50)
-            save_path = os.path.join(self.saving_folder, 'meshes')
-            if not os.path.exists(save_path):
-                os.mkdir(save_path)
-
-            n_label = len(self.unique_label)
-            progress_step = np.linspace(50, 95, n_label)
-
-            for i in range(n_label):
-                self.progress.emit(progress_step[i])
-                label_id = int(self.unique_label[i])
-
-                if label_id == 0:
-                    continue
-                render_small_volume(label_id, save_path, self.atlas_data, self.segmentation_data, factor=2, level=0.1)
-
-            self.small_mesh_list = {}
-            file_list = os.listdir(save_path)
-            for da_file in file_list:
-                file_name = os.path.basename(da_file)
-                da_name, file_extension = os.path.splitext(file_name)
-                if file_extension == '.pkl':
-                    infile = open(os.path.join(save_path, da_file), 'rb')
-                    md = pickle.load(infile)
-                    infile.close()
-
-                    self.small_mesh_list[str(da_name)] = md
+            # meshes and contours only read the store volumes, run them as parallel stages
+            self.atlas_data = None
+            self.segmentation_data = None
+            self.mesh_data, self.small_mesh_list = process_atlas_stages(
+                self.saving_folder, label_ids=self.unique_label, factor=2, level=0.1,
+                progress=lambda frac: self.progress.emit(int(40 + 55 * frac)))
 
             self.progress.emit(97)
             outfile = open(os.path.join(self.saving_folder, 'atlas_small_meshdata.pkl'), 'wb')
             pickle.dump(self.small_mesh_list, outfile)
             outfile.close()
 
+            # hand the compact store volumes (region indices instead of structure ids) to the viewer
+            self.atlas_data, self.atlas_info, self.segmentation_data, self.unique_label, self.boundary = \
+                load_atlas_store(self.saving_folder)
             self.progress.emit(100)
 
         self.finished.emit()
@@ -14,8 +14,10 @@ from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 
-from .uuuuuu import make_contour_img, make_atlas_label_contour
+from .uuuuuu import make_contour_img, make_label_boundary, make_atlas_label_contour
 from .obj_items import render_volume, render_small_volume
+from .atlas_store import check_atlas_store, index_label_volume, load_atlas_store, \
+    save_atlas_store, save_store_array, save_store_info
 
 
 def _make_label_info_data_waxholm_rat(label_file_path, excel_file_path):
@@ -195,11 +197,8 @@ def process_segmentation_data(atlas_folder, segmentation_path, mask_data):
 
         unique_label = np.unique(segmentation_data)
 
-        segment = {'data': segmentation_data, 'unique_label': unique_label}
-
-        outfile = open(os.path.join(atlas_folder, 'segment_pre_made.pkl'), 'wb')
-        pickle.dump(segment, outfile)
-        outfile.close()
+        save_store_array(atlas_folder, 'segment', segmentation_data)
+        save_store_info(atlas_folder, unique_label=unique_label)
 
         msg = 'Segmentation data processed successfully.'
         msg_flag = 1
@@ -240,9 +239,8 @@ def process_atlas_data(atlas_folder, atlas_path, mask_data,
         atlas_data = atlas['data']
         atlas_info = atlas['info']
 
-        outfile = open(os.path.join(atlas_folder, 'atlas_pre_made.pkl'), 'wb')
-        pickle.dump(atlas, outfile)
-        outfile.close()
+        save_store_array(atlas_folder, 'atlas', new_atlas_data)
+        save_store_info(atlas_folder, atlas_info=atlas_info)
 
         msg = 'Volume Atlas data processed successfully.'
         msg_flag = 1
@@ -251,24 +249,7 @@ def process_atlas_data(atlas_folder, atlas_path, mask_data,
 
 
 def process_contour_data(segmentation_data, dim_index=0):
-    contour_img = np.zeros(segmentation_data.shape, 'i')
-
-    # pre-process boundary
-    if dim_index == 0:
-        for i in range(segmentation_data.shape[dim_index]):
-            da_slice = segmentation_data[i, :, :].copy()
-            da_contour = make_contour_img(da_slice)
-            contour_img[i, :, :] = da_contour
-    elif dim_index == 1:
-        for i in range(segmentation_data.shape[dim_index]):
-            da_slice = segmentation_data[:, i, :].copy()
-            da_contour = make_contour_img(da_slice)
-            contour_img[:, i, :] = da_contour
-    else:
-        for i in range(segmentation_data.shape[dim_index]):
-            da_slice = segmentation_data[:, :, i].copy()
-            da_contour = make_contour_img(da_slice)
-            contour_img[:, :, i] = da_contour
+    contour_img = make_label_boundary(segmentation_data, dim_index)
     return contour_img
 
 
@@ -284,7 +265,7 @@ def process_contour_data(segmentation_data, dim_index=0):
 #     outfile_ct.close()
 
 def process_atlas_raw_data(atlas_folder, data_file=None, segmentation_file=None, mask_file=None,
-                           bregma_coordinates=None, lambda_coordinates=None, voxel_size=None):
+                           bregma_coordinates=None, lambda_coordinates=None, voxel_size=None, with_boundary=True):
     atlas_data, atlas_info, segmentation_data, boundary = None, None, None, None
 
     atlas_path = os.path.join(atlas_folder, data_file)
@@ -321,11 +302,8 @@ def process_atlas_raw_data(atlas_folder, data_file=None, segmentation_file=None,
 
     unique_label = np.unique(segmentation_data)
 
-    segment = {'data': segmentation_data, 'unique_label': unique_label}
-
-    outfile = open(os.path.join(atlas_folder, 'segment_pre_made.pkl'), 'wb')
-    pickle.dump(segment, outfile)
-    outfile.close()
+    save_store_array(atlas_folder, 'segment', segmentation_data)
+    save_store_info(atlas_folder, unique_label=unique_label)
 
     # pre-process atlas
     atlas_data, atlas_success = check_data_path_and_load(atlas_path)
@@ -358,11 +336,11 @@ def process_atlas_raw_data(atlas_folder, data_file=None, segmentation_file=None,
     atlas_data = atlas['data']
     atlas_info = atlas['info']
 
-    outfile = open(os.path.join(atlas_folder, 'atlas_pre_made.pkl'), 'wb')
-    pickle.dump(atlas, outfile)
-    outfile.close()
+    save_store_array(atlas_folder, 'atlas', new_atlas_data)
+    save_store_info(atlas_folder, atlas_info=atlas_info)
 
-    boundary = make_atlas_label_contour(atlas_folder, segmentation_data)
+    if with_boundary:
+        boundary = make_atlas_label_contour(atlas_folder, segmentation_data)
 
     msg = 'Atlas loaded successfully.'
 
@@ -382,7 +360,58 @@ class AtlasMeshProcessor(object):
 
 
 class AtlasLoader(object):
-    def __init__(self, atlas_folder):
+    def __init__(self, atlas_folder, use_store=True):
+        self.msg = None
+        self.success = False
+        # stores made before the surface arrays existed, the GUI adds them in the background (SurfaceStoreWorker)
+        self.surface_missing = False
+        if use_store and check_atlas_store(atlas_folder, with_boundary=False):
+            self.load_atlas_store(atlas_folder)
+            return
+
+        self.load_atlas_pkl(atlas_folder)
+
+        if use_store and self.success:
+            # one-time conversion, next time the atlas is opened through memory maps
+            try:
+                save_atlas_store(atlas_folder, self.atlas_data, self.atlas_info, self.segmentation_data,
+                                 self.unique_label, self.boundary)
+            except (OSError, KeyError):
+                # the atlas still opens from the pickles, the message tells why it is slow and memory hungry
+                self.msg = 'Failed to convert atlas to memory-mapped store, the atlas is loaded into memory.'
+                self.segmentation_data, self.atlas_info[3]['region_ids'] = \
+                    index_label_volume(self.segmentation_data)
+                return
+            # re-open the compact (uint8 / uint16) volumes instead of keeping the float and int64 ones in memory
+            self.load_atlas_store(atlas_folder)
+
+    def load_atlas_store(self, atlas_folder):
+        pre_made_label_info_path = os.path.join(atlas_folder, 'atlas_labels.pkl')
+        if not os.path.exists(pre_made_label_info_path):
+            self.msg = 'Please pre-process the raw data of your desire atlas.'
+            self.success = False
+            return
+        try:
+            infile = open(pre_made_label_info_path, 'rb')
+            self.label_info = pickle.load(infile)
+            infile.close()
+        except ValueError:
+            self.msg = 'Please give the label information file. If you do not have one, ' \
+                       'the maintainers are more than happy to help you to process one.'
+            self.success = False
+            return
+        try:
+            self.atlas_data, self.atlas_info, self.segmentation_data, self.unique_label, self.boundary = \
+                load_atlas_store(atlas_folder)
+            self.success = True
+        except (ValueError, OSError, KeyError):
+            self.msg = 'Please re-process atlas and label segmentation file.'
+            self.success = False
+            return
+        surface = self.atlas_info[3]['surface']
+        self.surface_missing = not all([key in surface for key in [0, 1, 2, 'distance', 'intensity']])
+
+    def load_atlas_pkl(self, atlas_folder):
         pre_made_atlas_path = os.path.join(atlas_folder, 'atlas_pre_made.pkl')
         pre_made_segment_path = os.path.join(atlas_folder, 'segment_pre_made.pkl')
         pre_made_boundary_path = os.path.join(atlas_folder, 'contour_pre_made.pkl')
@@ -441,8 +470,8 @@ class AtlasLoader(object):
 
         if not bnd_chk0:
             if not np.all([bnd_chk1, bnd_chk2, bnd_chk3]):
-                self.msg = 'Please pre-process boundary file.'
-                self.success = False
+                # contour volumes are optional, AtlasView computes the contour of the shown slices
+                self.boundary = {}
             else:
                 # load boundary
                 self.boundary = {}
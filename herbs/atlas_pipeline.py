@@ -0,0 +1,507 @@
+import os
+import pickle
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from concurrent.futures.process import BrokenProcessPool
+
+from .uuuuuu import make_label_boundary, make_surface_map, make_surface_distance, read_excel_file, hex2rgb
+from .obj_items import render_volume, downsample_regions, render_region_meshes
+from .atlas_loader import check_data_path_and_load
+from .atlas_store import create_store_array, get_label_dtype, open_store_array, read_store_header, \
+    save_store_array, save_store_info, surface_map_names, surface_distance_name, surface_intensity_name, \
+    write_store_header
+
+
+# The stages after the atlas and segmentation volumes are written to the atlas store (whole brain mesh, region
+# meshes, contour volumes) only read those volumes. Each stage runs in a pool process which opens the store with
+# read-only memory maps, so the volumes are shared through the OS page cache instead of being copied to every
+# process. Contour chunks write their slices straight into store volumes allocated up front.
+
+small_atlas_name = 'atlas_store_small_atlas.npy'
+small_segment_name = 'atlas_store_small_segment.npy'
+small_boxes_name = 'atlas_store_small_boxes.pkl'
+
+contour_axes = {'s_contour': 0, 'c_contour': 1, 'h_contour': 2}
+surface_temp_name = 'atlas_store_surface_temp.raw'
+surface_distance_scale = 0.125
+
+
+def get_process_context():
+    """
+    Start method of the stage processes. Spawn on every platform: fork is not safe in a process running Qt threads,
+    and Windows / macOS spawn anyway. Spawned workers import __main__ again, see run_herbs and herbs/__main__.py.
+    """
+    return multiprocessing.get_context('spawn')
+
+
+class PipelineStage(object):
+    def __init__(self, name, func, args=(), deps=(), weight=1.):
+        """
+        :param name: unique name of the stage
+        :param func: module level function, it has to be picklable for the process pool
+        :param args: arguments of func
+        :param deps: names of the stages which have to finish first
+        :param weight: share of the stage in the reported progress
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = tuple(deps)
+        self.weight = weight
+
+
+def run_stage_graph(stages, n_workers=None, progress=None):
+    """
+    Run the stages as a dependency graph, every stage is started as soon as all its dependencies finished.
+
+    :param stages: list of PipelineStage
+    :param n_workers: number of processes, default is the number of cores, 1 runs everything in this process
+    :param progress: optional callable receiving the finished fraction of the total stage weight
+    :return: dict of stage results by stage name
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    stage_names = [stage.name for stage in stages]
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in stage_names:
+                raise ValueError('Stage {} depends on unknown stage {}.'.format(stage.name, dep))
+
+    total_weight = float(sum([stage.weight for stage in stages])) or 1.
+    done_weight = 0
+    results = {}
+    pending = list(stages)
+
+    if n_workers <= 1:
+        while pending:
+            ready = [stage for stage in pending if all([dep in results for dep in stage.deps])]
+            if not ready:
+                raise ValueError('Stage dependencies contain a cycle.')
+            for stage in ready:
+                results[stage.name] = stage.func(*stage.args)
+                pending.remove(stage)
+                done_weight += stage.weight
+                if progress is not None:
+                    progress(done_weight / total_weight)
+        return results
+
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=get_process_context())
+    running = {}
+    try:
+        while pending or running:
+            ready = [stage for stage in pending if all([dep in results for dep in stage.deps])]
+            for stage in ready:
+                running[executor.submit(stage.func, *stage.args)] = stage
+                pending.remove(stage)
+            if not running:
+                raise ValueError('Stage dependencies contain a cycle.')
+            done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                done_weight += stage.weight
+                if progress is not None:
+                    progress(done_weight / total_weight)
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=True)
+    return results
+
+
+def stage_brain_mesh(atlas_folder, factor, level):
+    atlas_data = open_store_array(atlas_folder, 'atlas')
+    return render_volume(atlas_data, atlas_folder, factor=factor, level=level)
+
+
+def stage_downsample_regions(atlas_folder, factor):
+    atlas_data = open_store_array(atlas_folder, 'atlas')
+    segmentation_data = open_store_array(atlas_folder, 'segment')
+    small_atlas, small_label, box_by_id = downsample_regions(atlas_data, segmentation_data, factor)
+    np.save(os.path.join(atlas_folder, small_atlas_name), small_atlas)
+    np.save(os.path.join(atlas_folder, small_segment_name), small_label)
+    outfile = open(os.path.join(atlas_folder, small_boxes_name), 'wb')
+    pickle.dump(box_by_id, outfile)
+    outfile.close()
+
+
+def stage_region_meshes(atlas_folder, mesh_path, label_ids, factor, level):
+    header = read_store_header(atlas_folder)
+    atlas_data = open_store_array(atlas_folder, 'atlas', header)
+    segmentation_data = open_store_array(atlas_folder, 'segment', header)
+    small_atlas = np.load(os.path.join(atlas_folder, small_atlas_name), mmap_mode='r')
+    small_label = np.load(os.path.join(atlas_folder, small_segment_name), mmap_mode='r')
+    infile = open(os.path.join(atlas_folder, small_boxes_name), 'rb')
+    box_by_id = pickle.load(infile)
+    infile.close()
+    return render_region_meshes(mesh_path, atlas_data, segmentation_data, small_atlas, small_label, box_by_id,
+                                label_ids, region_ids=header['region_ids'], factor=factor, level=level)
+
+
+def stage_label_boundary(atlas_folder, contour_name, start, stop):
+    segmentation_data = open_store_array(atlas_folder, 'segment')
+    contour_data = open_store_array(atlas_folder, contour_name, mode='r+')
+    make_label_boundary(segmentation_data, contour_axes[contour_name], out=contour_data, start=start, stop=stop)
+    contour_data.flush()
+
+
+def stage_surface_map(atlas_folder, axis):
+    segmentation_data = open_store_array(atlas_folder, 'segment')
+    surface_map = open_store_array(atlas_folder, surface_map_names[axis], mode='r+')
+    surface_map[:] = make_surface_map(segmentation_data, axis)
+    surface_map.flush()
+
+
+def stage_surface_intensity(atlas_folder):
+    atlas_data = open_store_array(atlas_folder, 'atlas')
+    surface_map = open_store_array(atlas_folder, surface_intensity_name, mode='r+')
+    surface_map[:] = make_surface_map(atlas_data, 2)
+    surface_map.flush()
+
+
+def stage_surface_distance(atlas_folder):
+    segmentation_data = open_store_array(atlas_folder, 'segment')
+    distance_data = open_store_array(atlas_folder, surface_distance_name, mode='r+')
+    temp_path = os.path.join(atlas_folder, surface_temp_name)
+    temp = np.memmap(temp_path, dtype='float32', mode='w+', shape=segmentation_data.shape)
+    try:
+        make_surface_distance(segmentation_data, distance_data, temp, scale=surface_distance_scale)
+        distance_data.flush()
+    finally:
+        del temp
+        os.remove(temp_path)
+
+
+def get_surface_stages(atlas_folder, data_shape, missing_only=False):
+    """
+    Allocate the surface maps, the surface distance volume and the intensity surface map in the atlas store.
+
+    :param atlas_folder: atlas folder
+    :param data_shape: shape of the segmentation volume
+    :param missing_only: only the arrays which are not in the store yet
+    :return: list of PipelineStage filling the arrays
+    """
+    header = read_store_header(atlas_folder)
+    stages = []
+    for axis, name in enumerate(surface_map_names):
+        if missing_only and name in header['arrays']:
+            continue
+        map_shape = (2, ) + tuple(data_shape[ax] for ax in range(3) if ax != axis)
+        create_store_array(atlas_folder, name, map_shape, 'int32')
+        stages.append(PipelineStage(name, stage_surface_map, (atlas_folder, axis), weight=0.5))
+    if not missing_only or surface_intensity_name not in header['arrays']:
+        create_store_array(atlas_folder, surface_intensity_name, (2, ) + tuple(data_shape[:2]), 'int32')
+        stages.append(PipelineStage(surface_intensity_name, stage_surface_intensity, (atlas_folder, ), weight=0.5))
+    if not missing_only or surface_distance_name not in header['arrays']:
+        create_store_array(atlas_folder, surface_distance_name, data_shape, 'int16')
+        header = read_store_header(atlas_folder)
+        header['arrays'][surface_distance_name]['scale'] = surface_distance_scale
+        write_store_header(atlas_folder, header)
+        stages.append(PipelineStage(surface_distance_name, stage_surface_distance, (atlas_folder, ), weight=4))
+    return stages
+
+
+def process_surface_stages(atlas_folder, n_workers=None, progress=None):
+    """
+    Add the surface maps, the surface distance volume and the intensity surface map which are missing from an atlas
+    store, e.g. one made before they were part of the store. Arrays whose stage fails are removed from the store
+    header again.
+
+    :param atlas_folder: atlas folder
+    :param n_workers: number of processes, default is the number of cores
+    :param progress: optional callable receiving the finished fraction
+    :return: names of the added arrays
+    """
+    data_shape = read_store_header(atlas_folder)['arrays']['segment']['shape']
+    stages = get_surface_stages(atlas_folder, data_shape, missing_only=True)
+    if len(stages) == 0:
+        return []
+    try:
+        run_stage_graph(stages, n_workers=n_workers, progress=progress)
+    except Exception:
+        header = read_store_header(atlas_folder)
+        for stage in stages:
+            header['arrays'].pop(stage.name, None)
+        write_store_header(atlas_folder, header)
+        raise
+    return [stage.name for stage in stages]
+
+
+def process_atlas_stages(atlas_folder, label_ids=None, brain_mesh=True, boundary=True, factor=2, level=0.1,
+                         n_workers=None, contour_chunk=64, progress=None, surface=True):
+    """
+    Build meshes and contour volumes of an atlas whose atlas and segmentation volumes are in the atlas store.
+
+    :param atlas_folder: atlas folder
+    :param label_ids: structure ids to mesh into atlas_folder/meshes, None for no region meshes
+    :param brain_mesh: render the whole brain mesh (atlas_meshdata.pkl)
+    :param boundary: make the three contour volumes
+    :param factor: down-sampling factor of the meshes
+    :param level: iso level of the meshes
+    :param n_workers: number of processes, default is the number of cores
+    :param contour_chunk: number of slices in one contour stage
+    :param progress: optional callable receiving the finished fraction
+    :param surface: make the surface maps and the signed distance to the surface volume
+    :return: whole brain MeshData (None if not rendered), dict of region MeshData by str(label_id)
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    header = read_store_header(atlas_folder)
+    data_shape = header['arrays']['segment']['shape']
+
+    stages = []
+    if brain_mesh:
+        stages.append(PipelineStage('brain_mesh', stage_brain_mesh, (atlas_folder, factor, level), weight=4))
+
+    region_stage_names = []
+    if label_ids is not None and len(label_ids) != 0:
+        mesh_path = os.path.join(atlas_folder, 'meshes')
+        if not os.path.exists(mesh_path):
+            os.mkdir(mesh_path)
+        stages.append(PipelineStage('downsample', stage_downsample_regions, (atlas_folder, factor), weight=2))
+        # interleave the ids, big and small regions are spread over the chunks
+        label_ids = np.ravel(label_ids)
+        n_chunks = min(len(label_ids), 4 * n_workers)
+        for i in range(n_chunks):
+            stage_name = 'region_meshes_{}'.format(i)
+            region_stage_names.append(stage_name)
+            stages.append(PipelineStage(stage_name, stage_region_meshes,
+                                        (atlas_folder, mesh_path, label_ids[i::n_chunks], factor, level),
+                                        deps=['downsample']))
+
+    if boundary:
+        for contour_name in ['s_contour', 'c_contour', 'h_contour']:
+            create_store_array(atlas_folder, contour_name, data_shape, 'uint8')
+            n_slices = data_shape[contour_axes[contour_name]]
+            for start in range(0, n_slices, contour_chunk):
+                stop = min(start + contour_chunk, n_slices)
+                stages.append(PipelineStage('{}_{}'.format(contour_name, start), stage_label_boundary,
+                                            (atlas_folder, contour_name, start, stop), weight=0.5))
+
+    if surface:
+        stages += get_surface_stages(atlas_folder, data_shape)
+
+    try:
+        results = run_stage_graph(stages, n_workers=n_workers, progress=progress)
+    finally:
+        for temp_name in [small_atlas_name, small_segment_name, small_boxes_name]:
+            temp_path = os.path.join(atlas_folder, temp_name)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    small_mesh_list = {}
+    for stage_name in region_stage_names:
+        small_mesh_list.update(results[stage_name])
+    return results.get('brain_mesh'), small_mesh_list
+
+
+def process_custom_atlas(saving_folder, data_local, segmentation_local, label_local, direction_change,
+                         transpose_order, b_val, vox_size, mask_local=None, factor=2, l_val=None, n_workers=None,
+                         progress=None, boundary=True):
+    """
+    Pre-process a user atlas into saving_folder, the whole pipeline behind the Atlas Processor, without any window.
+
+    :param saving_folder: folder holding the input files, the processed atlas is written here
+    :param data_local: atlas volume file name (.nii, .nrrd or .pkl)
+    :param segmentation_local: segmentation volume file name
+    :param label_local: label table file name (.csv or .xlsx)
+    :param direction_change: for each axis of the volume, True if it has to be flipped
+    :param transpose_order: axis order passed to np.transpose
+    :param b_val: Bregma voxel coordinates in the input volume, 0 means center
+    :param vox_size: voxel size in um
+    :param mask_local: optional brain mask file name
+    :param factor: down-sampling factor of the meshes
+    :param l_val: optional Lambda voxel coordinates in the input volume
+    :param n_workers: number of processes for the mesh and contour stages, default is the number of cores
+    :param progress: optional callable receiving the progress in percent
+    :param boundary: make the three contour volumes, without them the atlas view computes the contours per slice
+    :return: error message, None if success
+    """
+    if progress is None:
+        progress = lambda val: None
+    progress(1)
+    if vox_size < 1e-4:
+        return 'Please set voxel size.'
+    df, msg = read_excel_file(os.path.join(saving_folder, label_local))
+    if msg is not None:
+        return msg
+
+    reformat_keys = list(df.columns)
+    for i in range(len(reformat_keys)):
+        reformat_keys[i] = reformat_keys[i].lower()
+    df.columns = reformat_keys
+    progress(2)
+    try:
+        da_labels = df['name'].values
+        progress(3)
+
+        da_short_label = df['acronym'].values
+
+    except KeyError:
+        return 'Label file missing columns "name" or "acronym".'
+    progress(4)
+
+    try:
+        levels = []
+        structure_id_path = df['structure_id_path'].values
+        for i in range(len(structure_id_path)):
+            da_path = structure_id_path[i]
+            da_path_split = da_path.split('/')
+            for j in np.arange(len(da_path_split))[::-1]:
+                if da_path_split[j] == '':
+                    da_path_split.pop(j)
+            levels.append(len(da_path_split))
+    except KeyError:
+        return 'Label file missing columns "structure_id_path".'
+    progress(5)
+
+    try:
+        hex_colors = df['color_hex_triplet'].values
+        rgb_colors = []
+        for i in range(len(hex_colors)):
+            r, g, b = hex2rgb(hex_colors[i])
+            rgb_colors.append([r, g, b])
+        rgb_colors = np.asarray(rgb_colors)
+    except KeyError:
+        rgb_colors = []
+        for i in range(len(da_short_label)):
+            r, g, b = np.random.randint(0, 255, 3)
+            rgb_colors.append([r, g, b])
+        rgb_colors = np.asarray(rgb_colors)
+    progress(6)
+
+    try:
+        parent = df['parent_id'].values.astype(int)
+        ids = df['id'].values.astype(int)
+    except KeyError:
+        return 'Label file missing columns "parent_structure_id" or "id".'
+
+    label_info = {'index': ids,
+                  'label': da_labels,
+                  'parent': parent,
+                  'abbrev': da_short_label,
+                  'color': rgb_colors,
+                  'level_indicator': levels}
+
+    with open(os.path.join(saving_folder, 'atlas_labels.pkl'), 'wb') as handle:
+        pickle.dump(label_info, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    progress(9)
+
+    # laod atlas
+    atlas_data, success = check_data_path_and_load(os.path.join(saving_folder, data_local))
+    if not success:
+        return 'Failed to load atlas data file. Currently only support for .nii and .nrrd.'
+    atlas_data = atlas_data - np.min(atlas_data)
+    atlas_size = atlas_data.shape
+    if np.any(np.ravel(atlas_size) < factor):
+        return 'Factor can not be larger than atlas size.'
+    progress(14)
+    # laod segmentation data
+    segmentation_data, success = check_data_path_and_load(os.path.join(saving_folder, segmentation_local))
+    if not success:
+        return 'Failed to load segmentation data file. Currently only support for .nii and .nrrd.'
+    progress(19)
+    if not (segmentation_data.shape == atlas_data.shape):
+        return 'Atlas shape is different than segmentation shape.'
+
+    if mask_local is not None:
+        mask_data, success = check_data_path_and_load(os.path.join(saving_folder, mask_local))
+        if not success:
+            return 'Failed to load mask data file. Currently only support for .nii and .nrrd.'
+        progress(23)
+        if not mask_data.shape == atlas_data.shape:
+            return 'Atlas shape is different than mask shape.'
+
+        # make segmentation with mask
+        progress_step = np.linspace(23, 26, len(mask_data))
+        for i in range(len(mask_data)):
+            progress(progress_step[i])
+            segmentation_data[i][mask_data[i] == 0] = 0
+        segmentation_data = segmentation_data.astype('int')
+
+        progress_step = np.linspace(26, 28, len(mask_data))
+        for i in range(len(mask_data)):
+            progress(progress_step[i])
+            atlas_data[i][mask_data[i] == 0] = 0
+
+    atlas_data = atlas_data / np.max(atlas_data)
+    progress(35)
+
+    if direction_change[0]:
+        segmentation_data = segmentation_data[::-1, :, :]
+        atlas_data = atlas_data[::-1, :, :]
+    progress(36)
+    if direction_change[1]:
+        segmentation_data = segmentation_data[:, ::-1, :]
+        atlas_data = atlas_data[:, ::-1, :]
+    progress(37)
+    if direction_change[2]:
+        segmentation_data = segmentation_data[:, :, ::-1]
+        atlas_data = atlas_data[:, :, ::-1]
+    progress(38)
+
+    segmentation_data = np.transpose(segmentation_data, transpose_order)
+    segmentation_data = segmentation_data.astype(get_label_dtype(segmentation_data))
+    # print(segmentation_data.shape)
+    progress(39)
+
+    save_store_array(saving_folder, 'segment', segmentation_data)
+    # the store keeps the sorted structure ids of the segmentation, no need for another np.unique pass
+    unique_label = read_store_header(saving_folder)['region_ids']
+    save_store_info(saving_folder, unique_label=unique_label)
+    del segmentation_data
+    progress(42)
+
+    new_atlas_shape = atlas_data.shape
+    b_val = np.ravel(b_val)[transpose_order]
+    if b_val[0] == 0:
+        b_val[0] = int(new_atlas_shape[0] / 2)
+    progress(43)
+    if b_val[1] == 0:
+        b_val[1] = int(new_atlas_shape[1] / 2)
+    progress(44)
+
+    for i in range(3):
+        if direction_change[i]:
+            b_val[i] = new_atlas_shape[i] - 1 - b_val[i]
+
+    if b_val[2] == 0:
+        b_val[2] = new_atlas_shape[2] - 1 - b_val[2]
+
+    atlas_info = [
+        {'name': 'anterior', 'values': np.arange(atlas_data.shape[0]) * vox_size, 'units': 'um'},
+        {'name': 'dorsal', 'values': np.arange(atlas_data.shape[1]) * vox_size, 'units': 'um'},
+        {'name': 'right', 'values': np.arange(atlas_data.shape[2]) * vox_size, 'units': 'um'},
+        {'vxsize': vox_size,
+         'Bregma': [b_val[0], b_val[1], b_val[2]]}
+    ]
+    if l_val is not None and np.any(np.ravel(l_val) != 0):
+        l_val = np.ravel(l_val)[transpose_order]
+        for i in range(3):
+            if direction_change[i]:
+                l_val[i] = new_atlas_shape[i] - 1 - l_val[i]
+        atlas_info[3]['Lambda'] = [l_val[0], l_val[1], l_val[2]]
+    progress(45)
+    save_store_array(saving_folder, 'atlas', atlas_data)
+    save_store_info(saving_folder, atlas_info=atlas_info)
+    progress(50)
+
+    del atlas_data
+
+    # meshes and contours only read the store volumes, run them as parallel stages
+    try:
+        mesh_data, small_mesh_list = process_atlas_stages(
+            saving_folder, label_ids=unique_label, boundary=boundary, factor=factor, level=0.1, n_workers=n_workers,
+            progress=lambda frac: progress(50 + 48 * frac))
+    except (OSError, MemoryError, BrokenProcessPool) as e:
+        return 'Failed to build meshes and contours: {}'.format(e)
+
+    outfile = open(os.path.join(saving_folder, 'atlas_small_meshdata.pkl'), 'wb')
+    pickle.dump(small_mesh_list, outfile)
+    outfile.close()
+
+    progress(100)
+
+    return None
@@ -13,9 +13,9 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 import pyqtgraph.opengl as gl
 
-from .uuuuuu import read_qss_file, make_contour_img, read_excel_file, hex2rgb
-from .obj_items import render_volume, render_small_volume
-from .atlas_loader import process_atlas_raw_data, AtlasLoader, check_data_path_and_load
+from .uuuuuu import read_qss_file
+from .atlas_loader import process_atlas_raw_data, AtlasLoader
+from .atlas_pipeline import process_custom_atlas, process_surface_stages
 
 
 class CustomerAtlasWorker(QObject):
@@ -34,285 +34,56 @@ class CustomerAtlasWorker(QObject):
         self.l_val = None
         self.vox_size = None
         self.factor = 2
+        self.boundary = True
 
         self.direction_change = [False, False, False]
         self.transpose_order = [-1, -1, -1]
 
     def set_data(self, saving_folder, data_local, segmentation_local, label_local, direction_change, transpose_order,
-                 b_val, vox_size, mask_local=None, factor=2):
+                 b_val, vox_size, mask_local=None, factor=2, l_val=None, boundary=True):
         self.saving_folder = saving_folder
         self.data_local = data_local
         self.segmentation_local = segmentation_local
         self.label_local = label_local
         self.mask_local = mask_local
         self.b_val = b_val
+        self.l_val = l_val
         self.vox_size = vox_size
         self.direction_change = direction_change
         self.transpose_order = transpose_order
         self.factor = factor
+        self.boundary = boundary
 
     def progress_control(self, total_count):
         self.progress.emit(total_count)
 
     def run(self):
-        self.progress.emit(1)
-        if self.vox_size < 1e-4:
-            self.error_occur.emit('Please set voxel size.')
-            return
-        print(self.saving_folder)
-        print(self.label_local)
-        df, msg = read_excel_file(os.path.join(self.saving_folder, self.label_local))
+        msg = process_custom_atlas(self.saving_folder, self.data_local, self.segmentation_local, self.label_local,
+                                   self.direction_change, self.transpose_order, self.b_val, self.vox_size,
+                                   mask_local=self.mask_local, factor=self.factor, l_val=self.l_val,
+                                   progress=self.progress.emit, boundary=self.boundary)
         if msg is not None:
             self.error_occur.emit(msg)
             return
+        self.finished.emit()
 
-        reformat_keys = list(df.columns)
-        for i in range(len(reformat_keys)):
-            reformat_keys[i] = reformat_keys[i].lower()
-        df.columns = reformat_keys
-        self.progress.emit(2)
-        try:
-            da_labels = df['name'].values
-            self.progress.emit(3)
-
-            da_short_label = df['acronym'].values
 
-        except KeyError:
-            self.error_occur.emit('Label file missing columns "name" or "acronym".')
-            return
-        self.progress.emit(4)
+class SurfaceStoreWorker(QObject):
+    finished = pyqtSignal()
+    progress = pyqtSignal(float)
+    error_occur = pyqtSignal(str)
 
-        try:
-            levels = []
-            structure_id_path = df['structure_id_path'].values
-            for i in range(len(structure_id_path)):
-                da_path = structure_id_path[i]
-                da_path_split = da_path.split('/')
-                for j in np.arange(len(da_path_split))[::-1]:
-                    if da_path_split[j] == '':
-                        da_path_split.pop(j)
-                levels.append(len(da_path_split))
-        except KeyError:
-            self.error_occur.emit('Label file missing columns "structure_id_path".')
-            return
-        self.progress.emit(5)
-
-        try:
-            hex_colors = df['color_hex_triplet'].values
-            rgb_colors = []
-            for i in range(len(hex_colors)):
-                r, g, b = hex2rgb(hex_colors[i])
-                rgb_colors.append([r, g, b])
-            rgb_colors = np.asarray(rgb_colors)
-        except KeyError:
-            rgb_colors = []
-            for i in range(len(da_short_label)):
-                r, g, b = np.random.randint(0, 255, 3)
-                rgb_colors.append([r, g, b])
-            rgb_colors = np.asarray(rgb_colors)
-        self.progress.emit(6)
+    def __init__(self, atlas_folder):
+        super(SurfaceStoreWorker, self).__init__()
+        self.atlas_folder = atlas_folder
 
+    def run(self):
         try:
-            parent = df['parent_id'].values.astype(int)
-            ids = df['id'].values.astype(int)
-        except KeyError:
-            self.error_occur.emit('Label file missing columns "parent_structure_id" or "id".')
-            return
-
-        label_info = {'index': ids,
-                      'label': da_labels,
-                      'parent': parent,
-                      'abbrev': da_short_label,
-                      'color': rgb_colors,
-                      'level_indicator': levels}
-
-        with open(os.path.join(self.saving_folder, 'atlas_labels.pkl'), 'wb') as handle:
-            pickle.dump(label_info, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        self.progress.emit(9)
-
-        # laod atlas
-        atlas_data, success = check_data_path_and_load(os.path.join(self.saving_folder, self.data_local))
-        if not success:
-            self.error_occur.emit('Failed to load atlas data file. Currently only support for .nii and .nrrd.')
-            return
-        atlas_data = atlas_data - np.min(atlas_data)
-        atlas_size = atlas_data.shape
-        if np.any(np.ravel(atlas_size) < self.factor):
-            self.error_occur.emit('Factor can not be larger than atlas size.')
-        self.progress.emit(14)
-        # laod segmentation data
-        segmentation_data, success = check_data_path_and_load(os.path.join(self.saving_folder, self.segmentation_local))
-        if not success:
-            self.error_occur.emit('Failed to load segmentation data file. Currently only support for .nii and .nrrd.')
+            process_surface_stages(self.atlas_folder, progress=self.progress.emit)
+        except (OSError, ValueError, KeyError, RuntimeError):
+            self.error_occur.emit('Failed to add the brain surface maps to the atlas store, '
+                                  'please re-process the atlas.')
             return
-        self.progress.emit(19)
-        if not (segmentation_data.shape == atlas_data.shape):
-            self.error_occur.emit('Atlas shape is different than segmentation shape.')
-            return
-
-        if self.mask_local is not None:
-            mask_data, success = check_data_path_and_load(os.path.join(self.saving_folder, self.mask_local))
-            if not success:
-                self.error_occur.emit('Failed to load mask data file. Currently only support for .nii and .nrrd.')
-                return
-            self.progress.emit(23)
-            if not mask_data.shape == atlas_data.shape:
-                self.error_occur.emit('Atlas shape is different than mask shape.')
-                return
-
-            # make segmentation with mask
-            progress_step = np.linspace(23, 26, len(mask_data))
-            for i in range(len(mask_data)):
-                self.progress.emit(progress_step[i])
-                segmentation_data[i][mask_data[i] == 0] = 0
-            segmentation_data = segmentation_data.astype('int')
-
-            progress_step = np.linspace(26, 28, len(mask_data))
-            for i in range(len(mask_data)):
-                self.progress.emit(progress_step[i])
-                atlas_data[i][mask_data[i] == 0] = 0
-
-        atlas_data = atlas_data / np.max(atlas_data)
-        self.progress.emit(30)
-
-        unique_label = np.unique(segmentation_data)
-        n_unique_labels = len(unique_label)
-        self.progress.emit(35)
-
-        if self.direction_change[0]:
-            segmentation_data = segmentation_data[::-1, :, :]
-            atlas_data = atlas_data[::-1, :, :]
-        self.progress.emit(36)
-        if self.direction_change[1]:
-            segmentation_data = segmentation_data[:, ::-1, :]
-            atlas_data = atlas_data[:, ::-1, :]
-        self.progress.emit(37)
-        if self.direction_change[2]:
-            segmentation_data = segmentation_data[:, :, ::-1]
-            atlas_data = atlas_data[:, :, ::-1]
-        self.progress.emit(38)
-
-        segmentation_data = np.transpose(segmentation_data, self.transpose_order)
-        segmentation_data = segmentation_data.astype(int)
-        # print(segmentation_data.shape)
-        self.progress.emit(39)
-
-        segment = {'data': segmentation_data, 'unique_label': unique_label}
-
-        outfile = open(os.path.join(self.saving_folder, 'segment_pre_made.pkl'), 'wb')
-        pickle.dump(segment, outfile)
-        outfile.close()
-        self.progress.emit(42)
-
-        new_atlas_shape = atlas_data.shape
-        b_val = np.ravel(self.b_val)[self.transpose_order]
-        if b_val[0] == 0:
-            b_val[0] = int(new_atlas_shape[0] / 2)
-        self.progress.emit(43)
-        if b_val[1] == 0:
-            b_val[1] = int(new_atlas_shape[1] / 2)
-        self.progress.emit(44)
-
-        for i in range(3):
-            if self.direction_change[i]:
-                b_val[i] = new_atlas_shape[i] - 1 - b_val[i]
-
-        if b_val[2] == 0:
-            b_val[2] = new_atlas_shape[2] - 1 - b_val[2]
-
-        atlas_info = [
-            {'name': 'anterior', 'values': np.arange(atlas_data.shape[0]) * self.vox_size, 'units': 'um'},
-            {'name': 'dorsal', 'values': np.arange(atlas_data.shape[1]) * self.vox_size, 'units': 'um'},
-            {'name': 'right', 'values': np.arange(atlas_data.shape[2]) * self.vox_size, 'units': 'um'},
-            {'vxsize': self.vox_size,
-             'Bregma': [b_val[0], b_val[1], b_val[2]]}
-        ]
-        self.progress.emit(45)
-        atlas = {'data': atlas_data, 'info': atlas_info}
-
-        outfile = open(os.path.join(self.saving_folder, 'atlas_pre_made.pkl'), 'wb')
-        pickle.dump(atlas, outfile)
-        outfile.close()
-        self.progress.emit(50)
-
-        mesh_data = render_volume(atlas_data, self.saving_folder, factor=self.factor, level=0.1)
-        self.progress.emit(55)
-
-        mesh_path = os.path.join(self.saving_folder, 'meshes')
-        if not os.path.exists(mesh_path):
-            os.mkdir(mesh_path)
-
-        progress_step = np.linspace(55, 68, n_unique_labels)
-        for i in range(n_unique_labels):
-            self.progress.emit(progress_step[i])
-            label_id = int(unique_label[i])
-
-            if label_id == 0:
-                continue
-            render_small_volume(label_id, mesh_path, atlas_data, segmentation_data, factor=self.factor, level=0.1)
-
-        small_mesh_list = {}
-        file_list = os.listdir(mesh_path)
-        for da_file in file_list:
-            file_name = os.path.basename(da_file)
-            da_name, file_extension = os.path.splitext(file_name)
-            if file_extension == '.pkl':
-                infile = open(os.path.join(mesh_path, da_file), 'rb')
-                md = pickle.load(infile)
-                infile.close()
-
-                small_mesh_list[str(da_name)] = md
-
-        self.progress.emit(69)
-        outfile = open(os.path.join(self.saving_folder, 'atlas_small_meshdata.pkl'), 'wb')
-        pickle.dump(small_mesh_list, outfile)
-        outfile.close()
-        self.progress.emit(70)
-
-        segment_data_shape = segmentation_data.shape
-
-        sagital_contour_img = np.zeros(segment_data_shape, 'i')
-        coronal_contour_img = np.zeros(segment_data_shape, 'i')
-        horizontal_contour_img = np.zeros(segment_data_shape, 'i')
-
-        # pre-process boundary ----- todo: change this part as optional
-        process_index = np.linspace(70, 78, segment_data_shape[0])
-        for i in range(segment_data_shape[0]):
-            self.progress.emit(process_index[i])
-            da_slice = segmentation_data[i, :, :].copy()
-            contour_img = make_contour_img(da_slice)
-            sagital_contour_img[i, :, :] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'sagital_contour_pre_made.pkl'), 'wb')
-        pickle.dump(sagital_contour_img, outfile_ct)
-        outfile_ct.close()
-        self.progress.emit(80)
-
-        process_index = np.linspace(80, 88, segment_data_shape[1])
-        for i in range(segment_data_shape[1]):
-            self.progress.emit(process_index[i])
-            da_slice = segmentation_data[:, i, :].copy()
-            contour_img = make_contour_img(da_slice)
-            coronal_contour_img[:, i, :] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'coronal_contour_pre_made.pkl'), 'wb')
-        pickle.dump(coronal_contour_img, outfile_ct)
-        outfile_ct.close()
-        self.progress.emit(90)
-
-        process_index = np.linspace(90, 98, segment_data_shape[2])
-        for i in range(segment_data_shape[2]):
-            self.progress.emit(process_index[i])
-            da_slice = segmentation_data[:, :, i].copy()
-            contour_img = make_contour_img(da_slice)
-            horizontal_contour_img[:, :, i] = contour_img
-
-        outfile_ct = open(os.path.join(self.saving_folder, 'horizontal_contour_pre_made.pkl'), 'wb')
-        pickle.dump(horizontal_contour_img, outfile_ct)
-        outfile_ct.close()
-
-        self.progress.emit(100)
-
         self.finished.emit()
 
 
@@ -405,6 +176,9 @@ class AtlasProcessor(QDialog):
         self.factor_input1 = QLineEdit('2')
         self.factor_input1.setValidator(QIntValidator(2, 99999))
 
+        self.boundary_check = QCheckBox('Pre-compute region contours (faster browsing, larger atlas folder)')
+        self.boundary_check.setChecked(True)
+
         dim_selector_label = QLabel('CSys Selector: ')
 
         self.x_axis_combo = QComboBox()
@@ -472,9 +246,11 @@ class AtlasProcessor(QDialog):
         layout.addWidget(self.y_axis_combo, 7, 2, 1, 1)
         layout.addWidget(self.z_axis_combo, 7, 3, 1, 1)
 
-        layout.addWidget(self.process_info, 8, 0, 1, 4)
-        layout.addWidget(self.process_btn, 9, 0, 1, 4)
-        layout.addWidget(progress_wrap, 10, 0, 1, 4)
+        layout.addWidget(self.boundary_check, 8, 0, 1, 4)
+
+        layout.addWidget(self.process_info, 9, 0, 1, 4)
+        layout.addWidget(self.process_btn, 10, 0, 1, 4)
+        layout.addWidget(progress_wrap, 11, 0, 1, 4)
 
         # connect all buttons
         self.data_btn.clicked.connect(self.get_data_file)
@@ -639,7 +415,7 @@ class AtlasProcessor(QDialog):
         self.worker = CustomerAtlasWorker()
         self.worker.set_data(self.folder_path, self.data_local, self.segmentation_local, self.label_local,
                              direction_change, transpose_order, self.bregma_coord, self.voxel_size, self.mask_local,
-                             self.factor_val)
+                             self.factor_val, self.lambda_coord, self.boundary_check.isChecked())
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
         self.worker.finished.connect(self.on_finish)
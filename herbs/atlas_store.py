@@ -0,0 +1,316 @@
+import os
+import pickle
+import numpy as np
+
+
+# The atlas store keeps every big atlas volume as a raw C-ordered file next to a small pickled header.
+# Volumes are opened with np.memmap, so opening an atlas only reads the header, the pages of a volume are read
+# when a slice touches them and are shared between HERBS processes through the OS page cache.
+
+store_header_name = 'atlas_store_header.pkl'
+store_array_names = ['atlas', 'segment', 's_contour', 'c_contour', 'h_contour']
+# first / last in-brain voxel along the rays of every axis, and the signed distance to the brain surface
+surface_map_names = ['surface_0', 'surface_1', 'surface_2']
+surface_distance_name = 'surface_dist'
+# first / last non-zero intensity voxel along the last axis (dorsal-ventral), read by the hover depth readout
+surface_intensity_name = 'surface_atlas'
+
+
+def get_store_header_path(atlas_folder):
+    return os.path.join(atlas_folder, store_header_name)
+
+
+def get_store_array_path(atlas_folder, name):
+    return os.path.join(atlas_folder, 'atlas_store_{}.raw'.format(name))
+
+
+def check_atlas_store(atlas_folder, with_boundary=True):
+    header = read_store_header(atlas_folder)
+    if header is None:
+        return False
+    valid_names = store_array_names if with_boundary else store_array_names[:2]
+    for name in valid_names:
+        if name not in header['arrays']:
+            return False
+        if not os.path.exists(get_store_array_path(atlas_folder, name)):
+            return False
+    if header['atlas_info'] is None or header['unique_label'] is None or 'region_ids' not in header:
+        return False
+    return True
+
+
+def read_store_header(atlas_folder):
+    header_path = get_store_header_path(atlas_folder)
+    if not os.path.exists(header_path):
+        return None
+    try:
+        infile = open(header_path, 'rb')
+        header = pickle.load(infile)
+        infile.close()
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return header
+
+
+def write_store_header(atlas_folder, header):
+    # write to a temporary file first, a reader never sees a half written header
+    header_path = get_store_header_path(atlas_folder)
+    temp_path = header_path + '.tmp'
+    outfile = open(temp_path, 'wb')
+    pickle.dump(header, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    outfile.close()
+    os.replace(temp_path, header_path)
+
+
+def get_store_header(atlas_folder):
+    header = read_store_header(atlas_folder)
+    if header is None:
+        header = {'version': 1, 'arrays': {}, 'atlas_info': None, 'unique_label': None}
+    return header
+
+
+def get_label_dtype(label_data):
+    label_min = np.min(label_data)
+    label_max = np.max(label_data)
+    if label_min < 0:
+        if label_min >= np.iinfo(np.int32).min and label_max <= np.iinfo(np.int32).max:
+            return np.dtype('int32')
+        return np.dtype('int64')
+    if label_max <= np.iinfo(np.uint16).max:
+        return np.dtype('uint16')
+    if label_max <= np.iinfo(np.uint32).max:
+        return np.dtype('uint32')
+    return np.dtype('uint64')
+
+
+def compact_intensity(data, data_max=None):
+    """
+    Quantize a (normalized) intensity volume to uint8.
+
+    Non-zero voxels never become 0, the brain outline (intensity != 0) stays the same as in the float volume.
+
+    :param data: intensity volume or a part of it
+    :param data_max: maximum of the whole volume, maps to 255
+    :return: uint8 array, scale to get back the intensity (intensity = stored * scale)
+    """
+    if data_max is None:
+        data_max = np.max(data)
+    if data_max <= 0:
+        return np.zeros(data.shape, 'uint8'), 1. / 255
+    scaled = np.round(np.asarray(data, 'float32') * (255. / data_max))
+    scaled[np.logical_and(scaled == 0, data > 0)] = 1
+    return scaled.astype('uint8'), data_max / 255.
+
+
+def get_index_dtype(n_regions):
+    if n_regions <= np.iinfo(np.uint16).max + 1:
+        return np.dtype('uint16')
+    return np.dtype('uint32')
+
+
+def make_region_ids(segmentation_data, chunk_size=16):
+    """
+    Sorted structure ids present in a segmentation volume, background 0 always comes first.
+
+    :param segmentation_data: label volume with structure ids
+    :param chunk_size: number of slices along the first axis handled at once
+    :return: region_ids, region index i stands for structure id region_ids[i]
+    """
+    region_ids = np.zeros(1, 'int64')
+    for i in range(0, segmentation_data.shape[0], chunk_size):
+        chunk_ids = np.unique(segmentation_data[i:i + chunk_size])
+        region_ids = np.union1d(region_ids, chunk_ids.astype('int64'))
+    return region_ids
+
+
+def remap_label_chunk(label_chunk, region_ids):
+    return np.searchsorted(region_ids, label_chunk).astype(get_index_dtype(len(region_ids)))
+
+
+def index_label_volume(segmentation_data, region_ids=None, chunk_size=16):
+    """
+    Replace the structure ids of a segmentation volume by contiguous region indices.
+
+    :param segmentation_data: label volume with structure ids
+    :param region_ids: sorted structure ids, made from the volume if None
+    :param chunk_size: number of slices along the first axis handled at once
+    :return: index volume (uint16 for up to 65536 regions), region_ids
+    """
+    if region_ids is None:
+        region_ids = make_region_ids(segmentation_data, chunk_size)
+    index_data = np.zeros(segmentation_data.shape, get_index_dtype(len(region_ids)))
+    for i in range(0, segmentation_data.shape[0], chunk_size):
+        index_data[i:i + chunk_size] = remap_label_chunk(segmentation_data[i:i + chunk_size], region_ids)
+    return index_data, region_ids
+
+
+def get_store_dtype(name, data, region_ids=None):
+    if name == 'atlas':
+        return np.dtype('uint8')
+    if name == 'segment':
+        return get_index_dtype(len(region_ids))
+    # contours only hold 0 and 1
+    return np.dtype('uint8')
+
+
+def save_store_array(atlas_folder, name, data, scale=None, region_ids=None):
+    """
+    Write one volume of the atlas store with the narrowest safe dtype and register it in the header.
+
+    The intensity volume is stored as uint8 with a scale, labels as contiguous region indices (uint16 up to 65536
+    regions) with the index -> structure id table in the header, and contours as uint8.
+
+    :param atlas_folder: atlas folder
+    :param name: one of store_array_names
+    :param data: numpy array
+    :param scale: intensity scale of an atlas volume which is already uint8
+    :param region_ids: index -> structure id table of a segmentation which is already an index volume
+    """
+    data = np.asarray(data)
+    data_max = None
+    remap_ids = None
+    if name == 'atlas':
+        if data.dtype == np.uint8:
+            scale = 1. / 255 if scale is None else scale
+        else:
+            data_max = np.max(data)
+            scale = data_max / 255. if data_max > 0 else 1. / 255
+    elif name == 'segment' and region_ids is None:
+        region_ids = make_region_ids(data)
+        remap_ids = region_ids
+    da_dtype = get_store_dtype(name, data, region_ids)
+
+    array_path = get_store_array_path(atlas_folder, name)
+    mm = np.memmap(array_path, dtype=da_dtype, mode='w+', shape=data.shape)
+    # copy slab by slab, non-contiguous inputs never get a full contiguous copy
+    for i in range(0, data.shape[0], 16):
+        if data_max is not None:
+            mm[i:i + 16] = compact_intensity(data[i:i + 16], data_max)[0]
+        elif remap_ids is not None:
+            mm[i:i + 16] = remap_label_chunk(data[i:i + 16], remap_ids)
+        else:
+            mm[i:i + 16] = data[i:i + 16]
+    mm.flush()
+    del mm
+
+    header = get_store_header(atlas_folder)
+    header['arrays'][name] = {'dtype': da_dtype.str, 'shape': tuple(int(val) for val in data.shape)}
+    if scale is not None:
+        header['arrays'][name]['scale'] = float(scale)
+    if name == 'segment':
+        header['region_ids'] = np.asarray(region_ids, 'int64')
+    write_store_header(atlas_folder, header)
+
+
+def save_store_info(atlas_folder, atlas_info=None, unique_label=None):
+    header = get_store_header(atlas_folder)
+    if atlas_info is not None:
+        # the surface memory maps are attached when loading, they are not part of the info
+        atlas_info = list(atlas_info)
+        atlas_info[3] = {key: val for key, val in atlas_info[3].items() if key != 'surface'}
+        header['atlas_info'] = atlas_info
+    if unique_label is not None:
+        header['unique_label'] = np.asarray(unique_label)
+    write_store_header(atlas_folder, header)
+
+
+def create_store_array(atlas_folder, name, shape, dtype):
+    """
+    Allocate an empty volume in the atlas store, so several processes can fill parts of it through
+    open_store_array(..., mode='r+').
+
+    :param atlas_folder: atlas folder
+    :param name: one of store_array_names
+    :param shape: shape of the volume
+    :param dtype: dtype of the volume
+    """
+    da_dtype = np.dtype(dtype)
+    mm = np.memmap(get_store_array_path(atlas_folder, name), dtype=da_dtype, mode='w+', shape=tuple(shape))
+    mm.flush()
+    del mm
+
+    header = get_store_header(atlas_folder)
+    header['arrays'][name] = {'dtype': da_dtype.str, 'shape': tuple(int(val) for val in shape)}
+    write_store_header(atlas_folder, header)
+
+
+def open_store_array(atlas_folder, name, header=None, mode='r'):
+    if header is None:
+        header = read_store_header(atlas_folder)
+    entry = header['arrays'][name]
+    data = np.memmap(get_store_array_path(atlas_folder, name), dtype=np.dtype(entry['dtype']), mode=mode,
+                     shape=entry['shape'])
+    return data
+
+
+def load_surface_store(atlas_folder, header=None):
+    """
+    :return: dict with the surface maps by axis (0, 1, 2), 'distance' / 'distance_scale' and 'intensity' which are
+             in the store, all in the store orientation
+    """
+    if header is None:
+        header = read_store_header(atlas_folder)
+    surface = {}
+    for axis, name in enumerate(surface_map_names):
+        if name in header['arrays']:
+            surface[axis] = open_store_array(atlas_folder, name, header)
+    if surface_distance_name in header['arrays']:
+        surface['distance'] = open_store_array(atlas_folder, surface_distance_name, header)
+        surface['distance_scale'] = header['arrays'][surface_distance_name].get('scale', 1.)
+    if surface_intensity_name in header['arrays']:
+        surface['intensity'] = open_store_array(atlas_folder, surface_intensity_name, header)
+    return surface
+
+
+def load_atlas_store(atlas_folder):
+    """
+    Open all volumes of the atlas store as read-only memory maps.
+
+    :param atlas_folder: atlas folder
+    :return: atlas_data (uint8, atlas_info[3]['intensity_scale'] gives the intensity), atlas_info,
+             segmentation_data (region indices, atlas_info[3]['region_ids'] gives the structure ids), unique_label,
+             boundary, atlas_info[3]['surface'] holds the surface maps which are in the store (see load_surface_store)
+    """
+    header = read_store_header(atlas_folder)
+    atlas_data = open_store_array(atlas_folder, 'atlas', header)
+    segmentation_data = open_store_array(atlas_folder, 'segment', header)
+    boundary = {}
+    for name in ['s_contour', 'c_contour', 'h_contour']:
+        if name in header['arrays']:
+            boundary[name] = open_store_array(atlas_folder, name, header)
+    atlas_info = header['atlas_info']
+    atlas_info[3]['intensity_scale'] = header['arrays']['atlas'].get('scale', 1. / 255)
+    atlas_info[3]['region_ids'] = header['region_ids']
+    atlas_info[3]['surface'] = load_surface_store(atlas_folder, header)
+    return atlas_data, atlas_info, segmentation_data, header['unique_label'], boundary
+
+
+def save_atlas_store(atlas_folder, atlas_data, atlas_info, segmentation_data, unique_label, boundary=None):
+    save_store_array(atlas_folder, 'atlas', atlas_data)
+    save_store_array(atlas_folder, 'segment', segmentation_data, region_ids=atlas_info[3].get('region_ids'))
+    if boundary is not None:
+        for name in ['s_contour', 'c_contour', 'h_contour']:
+            if name in boundary:
+                save_store_array(atlas_folder, name, boundary[name])
+    save_store_info(atlas_folder, atlas_info, unique_label)
+
+
+def convert_pkl_atlas_to_store(atlas_folder):
+    """
+    One-time conversion of a pre-processed atlas folder (atlas_pre_made.pkl, segment_pre_made.pkl and the contour
+    pkls) into the atlas store, the pkl files are left untouched.
+
+    :param atlas_folder: atlas folder
+    :return: message, None if success
+    """
+    from .atlas_loader import AtlasLoader
+
+    da_atlas = AtlasLoader(atlas_folder, use_store=False)
+    if not da_atlas.success:
+        return da_atlas.msg
+    try:
+        save_atlas_store(atlas_folder, da_atlas.atlas_data, da_atlas.atlas_info, da_atlas.segmentation_data,
+                         da_atlas.unique_label, da_atlas.boundary)
+    except OSError:
+        return 'OSError: possible reason - disk full, please contact maintainers.'
+    return None
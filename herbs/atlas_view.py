@@ -1,5 +1,6 @@
 import os
 import sys
+from collections import OrderedDict
 import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
@@ -12,6 +13,7 @@ from PyQt5.QtCore import *
 from .image_stacks import SliceStack
 from .slice_stacks import SliceStacks
 from .label_tree import LabelTree
+from .decode_cache import TileCache
 from .uuuuuu import *
 
 
@@ -194,6 +196,7 @@ class SliceRotation(QWidget):
 
         self.h_slider = QSlider(Qt.Horizontal)
         self.h_slider.sliderMoved.connect(self.h_slider_changed)
+        self.h_slider.sliderReleased.connect(self.slider_released)
         self.h_slider.setValue(0)
         self.h_slider.setRange(-self.n_steps, self.n_steps)
 
@@ -208,6 +211,7 @@ class SliceRotation(QWidget):
 
         self.v_slider = QSlider(Qt.Horizontal)
         self.v_slider.sliderMoved.connect(self.v_slider_changed)
+        self.v_slider.sliderReleased.connect(self.slider_released)
         self.v_slider.setValue(0)
         self.v_slider.setRange(-self.n_steps, self.n_steps)
 
@@ -223,6 +227,13 @@ class SliceRotation(QWidget):
     def set_prec(self, prec):
         self.prec = prec
 
+    def is_dragging(self):
+        return self.h_slider.isSliderDown() or self.v_slider.isSliderDown()
+
+    def slider_released(self):
+        # slices are shown coarse while dragging, draw the final angle at full resolution
+        self.sig_slice_rotated.emit(np.deg2rad([self.h_spinbox.value(), self.v_spinbox.value()]))
+
     def h_slider_changed(self):
         val = self.h_slider.value() * self.prec
         self.h_spinbox.setValue(val)
@@ -288,7 +299,19 @@ class AtlasView(QObject):
         self.atlas_data = None
         self.atlas_label = None
         self.label_info = None
+        self.region_info = None
         self.atlas_boundary = None
+        # contours of the shown slices when the atlas comes without contour volumes, keyed by (axis, page)
+        self.contour_cache = OrderedDict()
+        self.contour_cache_size = 48
+        # sampling grids of the rotated slices, dragging back to a visited angle does not rebuild them. A full size
+        # grid of a 10 um atlas is about 10 MB, the budget keeps a handful of them
+        self.oblique_grid_cache = TileCache(64 * 1024 * 1024)
+        # first / last in-brain voxel along the rays of every axis and the distance to the surface, from the atlas store
+        self.surface_maps = {}
+        self.surface_distance = None
+        self.surface_distance_scale = 1.
+        self.surface_intensity = None
         self.slice_size = None
         self.slice_tb_size_base = 80
         self.coronal_tb_size = None
@@ -646,7 +669,22 @@ class AtlasView(QObject):
         self.atlas_label = atlas_label
         self.label_info = label_info
         self.atlas_boundary = boundaries
-        self.label_tree.set_labels(label_info)
+        self.contour_cache.clear()
+        self.oblique_grid_cache.clear()
+        self.set_surface_store(atlas_info[3].get('surface', {}))
+        # atlas_label holds region indices, region_info gives the dense label tables per index
+        region_ids = atlas_info[3]['region_ids']
+        self.region_info = make_region_info(label_info, region_ids)
+        self.label_tree.set_labels(label_info, region_ids)
+
+        # the atlas store keeps the intensity as uint8, older atlases as normalized float
+        if self.atlas_data.dtype == np.uint8:
+            intensity_levels = (0, 255)
+        else:
+            intensity_levels = (0, 1)
+        self.cimg.img.setLevels(intensity_levels)
+        self.simg.img.setLevels(intensity_levels)
+        self.himg.img.setLevels(intensity_levels)
 
         self.atlas_size = self.atlas_data.shape
         self.anterior_info = atlas_info[0]
@@ -792,6 +830,104 @@ class AtlasView(QObject):
         self.simg.label_img.setOpts(opacity=val)
         self.himg.label_img.setOpts(opacity=val)
 
+    def get_slice_contour(self, contour_key, slice_number, label_slice):
+        """
+        Contour image of one atlas slice, read from the contour volume or computed from the label slice.
+
+        :param contour_key: 'c_contour', 's_contour' or 'h_contour'
+        :param slice_number: index of the slice along the axis of contour_key
+        :param label_slice: label image of the slice
+        :return: uint8 contour image
+        """
+        if contour_key in self.atlas_boundary:
+            if contour_key == 'c_contour':
+                return self.atlas_boundary[contour_key][:, :, slice_number]
+            elif contour_key == 's_contour':
+                return self.atlas_boundary[contour_key][:, slice_number, :]
+            else:
+                return self.atlas_boundary[contour_key][slice_number, :, :]
+        cache_key = (contour_key, slice_number)
+        if cache_key in self.contour_cache:
+            self.contour_cache.move_to_end(cache_key)
+            return self.contour_cache[cache_key]
+        contour_img = make_contour_img(label_slice)
+        self.contour_cache[cache_key] = contour_img
+        if len(self.contour_cache) > self.contour_cache_size:
+            self.contour_cache.popitem(last=False)
+        return contour_img
+
+    def set_surface_store(self, surface):
+        """
+        :param surface: surface arrays of the atlas store, see load_surface_store, they are in the store orientation
+                        (the processing orientation of the labels, the last axis points up)
+        """
+        self.surface_maps = {axis: surface[axis] for axis in range(3) if axis in surface}
+        self.surface_distance = surface.get('distance')
+        self.surface_distance_scale = surface.get('distance_scale', 1.)
+        self.surface_intensity = surface.get('intensity')
+
+    def get_column_top_map(self):
+        """
+        :return: highest brain voxel of every column in the processing orientation of the labels (transposed by
+                 (1, 2, 0), last axis flipped to point up), -1 for empty columns, None if the atlas store has no
+                 surface maps (the columns are searched one by one then)
+        """
+        if 2 not in self.surface_maps:
+            return None
+        return self.surface_maps[2][1]
+
+    def get_surface_distance_data(self):
+        """
+        :return: signed distance to the brain surface in the processing orientation (None if not in the atlas store),
+                 um per stored unit
+        """
+        if self.surface_distance is None:
+            return None, 1.
+        return self.surface_distance, self.surface_distance_scale * self.vox_size_um
+
+    def get_surface_top(self, vox):
+        """
+        :param vox: voxel of the atlas volume (dv, ml, ap)
+        :return: first dv index with atlas intensity in the column of vox, nan for empty columns or columns outside
+                 the volume
+        """
+        ml_id, ap_id = int(vox[1]), int(vox[2])
+        if not (0 <= ml_id < self.atlas_size[1] and 0 <= ap_id < self.atlas_size[2]):
+            return np.nan
+        if self.surface_intensity is None:
+            # until the store has the intensity map, e.g. while it is added in the background
+            da_vec = self.atlas_data[:, ml_id, ap_id] != 0
+            return np.argmax(da_vec) if np.any(da_vec) else np.nan
+        # the store column points up, its last intensity voxel is the first one from the top of the view
+        column_top = self.surface_intensity[1, ml_id, ap_id]
+        if column_top < 0:
+            return np.nan
+        return self.atlas_size[0] - 1 - column_top
+
+    def get_oblique_slice(self, origin, vectors, shape, coarse=False):
+        """
+        Intensity, label and contour images of a rotated atlas slice.
+
+        :param origin: volume coordinates of the pixel (0, 0)
+        :param vectors: volume vectors of one pixel step along the rows and the columns of the slice
+        :param shape: shape of the slice
+        :param coarse: sample every second pixel (preview while a rotation slider is dragged)
+        :return: atlas, label and contour images of the given shape
+        """
+        step = 2 if coarse else 1
+        cache_key = (tuple(np.round(origin, 6)), tuple(np.round(np.ravel(vectors), 6)), tuple(shape), step)
+        grid = self.oblique_grid_cache.get(cache_key)
+        if grid is None:
+            grid = get_oblique_grid(origin, vectors, shape, step)
+            self.oblique_grid_cache.put(cache_key, grid)
+        atlas, label = sample_oblique_slice(self.atlas_data, self.atlas_label, grid)
+        contour = make_contour_img(label)
+        if coarse:
+            # back to the full size, pixel positions stay the same for the mouse events
+            atlas, label, contour = [np.repeat(np.repeat(da_img, 2, axis=0), 2, axis=1)[:shape[0], :shape[1]]
+                                     for da_img in [atlas, label, contour]]
+        return atlas, label, contour
+
     # slice number changed
     def coronal_slice_page_changed(self, page_number):
         self.crotation_ctrl.h_spinbox.setValue(0)
@@ -801,7 +937,7 @@ class AtlasView(QObject):
         self.current_coronal_index = page_number
         da_atlas_slice = self.atlas_data[:, :, page_number]
         da_atlas_label = self.atlas_label[:, :, page_number]
-        da_atlas_contour = self.atlas_boundary['c_contour'][:, :, page_number]
+        da_atlas_contour = self.get_slice_contour('c_contour', page_number, da_atlas_label)
         self.cimg.set_data(da_atlas_slice, da_atlas_label, da_atlas_contour, scale=None)
 
         slide_dist = (page_number - self.origin_3d[1])
@@ -818,7 +954,7 @@ class AtlasView(QObject):
         self.current_sagital_index = page_number
         da_atlas_slice = self.atlas_data[:, page_number, :]
         da_atlas_label = self.atlas_label[:, page_number, :]
-        da_atlas_contour = self.atlas_boundary['s_contour'][:, page_number, :]
+        da_atlas_contour = self.get_slice_contour('s_contour', page_number, da_atlas_label)
         self.simg.set_data(da_atlas_slice, da_atlas_label, da_atlas_contour, scale=None)
 
         slide_dist = (page_number - self.origin_3d[0])
@@ -836,7 +972,7 @@ class AtlasView(QObject):
         slice_number = self.atlas_size[0] - 1 - page_number
         da_atlas_slice = self.atlas_data[slice_number, :, :]
         da_atlas_label = self.atlas_label[slice_number, :, :]
-        da_atlas_contour = self.atlas_boundary['h_contour'][slice_number, :, :]
+        da_atlas_contour = self.get_slice_contour('h_contour', slice_number, da_atlas_label)
         self.himg.set_data(da_atlas_slice, da_atlas_label, da_atlas_contour, scale=None)
 
         slide_dist = (page_number - self.origin_3d[2])
@@ -881,11 +1017,8 @@ class AtlasView(QObject):
         ox_length = self.atlas_size[1]
         oz_length = self.atlas_size[0]
 
-        atlas = fn.affineSlice(self.atlas_data, shape=(oz_length, ox_length), vectors=[oz_vector, ox_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=1)
-        label = fn.affineSlice(self.atlas_label, shape=(oz_length, ox_length), vectors=[oz_vector, ox_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=0)
-        da_contour = make_contour_img(label)
+        atlas, label, da_contour = self.get_oblique_slice(oval_new, [oz_vector, ox_vector], (oz_length, ox_length),
+                                                          coarse=self.crotation_ctrl.is_dragging())
         self.cimg.set_data(atlas, label, da_contour, scale=None)
 
         self.c_rotm_3d = np.dot(rotation_z(z_angle), rotation_x(-x_angle))
@@ -924,11 +1057,8 @@ class AtlasView(QObject):
         oy_length = self.atlas_size[2]
         oz_length = self.atlas_size[0]
 
-        atlas = fn.affineSlice(self.atlas_data, shape=(oz_length, oy_length), vectors=[oz_vector, oy_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=1)
-        label = fn.affineSlice(self.atlas_label, shape=(oz_length, oy_length), vectors=[oz_vector, oy_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=0)
-        da_contour = make_contour_img(label)
+        atlas, label, da_contour = self.get_oblique_slice(oval_new, [oz_vector, oy_vector], (oz_length, oy_length),
+                                                          coarse=self.srotation_ctrl.is_dragging())
         self.simg.set_data(atlas, label, da_contour, scale=None)
 
         self.s_rotm_3d = np.dot(rotation_z(z_angle), rotation_y(-y_angle))
@@ -967,11 +1097,8 @@ class AtlasView(QObject):
         oy_length = self.atlas_size[2]
         ox_length = self.atlas_size[1]
 
-        atlas = fn.affineSlice(self.atlas_data, shape=(ox_length, oy_length), vectors=[ox_vector, oy_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=1)
-        label = fn.affineSlice(self.atlas_label, shape=(ox_length, oy_length), vectors=[ox_vector, oy_vector],
-                               origin=(oval_new[0], oval_new[1], oval_new[2]), axes=(0, 1, 2), order=0)
-        da_contour = make_contour_img(label)
+        atlas, label, da_contour = self.get_oblique_slice(oval_new, [ox_vector, oy_vector], (ox_length, oy_length),
+                                                          coarse=self.hrotation_ctrl.is_dragging())
         self.himg.set_data(atlas, label, da_contour, scale=None)
 
         self.h_rotm_3d = np.dot(rotation_y(-y_angle), rotation_x(-x_angle))
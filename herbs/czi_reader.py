@@ -1,4 +1,6 @@
 import cv2
+import math
+import threading
 from aicspylibczi import CziFile
 from pathlib import Path
 from os.path import dirname, realpath, join
@@ -6,12 +8,148 @@ import pickle
 import numpy as np
 import colorsys
 from .uuuuuu import hex2rgb
+from .decode_cache import TileCache, get_default_decode_cache
 
 # czi_path = '~/Work/Kavli/Data/HERBS_DATA/abraham/Pecorino_mec_slide_1.czi'
 
+
+# Mosaic scenes are read as tile pyramids: level k is the scene scaled by 1 / 2 ** k and cut into square tiles.
+# Only the tiles covering a requested region are decoded, decoded tiles are kept in a cache with a byte budget
+# shared by all scenes (see TileCache in decode_cache), so memory stays bounded however big the slide is.
+
+
+class CZISceneArray(object):
+    def __init__(self, reader, scene_index, tile_size=1024):
+        """
+        One mosaic scene as a multi-resolution tiled array.
+
+        :param reader: CZIReader of the file
+        :param scene_index: index of the scene
+        :param tile_size: tile size in pixels of the level
+        """
+        self.reader = reader
+        self.scene_index = scene_index
+        self.tile_size = tile_size
+        self.bbox = reader.scene_bbox[scene_index]
+        self.n_channels = reader.n_channels
+        self.n_levels = 1
+        while max(self.bbox[2], self.bbox[3]) > tile_size * 2 ** (self.n_levels - 1):
+            self.n_levels += 1
+
+    def get_level_shape(self, level):
+        factor = 2 ** level
+        return int(math.ceil(self.bbox[3] / factor)), int(math.ceil(self.bbox[2] / factor))
+
+    def get_level(self, scale):
+        """
+        :return: coarsest level with at least the resolution of scale
+        """
+        if scale >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1. / scale) + 1e-9)), self.n_levels - 1)
+
+    def get_tile_rect(self, level, tile_row, tile_col):
+        level_shape = self.get_level_shape(level)
+        r0 = tile_row * self.tile_size
+        c0 = tile_col * self.tile_size
+        return r0, min(r0 + self.tile_size, level_shape[0]), c0, min(c0 + self.tile_size, level_shape[1])
+
+    def decode_tile(self, level, tile_row, tile_col):
+        r0, r1, c0, c1 = self.get_tile_rect(level, tile_row, tile_col)
+        factor = 2 ** level
+        x0 = c0 * factor
+        y0 = r0 * factor
+        region = (self.bbox[0] + x0, self.bbox[1] + y0, min((c1 - c0) * factor, self.bbox[2] - x0),
+                  min((r1 - r0) * factor, self.bbox[3] - y0))
+        tile = self.reader.decode_region(region, 1. / factor)
+        if tile.shape[0] != r1 - r0 or tile.shape[1] != c1 - c0:
+            tile = cv2.resize(tile, (c1 - c0, r1 - r0), interpolation=cv2.INTER_AREA)
+            tile = tile.reshape(r1 - r0, c1 - c0, -1)
+        return tile
+
+    def get_tile(self, level, tile_row, tile_col):
+        key = (self.scene_index, level, tile_row, tile_col)
+        tile = self.reader.tile_cache.get(key)
+        if tile is not None:
+            return tile
+        tile = self.downsample_cached_tiles(level, tile_row, tile_col)
+        if tile is None:
+            tile = self.decode_tile(level, tile_row, tile_col)
+        self.reader.tile_cache.put(key, tile)
+        return tile
+
+    def downsample_cached_tiles(self, level, tile_row, tile_col):
+        # a tile can be made from its 4 cached children one level finer without decoding
+        if level == 0:
+            return None
+        r0, r1, c0, c1 = self.get_tile_rect(level, tile_row, tile_col)
+        n_rows, n_cols = self.get_n_tiles(level - 1)
+        children = []
+        for child_row in range(2 * tile_row, min(2 * tile_row + 2, n_rows)):
+            row_tiles = []
+            for child_col in range(2 * tile_col, min(2 * tile_col + 2, n_cols)):
+                child = self.reader.tile_cache.get((self.scene_index, level - 1, child_row, child_col))
+                if child is None:
+                    return None
+                row_tiles.append(child)
+            children.append(np.concatenate(row_tiles, axis=1))
+        fine_tile = np.concatenate(children, axis=0)
+        tile = cv2.resize(fine_tile, (c1 - c0, r1 - r0), interpolation=cv2.INTER_AREA)
+        return tile.reshape(r1 - r0, c1 - c0, -1)
+
+    def read_region(self, level, rect=None):
+        """
+        :param level: pyramid level
+        :param rect: (row_start, row_end, col_start, col_end) in pixels of the level, the whole level if None
+        :return: image of the region, (rows, cols, n_channels)
+        """
+        level_shape = self.get_level_shape(level)
+        if rect is None:
+            rect = (0, level_shape[0], 0, level_shape[1])
+        r0, r1, c0, c1 = max(rect[0], 0), min(rect[1], level_shape[0]), max(rect[2], 0), min(rect[3], level_shape[1])
+        res = None
+        for tile_row in range(r0 // self.tile_size, (r1 - 1) // self.tile_size + 1):
+            for tile_col in range(c0 // self.tile_size, (c1 - 1) // self.tile_size + 1):
+                tile = self.get_tile(level, tile_row, tile_col)
+                if res is None:
+                    res = np.zeros((r1 - r0, c1 - c0, tile.shape[2]), tile.dtype)
+                tr0, tr1, tc0, tc1 = self.get_tile_rect(level, tile_row, tile_col)
+                sr0, sr1, sc0, sc1 = max(tr0, r0), min(tr1, r1), max(tc0, c0), min(tc1, c1)
+                res[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = tile[sr0 - tr0:sr1 - tr0, sc0 - tc0:sc1 - tc0]
+        return res
+
+    def get_n_tiles(self, level):
+        level_shape = self.get_level_shape(level)
+        return int(math.ceil(level_shape[0] / self.tile_size)), int(math.ceil(level_shape[1] / self.tile_size))
+
+    def is_level_cached(self, level):
+        n_rows, n_cols = self.get_n_tiles(level)
+        return all((self.scene_index, level, tile_row, tile_col) in self.reader.tile_cache
+                   for tile_row in range(n_rows) for tile_col in range(n_cols))
+
+    def read_scaled(self, scale):
+        """
+        :return: the whole scene at any scale. Pyramid scales and scales whose finer level is already cached are
+                 read through the tiles, other scales are decoded directly at the scale.
+        """
+        level = self.get_level(scale)
+        out_size = (max(int(round(self.bbox[2] * scale)), 1), max(int(round(self.bbox[3] * scale)), 1))
+        level_shape = self.get_level_shape(level)
+        if out_size != (level_shape[1], level_shape[0]) and not self.is_level_cached(level):
+            # decoding the finer level and resizing it would read up to 4 times the pixels
+            img = self.reader.decode_region(self.bbox, scale)
+        else:
+            img = self.read_region(level)
+        if out_size != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, out_size, interpolation=cv2.INTER_AREA).reshape(out_size[1], out_size[0], -1)
+        return img
+
+
 class CZIReader(object):
-    def __init__(self, czi_path):
+    def __init__(self, czi_path, cache_size=512 * 1024 * 1024, scene_cache_size=1024 * 1024 * 1024,
+                 use_decode_cache=True):
         self.is_czi = True
+        self.czi_path = czi_path
         self.file_name_list = [czi_path[:-4]]
         self.czi = CziFile(czi_path)
         self.czi_info = self.czi.dims
@@ -21,6 +159,18 @@ class CZIReader(object):
         self.n_pages = 1
         self.data = {}
         self.scale = {}
+        self.tile_cache = TileCache(cache_size)
+        self.scene_arrays = {}
+        self.read_lock = threading.Lock()
+        # whole scenes decoded at a scale, (scene_index, scale) -> image
+        self.scene_cache = TileCache(scene_cache_size)
+        self.prefetch_queue = []
+        self.prefetch_thread = None
+        self.prefetch_lock = threading.Lock()
+        # scenes being decoded, (scene_index, scale) -> Event set when the decode ends
+        self.pending_scenes = {}
+        # decoded scenes on disk, reopening the slide skips the decompression
+        self.decode_cache = get_default_decode_cache() if use_decode_cache else None
 
         if 'A' in self.czi_info:
             self.is_rgb = True
@@ -116,45 +266,134 @@ class CZIReader(object):
                 self.hsv_colors.append(hsv_color)
                 self.rgb_colors.append((r, g, b))
 
-    def read_data(self, scale, scene_index=None):
-        if scene_index is None:
-            scene_index = np.arange(self.n_scenes)
-        else:
-            scene_index = [scene_index]
+    def get_scene_array(self, scene_index):
+        if scene_index not in self.scene_arrays:
+            self.scene_arrays[scene_index] = CZISceneArray(self, scene_index)
+        return self.scene_arrays[scene_index]
 
-        for scind in scene_index:
+    def decode_region(self, region, scale_factor):
+        """
+        :param region: (x, y, width, height) in pixels of the file
+        :param scale_factor: scale of the decoded image
+        :return: image, (rows, cols, n_channels), RGB for RGB files
+        """
+        # libCZI readers are not shared between threads
+        with self.read_lock:
             if self.is_rgb:
-                if self.is_mosaic:
-                    image_data = self.czi.read_mosaic(C=0, scale_factor=scale, region=self.scene_bbox[scind])
-                    if len(image_data.shape) == 4:
-                        image_data = image_data[0]
-                else:
-                    image_data_full = self.czi.read_image(region=self.scene_bbox[scind])
-                    image_data = image_data_full[0]
-                    image_info = image_data_full[1]
-                    if image_info[0][0] == 'C':
-                        image_data = image_data[0]
-                img = image_data.copy()
+                image_data = self.czi.read_mosaic(C=0, scale_factor=scale_factor, region=region)
+                if len(image_data.shape) == 4:
+                    image_data = image_data[0]
                 if self.pixel_type == 'rgb24':
-                    img_data_temp = img.astype(np.uint8)
+                    img_data_temp = image_data.astype(np.uint8)
                 else:
-                    img_data_temp = img.astype(np.uint16)
-                img_data_temp = cv2.cvtColor(img_data_temp, cv2.COLOR_BGR2RGB)
-                self.data['scene %d' % scind] = img_data_temp
-                self.scale['scene %d' % scind] = scale
+                    img_data_temp = image_data.astype(np.uint16)
+                return cv2.cvtColor(img_data_temp, cv2.COLOR_BGR2RGB)
+            temp = []
+            for j in range(self.n_channels):
+                mosaic_data = self.czi.read_mosaic(C=j, scale_factor=scale_factor, region=region)
+                temp.append(mosaic_data[0])
+        img = np.dstack(temp)
+        return img.reshape(img.shape[0], img.shape[1], self.n_channels)
+
+    def decode_scene(self, scale, scene_index):
+        if self.is_rgb and not self.is_mosaic:
+            with self.read_lock:
+                image_data_full = self.czi.read_image(region=self.scene_bbox[scene_index])
+            image_data = image_data_full[0]
+            image_info = image_data_full[1]
+            if image_info[0][0] == 'C':
+                image_data = image_data[0]
+            img = image_data.copy()
+            if self.pixel_type == 'rgb24':
+                img_data_temp = img.astype(np.uint8)
             else:
-                if self.n_channels != 1:
-                    temp = []
-                    for j in range(self.n_channels):
-                        mosaic_data = self.czi.read_mosaic(C=j, scale_factor=scale, region=self.scene_bbox[scind])
-                        img = mosaic_data[0].copy()
-                        temp.append(img)
-                    img_data_temp = np.dstack(temp)
-                    self.data['scene %d' % scind] = img_data_temp
-                    self.scale['scene %d' % scind] = scale
-                else:
-                    mosaic_data = self.czi.read_mosaic(C=0, scale_factor=scale, region=self.scene_bbox[scind])
-                    img = mosaic_data[0].copy()
-                    img_data_temp = img
-                    self.data['scene %d' % scind] = img_data_temp.reshape(img.shape[0], img.shape[1], 1)
-                    self.scale['scene %d' % scind] = scale
+                img_data_temp = img.astype(np.uint16)
+            return cv2.cvtColor(img_data_temp, cv2.COLOR_BGR2RGB)
+        return self.get_scene_array(scene_index).read_scaled(scale)
+
+    def load_scene(self, scale, scene_index):
+        if self.decode_cache is not None:
+            cached_data = self.decode_cache.get(self.czi_path, scene_index, scale)
+            if cached_data is not None:
+                return np.array(cached_data)
+        img = self.decode_scene(scale, scene_index)
+        if self.decode_cache is not None:
+            self.decode_cache.put(self.czi_path, scene_index, scale, img)
+        return img
+
+    def get_scene(self, scale, scene_index):
+        """
+        :return: the scene from the scene cache, decoded if needed. A scene which is being decoded by another thread
+                 is waited for instead of being decoded twice.
+        """
+        key = (scene_index, scale)
+        while True:
+            img = self.scene_cache.get(key)
+            if img is not None:
+                return img
+            with self.prefetch_lock:
+                event = self.pending_scenes.get(key)
+                is_owner = event is None
+                if is_owner:
+                    event = threading.Event()
+                    self.pending_scenes[key] = event
+            if not is_owner:
+                # a failed or evicted decode is tried again by this thread
+                event.wait()
+                continue
+            try:
+                img = self.load_scene(scale, scene_index)
+                self.scene_cache.put(key, img)
+                return img
+            finally:
+                with self.prefetch_lock:
+                    del self.pending_scenes[key]
+                event.set()
+
+    def read_data(self, scale, scene_index=None):
+        """
+        Decode a scene at the given scale through the tile pyramid, only the scene shown is kept in self.data.
+        Without scene_index the first scene is decoded, the other scenes are decoded when they are shown.
+        Scenes decoded by prefetch_scenes are taken from the scene cache, scenes decoded before from the decode cache
+        on disk.
+
+        :param scale: scale of the image
+        :param scene_index: index of the scene
+        """
+        if scene_index is None:
+            scene_index = 0
+        da_key = 'scene %d' % scene_index
+        for key in list(self.data.keys()):
+            if key != da_key:
+                del self.data[key]
+                del self.scale[key]
+
+        self.data[da_key] = self.get_scene(scale, scene_index)
+        self.scale[da_key] = scale
+
+    def prefetch_scenes(self, scale, scene_indexes):
+        """
+        Decode scenes at the given scale into the scene cache in a background thread. A new call replaces the scenes
+        which are still waiting.
+
+        :param scale: scale of the images
+        :param scene_indexes: indices of the scenes, the ones outside the file are skipped
+        """
+        with self.prefetch_lock:
+            self.prefetch_queue = [(ind, scale) for ind in scene_indexes if 0 <= ind < self.n_scenes]
+            if self.prefetch_queue and self.prefetch_thread is None:
+                self.prefetch_thread = threading.Thread(target=self.run_prefetch, daemon=True)
+                self.prefetch_thread.start()
+
+    def run_prefetch(self):
+        while True:
+            with self.prefetch_lock:
+                if not self.prefetch_queue:
+                    self.prefetch_thread = None
+                    return
+                scene_index, scale = self.prefetch_queue.pop(0)
+            try:
+                self.get_scene(scale, scene_index)
+            except (OSError, RuntimeError, ValueError, IndexError):
+                # the scene is decoded again when it is shown
+                continue
@@ -0,0 +1,297 @@
+import os
+import atexit
+import time
+import pickle
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+# The decode cache keeps decoded slide images as raw C-ordered files next to a small pickled index, like the atlas
+# store. Entries are keyed by the identity of the source file (path, size and modification time), the scene, the
+# channel and the scale, so a changed slide never hits an old entry. The least recently used entries are deleted
+# when the cache grows over its disk quota.
+
+cache_index_name = 'decode_cache_index.pkl'
+cache_lock_name = 'decode_cache_index.lock'
+default_cache_folder = os.path.join(os.path.expanduser('~'), '.herbs', 'decode_cache')
+
+
+def get_file_identity(file_path):
+    file_path = os.path.realpath(file_path)
+    file_stat = os.stat(file_path)
+    return file_path, file_stat.st_size, file_stat.st_mtime_ns
+
+
+def make_cache_key(file_path, scene_index, scale, channel=None):
+    """
+    :param file_path: path of the source file
+    :param scene_index: index of the scene
+    :param scale: scale of the decoded image
+    :param channel: index of the channel, None for all channels (last axis of the image)
+    :return: key of the entry
+    """
+    identity = get_file_identity(file_path)
+    key_str = '{}|{}|{}|{}|{}|{}'.format(identity[0], identity[1], identity[2], scene_index,
+                                         'all' if channel is None else int(channel), repr(float(scale)))
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+class TileCache(object):
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        """
+        In-memory LRU cache of decoded arrays (tiles, scenes, images) with a byte budget.
+
+        :param max_bytes: maximum number of bytes of the cached tiles
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.tiles
+
+    def put(self, key, tile):
+        with self.lock:
+            if key in self.tiles:
+                self.n_bytes -= self.tiles.pop(key).nbytes
+            self.tiles[key] = tile
+            self.n_bytes += tile.nbytes
+            # least recently used tiles go first, the newest tile always stays
+            while self.n_bytes > self.max_bytes and len(self.tiles) > 1:
+                self.n_bytes -= self.tiles.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.n_bytes = 0
+
+
+class DecodeCache(object):
+    def __init__(self, cache_folder=None, max_bytes=4 * 1024 * 1024 * 1024, lock_timeout=10., stale_lock_age=60.,
+                 usage_flush_interval=60.):
+        """
+        :param cache_folder: folder of the cache, ~/.herbs/decode_cache if None
+        :param max_bytes: disk quota of the cache
+        :param lock_timeout: seconds to wait for the index lock of other HERBS processes
+        :param stale_lock_age: seconds after which a lock file left by a crashed process is removed
+        :param usage_flush_interval: seconds between writes of the last use times of cache hits to the index
+        """
+        self.cache_folder = default_cache_folder if cache_folder is None else cache_folder
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.stale_lock_age = stale_lock_age
+        self.usage_flush_interval = usage_flush_interval
+        self.lock = threading.Lock()
+        # last use times of cache hits, written to the index with the next put or flush_usage
+        self.used_keys = {}
+        self.last_flush = time.time()
+
+    def get_index_path(self):
+        return os.path.join(self.cache_folder, cache_index_name)
+
+    def get_lock_path(self):
+        return os.path.join(self.cache_folder, cache_lock_name)
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_folder, '{}.raw'.format(key))
+
+    def acquire_index_lock(self):
+        """
+        Lock the index against other HERBS processes with a lock file, a lock older than stale_lock_age is taken over.
+
+        :return: True if the lock is held
+        """
+        lock_path = self.get_lock_path()
+        start_time = time.time()
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode('utf-8'))
+                os.close(fd)
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > self.stale_lock_age:
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    continue
+            if time.time() - start_time > self.lock_timeout:
+                return False
+            time.sleep(0.01)
+
+    def release_index_lock(self):
+        try:
+            os.remove(self.get_lock_path())
+        except OSError:
+            pass
+
+    def read_index(self):
+        index_path = self.get_index_path()
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            infile = open(index_path, 'rb')
+            index = pickle.load(infile)
+            infile.close()
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        return index
+
+    def write_index(self, index):
+        # write to a temporary file first, other HERBS processes never see a half written index
+        index_path = self.get_index_path()
+        temp_path = index_path + '.{}.tmp'.format(os.getpid())
+        outfile = open(temp_path, 'wb')
+        pickle.dump(index, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        outfile.close()
+        os.replace(temp_path, index_path)
+
+    def update_index(self, key=None, entry=None, entry_temp_path=None):
+        """
+        Read, change and write the index under the index lock: the last use times of the hits are merged, the entry
+        is added and the cache is evicted down to its quota. Called with self.lock held.
+
+        :param key: key of the new entry
+        :param entry: index entry of the new entry
+        :param entry_temp_path: file of the new entry, moved into place under the lock
+        :return: True if the index is written
+        """
+        if not self.acquire_index_lock():
+            return False
+        try:
+            if entry_temp_path is not None:
+                os.replace(entry_temp_path, self.get_entry_path(key))
+            index = self.read_index()
+            for used_key, last_used in self.used_keys.items():
+                if used_key in index:
+                    index[used_key]['last_used'] = max(index[used_key]['last_used'], last_used)
+            if key is not None:
+                index[key] = entry
+                self.evict(index, keep_key=key)
+            self.write_index(index)
+        finally:
+            self.release_index_lock()
+        self.used_keys = {}
+        self.last_flush = time.time()
+        return True
+
+    def flush_usage(self):
+        """
+        Write the last use times of the cache hits to the index.
+        """
+        try:
+            with self.lock:
+                if self.used_keys and os.path.exists(self.cache_folder):
+                    self.update_index()
+        except OSError:
+            pass
+
+    def get(self, file_path, scene_index, scale, channel=None):
+        """
+        :return: the cached image as a read-only memory map, None if not cached
+        """
+        try:
+            key = make_cache_key(file_path, scene_index, scale, channel)
+            with self.lock:
+                entry = self.read_index().get(key)
+                if entry is None or not os.path.exists(self.get_entry_path(key)):
+                    return None
+                data = np.memmap(self.get_entry_path(key), dtype=np.dtype(entry['dtype']), mode='r',
+                                 shape=entry['shape'])
+                # hits only touch the index now and then, not on every read
+                self.used_keys[key] = time.time()
+                if time.time() - self.last_flush > self.usage_flush_interval:
+                    self.update_index()
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def put(self, file_path, scene_index, scale, data, channel=None):
+        """
+        Store a decoded image, the least recently used entries are deleted to stay under the disk quota.
+
+        :return: True if the image is stored
+        """
+        data = np.asarray(data)
+        if data.nbytes > self.max_bytes:
+            return False
+        temp_path = None
+        try:
+            key = make_cache_key(file_path, scene_index, scale, channel)
+            os.makedirs(self.cache_folder, exist_ok=True)
+            # the entry is written to a temporary file and moved into place, an old entry file which is still mapped
+            # by a reader is never truncated
+            temp_path = self.get_entry_path(key) + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+            mm = np.memmap(temp_path, dtype=data.dtype, mode='w+', shape=data.shape)
+            mm[:] = data
+            mm.flush()
+            del mm
+            entry = {'dtype': data.dtype.str, 'shape': tuple(int(val) for val in data.shape),
+                     'size': int(data.nbytes), 'last_used': time.time()}
+            with self.lock:
+                if not self.update_index(key, entry, temp_path):
+                    return False
+                temp_path = None
+        except OSError:
+            return False
+        finally:
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        return True
+
+    def evict(self, index, keep_key=None):
+        n_bytes = sum([entry['size'] for entry in index.values()])
+        for key in sorted(index.keys(), key=lambda da_key: index[da_key]['last_used']):
+            if n_bytes <= self.max_bytes:
+                break
+            if key == keep_key:
+                continue
+            n_bytes -= index[key]['size']
+            del index[key]
+            try:
+                os.remove(self.get_entry_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            if not os.path.exists(self.cache_folder) or not self.acquire_index_lock():
+                return
+            try:
+                index = self.read_index()
+                for key in index.keys():
+                    try:
+                        os.remove(self.get_entry_path(key))
+                    except OSError:
+                        pass
+                self.write_index({})
+            finally:
+                self.release_index_lock()
+            self.used_keys = {}
+
+
+default_decode_cache = None
+
+
+def get_default_decode_cache():
+    global default_decode_cache
+    if default_decode_cache is None:
+        default_decode_cache = DecodeCache()
+        # the last use times of hits since the last put
+        atexit.register(default_decode_cache.flush_usage)
+    return default_decode_cache
@@ -44,13 +44,15 @@ from .uuuuuu import *
 from .czi_reader import CZIReader
 from .atlas_downloader import AtlasDownloader
 from .allen_downloader import AllenDownloader
-from .atlas_processor import AtlasProcessor
+from .atlas_processor import AtlasProcessor, SurfaceStoreWorker
 from .atlas_loader import AtlasLoader
+from .atlas_store import load_surface_store
 from .atlas_view import AtlasView
 
 from .image_reader import ImageReader, ImagesReader, TIFFReader
 from .image_curves import *
 from .image_view import ImageView
+from .undo_history import UndoHistory
 
 from .layers_control import *
 from .object_control import *
@@ -79,6 +81,9 @@ class HERBS(QMainWindow, FORM_Main):
         self.volume_atlas_path = None
         self.slice_atlas_path = None
         self.current_atlas_path = None
+        self.surface_thread = None
+        self.surface_worker = None
+        self.surface_pending_path = None
 
         self.current_img_path = None
         self.current_img_name = None
@@ -93,6 +98,19 @@ class HERBS(QMainWindow, FORM_Main):
         self.is_pencil_allowed = False
         self.pencil_size = 3
 
+        # mouse moves are coalesced, each hover handler runs at most once per display frame with the last position,
+        # page changes of the other atlas views wait until the mouse rests
+        self.hover_pending = {}
+        self.hover_timer = QTimer()
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(16)
+        self.hover_timer.timeout.connect(self.process_hover)
+        self.navigation_pending = []
+        self.navigation_timer = QTimer()
+        self.navigation_timer.setSingleShot(True)
+        self.navigation_timer.setInterval(80)
+        self.navigation_timer.timeout.connect(self.process_navigation)
+
         self.site_face = 0
         self.probe_type = 0
         self.tip_length = 175
@@ -185,7 +203,8 @@ class HERBS(QMainWindow, FORM_Main):
         self.project_method = 'pre plan'
         self.register_method = 0
 
-        self.action_list = []
+        # undo steps are kept until their stored differences exceed the budget (bytes)
+        self.action_history = UndoHistory(memory_budget=256 * 1024 * 1024)
         self.layer_action_after_matching = []
 
         self.probe_lines_2d_list = []
@@ -204,6 +223,9 @@ class HERBS(QMainWindow, FORM_Main):
         self.probe_img = None
 
         self.overlay_img = None
+        # incremental re-warp of the overlay while a triangulation point is dragged
+        self.histo_drag_warp = None
+        self.atlas_drag_warp = None
 
         self.error_message_color = '#ff6e6e'
         self.reminder_color = 'gray'
@@ -211,7 +233,6 @@ class HERBS(QMainWindow, FORM_Main):
 
         self.layer_shift_val = 1
         self.layer_rotate_val = 1
-        self.action_id = 0
         self.undo_count = 0
         self.redo_count = -1
 
@@ -264,10 +285,11 @@ class HERBS(QMainWindow, FORM_Main):
         self.image_view = ImageView()
         self.image_view.sig_image_changed.connect(self.update_histo_tri_onside_data)
         self.image_view.img_stacks.sig_mouse_clicked.connect(self.img_stacks_clicked)
-        self.image_view.img_stacks.sig_mouse_hovered.connect(self.img_stacks_hovered)
+        self.image_view.img_stacks.sig_mouse_hovered.connect(self.img_stacks_hover_received)
         self.image_view.img_stacks.sig_key_pressed.connect(self.img_stacks_key_pressed)
         self.image_view.img_stacks.image_dict['tri_pnts'].mouseDragged.connect(self.hist_window_tri_pnts_moving)
         self.image_view.img_stacks.image_dict['tri_pnts'].mouseClicked.connect(self.hist_window_tri_pnts_clicked)
+        self.image_view.img_stacks.image_dict['tri_pnts'].mouseReleased.connect(self.hist_window_tri_pnts_released)
         self.image_view.img_stacks.image_dict['lasso_path'].sigPointsClicked.connect(self.lasso_points_clicked)
         self.image_view.img_stacks.image_dict['ruler_path'].sigPointsClicked.connect(self.img_ruler_points_clicked)
         # self.image_view.img_stacks.image_dict['img-cells'].sigClicked.connect(self.img_cell_pnts_clicked)
@@ -283,9 +305,12 @@ class HERBS(QMainWindow, FORM_Main):
         self.atlas_view.label_tree.label_color_changed.connect(self.sig_label_color_changed)
         self.atlas_view.label_tree.reset_labels.connect(self.sig_reset_labels)
         # hovered
-        self.atlas_view.cimg.sig_mouse_hovered.connect(self.coronal_slice_stacks_hovered)
-        self.atlas_view.simg.sig_mouse_hovered.connect(self.sagital_slice_stacks_hovered)
-        self.atlas_view.himg.sig_mouse_hovered.connect(self.horizontal_slice_stacks_hovered)
+        self.atlas_view.cimg.sig_mouse_hovered.connect(
+            lambda pos: self.queue_hover(self.coronal_slice_stacks_hovered, pos))
+        self.atlas_view.simg.sig_mouse_hovered.connect(
+            lambda pos: self.queue_hover(self.sagital_slice_stacks_hovered, pos))
+        self.atlas_view.himg.sig_mouse_hovered.connect(
+            lambda pos: self.queue_hover(self.horizontal_slice_stacks_hovered, pos))
         # clicked
         self.atlas_view.cimg.sig_mouse_clicked.connect(self.atlas_stacks_clicked)
         self.atlas_view.simg.sig_mouse_clicked.connect(self.atlas_stacks_clicked)
@@ -297,10 +322,13 @@ class HERBS(QMainWindow, FORM_Main):
         # triangle points moving and clicked
         self.atlas_view.cimg.image_dict['tri_pnts'].mouseDragged.connect(self.atlas_window_tri_pnts_moving)
         self.atlas_view.cimg.image_dict['tri_pnts'].mouseClicked.connect(self.atlas_window_tri_pnts_clicked)
+        self.atlas_view.cimg.image_dict['tri_pnts'].mouseReleased.connect(self.atlas_window_tri_pnts_released)
         self.atlas_view.himg.image_dict['tri_pnts'].mouseDragged.connect(self.atlas_window_tri_pnts_moving)
         self.atlas_view.himg.image_dict['tri_pnts'].mouseClicked.connect(self.atlas_window_tri_pnts_clicked)
+        self.atlas_view.himg.image_dict['tri_pnts'].mouseReleased.connect(self.atlas_window_tri_pnts_released)
         self.atlas_view.simg.image_dict['tri_pnts'].mouseDragged.connect(self.atlas_window_tri_pnts_moving)
         self.atlas_view.simg.image_dict['tri_pnts'].mouseClicked.connect(self.atlas_window_tri_pnts_clicked)
+        self.atlas_view.simg.image_dict['tri_pnts'].mouseReleased.connect(self.atlas_window_tri_pnts_released)
         # probe clicked
         self.atlas_view.cimg.image_dict['atlas-probe'].sigClicked.connect(self.atlas_probe_pnts_clicked)
         self.atlas_view.simg.image_dict['atlas-probe'].sigClicked.connect(self.atlas_probe_pnts_clicked)
@@ -1032,32 +1060,31 @@ class HERBS(QMainWindow, FORM_Main):
             self.layer_action_after_matching.append({'action': 'rotate', 'val': rotating_val})
 
     def save_current_action(self, current_tool, layer_link, data, layer_tb):
-        if self.action_id != 0:
-            del_index = np.arange(len(self.action_list) + self.action_id, len(self.action_list))[::-1]
-            for da_ind in del_index:
-                del self.action_list[da_ind]
-            self.action_id = 0
-        current_action = {'tool': current_tool, 'link': layer_link, 'data': data, 'layer': layer_tb}
-        self.action_list.append(current_action)
-        if len(self.action_list) > 6:
-            del self.action_list[0]
+        self.action_history.save(current_tool, layer_link, data, layer_tb)
+
+    def get_action_data(self, layer_link):
+        # current data of a layer, the undo history patches raster layers in place
+        if layer_link == 'img-process':
+            return {'data': self.image_view.processing_img}
+        if layer_link in ['img-mask', 'img-virus']:
+            return {'data': self.working_img_data[layer_link]}
+        if layer_link.startswith('atlas') and layer_link in self.working_atlas_data:
+            return {'data': self.working_atlas_data[layer_link]}
+        return {}
 
     def redo_called(self):
-        self.action_id += 1
-        if self.action_id > 0:
-            self.action_id -= 1
+        layer_link = self.action_history.get_redo_link()
+        if layer_link is None:
             return
-        self.set_undo_redo_data()
+        self.set_undo_redo_data(self.action_history.redo(self.get_action_data(layer_link)))
 
     def undo_called(self):
-        self.action_id -= 1
-        if abs(self.action_id) >= len(self.action_list):
-            self.action_id += 1
+        layer_link = self.action_history.get_undo_link()
+        if layer_link is None:
             return
-        self.set_undo_redo_data()
+        self.set_undo_redo_data(self.action_history.undo(self.get_action_data(layer_link)))
 
-    def set_undo_redo_data(self):
-        current_action = self.action_list[self.action_id - 1]
+    def set_undo_redo_data(self, current_action):
         current_data = current_action['data']
         layer_link = current_action['link']
         current_tool = current_action['tool']
@@ -1108,6 +1135,8 @@ class HERBS(QMainWindow, FORM_Main):
                 print('others')
         else:
             return
+        if da_layer is None:
+            return
         da_index = np.where(np.ravel(self.layer_ctrl.layer_link) == layer_link)[0][0]
         self.layer_ctrl.layer_list[da_index].set_thumbnail_data(da_layer)
 
@@ -1131,9 +1160,10 @@ class HERBS(QMainWindow, FORM_Main):
         if self.image_view.image_file is None:
             self.print_message('No histological image file is loaded.', self.error_message_color)
             return
-        self.image_view.processing_img = self.image_view.current_img.copy()
+        # shares the pixels of the current image until a tool changes them
+        self.image_view.processing_img = self.image_view.current_img
         if self.image_view.image_file.pixel_type == 'rgb24':
-            input_img = self.image_view.current_img.copy()
+            input_img = self.image_view.current_img
         else:
             channel_hsv = self.image_view.image_file.hsv_colors
             img_temp = merge_channels_into_single_img(self.image_view.processing_img, channel_hsv)
@@ -1155,8 +1185,7 @@ class HERBS(QMainWindow, FORM_Main):
         self.layer_ctrl.delete_layer(remove_index)
         self.reset_corners_hist()
         self.print_message('Processing image is deleted.', self.normal_color)
-        self.action_list = []
-        self.action_id = 0
+        self.action_history.clear()
 
     def cut_image(self):
         if self.image_view.image_file is None:
@@ -1164,14 +1193,14 @@ class HERBS(QMainWindow, FORM_Main):
             return
         if self.img_lasso_is_closure:
             cut_rect = cv2.boundingRect(np.asarray(self.working_img_data['lasso_path']).astype('int'))
-            temp = self.image_view.current_img.copy()
-            self.image_view.processing_img = temp[cut_rect[1]:(cut_rect[1] + cut_rect[3]), cut_rect[0]:(cut_rect[0] + cut_rect[2])]
+            self.image_view.processing_img = self.image_view.current_img[
+                cut_rect[1]:(cut_rect[1] + cut_rect[3]), cut_rect[0]:(cut_rect[0] + cut_rect[2])]
             for i in range(self.image_view.image_file.n_channels):
                 self.image_view.img_stacks.image_list[i].clear()
             self.image_view.set_data_and_size(self.image_view.processing_img)
             self.reset_corners_hist()
             if self.image_view.image_file.pixel_type == 'rgb24':
-                input_img = self.image_view.processing_img.copy()
+                input_img = self.image_view.processing_img
             else:
                 channel_hsv = self.image_view.image_file.hsv_colors
                 img_temp = merge_channels_into_single_img(self.image_view.processing_img, channel_hsv)
@@ -1180,8 +1209,7 @@ class HERBS(QMainWindow, FORM_Main):
             res = cv2.resize(temp, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
             self.layer_ctrl.master_layers(res, layer_type='img-process', color=[])
             self.inactive_lasso()
-            self.action_list = []
-            self.action_id = 0
+            self.action_history.clear()
 
     # ------------------------------------------------------------------
     #
@@ -1203,11 +1231,10 @@ class HERBS(QMainWindow, FORM_Main):
         segmentation_data = np.transpose(wax.worker.segmentation_data, [2, 0, 1])[::-1, :, :]
         unique_label = wax.worker.unique_label
 
-        s_boundary = np.transpose(wax.worker.boundary['s_contour'], [2, 0, 1])[::-1, :, :]
-        c_boundary = np.transpose(wax.worker.boundary['c_contour'], [2, 0, 1])[::-1, :, :]
-        h_boundary = np.transpose(wax.worker.boundary['h_contour'], [2, 0, 1])[::-1, :, :]
-
-        boundary = {'s_contour': s_boundary, 'c_contour': c_boundary, 'h_contour': h_boundary}
+        # missing contour volumes are computed per slice by the atlas view
+        boundary = {}
+        for da_key in wax.worker.boundary.keys():
+            boundary[da_key] = np.transpose(wax.worker.boundary[da_key], [2, 0, 1])[::-1, :, :]
 
         self.set_volume_atlas_to_view(atlas_data, segmentation_data, atlas_info, label_info, boundary)
         self.set_volume_atlas_3d(unique_label, wax.worker.mesh_data, wax.worker.small_mesh_list)
@@ -1229,11 +1256,10 @@ class HERBS(QMainWindow, FORM_Main):
         segmentation_data = np.transpose(aln.worker.segmentation_data, [2, 0, 1])[::-1, :, :]
         unique_label = aln.worker.unique_label
 
-        s_boundary = np.transpose(aln.worker.boundary['s_contour'], [2, 0, 1])[::-1, :, :]
-        c_boundary = np.transpose(aln.worker.boundary['c_contour'], [2, 0, 1])[::-1, :, :]
-        h_boundary = np.transpose(aln.worker.boundary['h_contour'], [2, 0, 1])[::-1, :, :]
-
-        boundary = {'s_contour': s_boundary, 'c_contour': c_boundary, 'h_contour': h_boundary}
+        # missing contour volumes are computed per slice by the atlas view
+        boundary = {}
+        for da_key in aln.worker.boundary.keys():
+            boundary[da_key] = np.transpose(aln.worker.boundary[da_key], [2, 0, 1])[::-1, :, :]
 
         self.set_volume_atlas_to_view(atlas_data, segmentation_data, atlas_info, label_info, boundary)
         self.set_volume_atlas_3d(unique_label, aln.worker.mesh_data, aln.worker.small_mesh_list)
@@ -2152,7 +2178,7 @@ class HERBS(QMainWindow, FORM_Main):
         params.filterByInertia = True
         params.minInertiaRatio = 0.01
 
-        temp = self.image_view.current_img.copy()
+        temp = self.image_view.current_img
         if self.image_view.image_file.is_rgb:
             if self.image_view.current_mode == 'rgb':
                 temp = cv2.cvtColor(temp, cv2.COLOR_RGB2GRAY)
@@ -2334,14 +2360,8 @@ class HERBS(QMainWindow, FORM_Main):
             self.image_view.img_stacks.tri_lines_list = []
 
     def update_histo_tri_lines(self):
-        self.remove_histo_tri_lines()
         histo_tri_lines = get_tri_lines(self.histo_rect, self.histo_tri_data)
-        for el in histo_tri_lines:
-            pt1 = [el[0], el[1]]
-            pt2 = [el[2], el[3]]
-            self.image_view.img_stacks.tri_lines_list.append(pg.PlotDataItem(pen=self.tool_box.tri_line_style))
-            self.image_view.img_stacks.tri_lines_list[-1].setData(np.asarray([pt1, pt2]))
-            self.image_view.img_stacks.vb.addItem(self.image_view.img_stacks.tri_lines_list[-1])
+        self.set_tri_lines_data(self.image_view.img_stacks, histo_tri_lines)
 
     def remove_atlas_tri_lines(self):
         if self.atlas_view.working_atlas.tri_lines_list:
@@ -2350,16 +2370,18 @@ class HERBS(QMainWindow, FORM_Main):
             self.atlas_view.working_atlas.tri_lines_list = []
 
     def update_atlas_tri_lines(self):
-        self.remove_atlas_tri_lines()
         point_data = self.atlas_view.working_atlas.image_dict['tri_pnts'].data['pos'].copy()
         point_data = list(point_data)
         atlas_tri_lines = get_tri_lines(self.atlas_rect, point_data)
-        for el in atlas_tri_lines:
-            pt1 = [el[0], el[1]]
-            pt2 = [el[2], el[3]]
-            self.atlas_view.working_atlas.tri_lines_list.append(pg.PlotDataItem(pen=self.tool_box.tri_line_style))
-            self.atlas_view.working_atlas.tri_lines_list[-1].setData(np.asarray([pt1, pt2]))
-            self.atlas_view.working_atlas.vb.addItem(self.atlas_view.working_atlas.tri_lines_list[-1])
+        self.set_tri_lines_data(self.atlas_view.working_atlas, atlas_tri_lines)
+
+    def set_tri_lines_data(self, stack, tri_lines):
+        # all edges live in one item drawn as separate segments, moving a point only replaces its data
+        line_data = np.reshape(np.asarray(tri_lines, float), (-1, 2))
+        if not stack.tri_lines_list:
+            stack.tri_lines_list.append(pg.PlotDataItem(pen=self.tool_box.tri_line_style, connect='pairs'))
+            stack.vb.addItem(stack.tri_lines_list[-1])
+        stack.tri_lines_list[0].setData(line_data, connect='pairs')
 
     def vis_tri_lines_btn_clicked(self):
         if self.tool_box.triang_vis_btn.isChecked():
@@ -2477,13 +2499,8 @@ class HERBS(QMainWindow, FORM_Main):
                     subdiv.insert(p)
 
                 tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
-                for i in range(len(tri_vet_inds)):
-                    da_inds = tri_vet_inds[i]
-                    t1 = [self.atlas_tri_data[da_inds[0]], self.atlas_tri_data[da_inds[1]], self.atlas_tri_data[da_inds[2]]]
-                    t2 = [self.histo_tri_data[da_inds[0]], self.histo_tri_data[da_inds[1]], self.histo_tri_data[da_inds[2]]]
-                    t1 = np.reshape(t1, (3, 2))
-                    t2 = np.reshape(t2, (3, 2))
-                    warp_triangle(input_img, img_wrap, t1, t2, True)
+                warp_image_by_triangles(input_img, self.atlas_tri_data, self.histo_tri_data, tri_vet_inds,
+                                        self.image_view.img_size, out=img_wrap)
                 self.project_method = 'match to hist'
                 self.register_method = 2
             else:
@@ -2537,19 +2554,18 @@ class HERBS(QMainWindow, FORM_Main):
         self.print_message('Transfer histological image to atlas window.', self.normal_color)
         if not self.h2a_transferred:
             if self.image_view.processing_img is not None:
-                input_img = self.image_view.processing_img.copy()
+                input_img = self.image_view.processing_img
             else:
-                input_img = self.image_view.current_img.copy()
+                input_img = self.image_view.current_img
 
             if self.image_view.image_file.pixel_type == 'rgb24':
-                self.overlay_img = input_img.copy()
+                self.overlay_img = input_img
             else:
-                czi_img = input_img.copy()
                 channel_hsv = self.image_view.image_file.hsv_colors
-                img_temp = merge_channels_into_single_img(czi_img, channel_hsv)
+                img_temp = merge_channels_into_single_img(input_img, channel_hsv)
                 self.overlay_img = cv2.normalize(img_temp, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
-            working_img = self.overlay_img.copy()
+            working_img = self.overlay_img
 
             img_wrap = np.zeros((self.atlas_view.slice_size[0], self.atlas_view.slice_size[1], 3), np.float32)
 
@@ -2564,16 +2580,8 @@ class HERBS(QMainWindow, FORM_Main):
                     subdiv.insert((int(p[0]), int(p[1])))
 
                 tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
-
-                for i in range(len(tri_vet_inds)):
-                    da_inds = tri_vet_inds[i]
-                    t2 = [self.atlas_tri_data[da_inds[0]], self.atlas_tri_data[da_inds[1]],
-                          self.atlas_tri_data[da_inds[2]]]
-                    t1 = [self.histo_tri_data[da_inds[0]], self.histo_tri_data[da_inds[1]],
-                          self.histo_tri_data[da_inds[2]]]
-                    t1 = np.reshape(t1, (3, 2))
-                    t2 = np.reshape(t2, (3, 2))
-                    warp_triangle(working_img, img_wrap, t1, t2, True)
+                warp_image_by_triangles(working_img, self.histo_tri_data, self.atlas_tri_data, tri_vet_inds,
+                                        self.atlas_view.slice_size, out=img_wrap)
             else:
                 if self.small_atlas_rect is not None:
                     atlas_rect = self.small_atlas_rect
@@ -2616,34 +2624,18 @@ class HERBS(QMainWindow, FORM_Main):
     # ---------------------------
     #          Accept
     # ---------------------------
-    def transfer_pnt(self, pnt, tri_vet_inds):
-        res_pnts = np.zeros((len(pnt), 2))
-        res_pnts[:] = np.nan
-        loc = get_pnts_triangle_ind(tri_vet_inds, self.histo_tri_data, self.image_view.img_size, pnt)
-        loc = np.ravel(loc)
-        if np.any(np.isnan(loc)):
+    def transfer_pnt(self, pnt, tri_locator):
+        res_pnts = tri_locator.transfer(pnt, self.atlas_tri_data)
+        if np.any(np.isnan(res_pnts[:, 0])):
             msg = 'Some of the selected points are out of triangles, the points are deleted.'
             self.print_message(msg, self.reminder_color)
-        for i in range(len(tri_vet_inds)):
-            da_inds = tri_vet_inds[i]
-            t2 = [self.atlas_tri_data[da_inds[0]], self.atlas_tri_data[da_inds[1]],
-                  self.atlas_tri_data[da_inds[2]]]
-            t1 = [self.histo_tri_data[da_inds[0]], self.histo_tri_data[da_inds[1]],
-                  self.histo_tri_data[da_inds[2]]]
-            t1 = np.reshape(t1, (3, 2))
-            t2 = np.reshape(t2, (3, 2))
-            inds = np.where(loc == i)
-            if len(inds) > 0:
-                pnts_inside = pnt[inds[0]]
-                res = warp_points(pnts_inside, t1, t2)
-                res_pnts[inds[0]] = res
         res_pnts = res_pnts[~np.isnan(res_pnts[:, 0])]
         return res_pnts
 
-    def transfer_vox_to_pnt(self, img_data, tri_vet_inds):
+    def transfer_vox_to_pnt(self, img_data, tri_locator):
         temp_pnts = np.where(img_data != 0)
         data = np.stack([temp_pnts[1], temp_pnts[0]], axis=1) + 0.5
-        res_pnts = self.transfer_pnt(data, tri_vet_inds)
+        res_pnts = self.transfer_pnt(data, tri_locator)
         return res_pnts
 
     def transform_accept(self):
@@ -2658,10 +2650,12 @@ class HERBS(QMainWindow, FORM_Main):
             subdiv.insert((int(p[0]), int(p[1])))
 
         tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
+        # one point location index for all object types
+        tri_locator = TriangleLocator(self.histo_tri_data, tri_vet_inds, self.image_view.img_size)
 
         if self.working_img_data['img-contour']:
             self.print_message('Transferring contour...', self.normal_color)
-            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-contour']), tri_vet_inds)
+            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-contour']), tri_locator)
             self.working_atlas_data['atlas-contour'] = res_pnts.tolist()
             self.atlas_view.working_atlas.image_dict['atlas-contour'].setData(
                 np.asarray(self.working_atlas_data['atlas-contour']))
@@ -2672,7 +2666,7 @@ class HERBS(QMainWindow, FORM_Main):
             self.print_message('Contour transferred.', self.normal_color)
 
         if self.working_img_data['img-probe']:
-            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-probe']), tri_vet_inds)
+            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-probe']), tri_locator)
             self.working_atlas_data['atlas-probe'] = res_pnts.tolist()
             self.atlas_view.working_atlas.image_dict['atlas-probe'].setData(
                 pos=np.asarray(self.working_atlas_data['atlas-probe']))
@@ -2683,7 +2677,7 @@ class HERBS(QMainWindow, FORM_Main):
             self.print_message('Probe transferred.', self.normal_color)
 
         if self.working_img_data['img-drawing']:
-            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-drawing']), tri_vet_inds)
+            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-drawing']), tri_locator)
             self.working_atlas_data['atlas-drawing'] = res_pnts.tolist()
             if self.tool_box.is_closed:
                 self.set_atlas_pencil_closed_style()
@@ -2699,7 +2693,7 @@ class HERBS(QMainWindow, FORM_Main):
             self.print_message('Drawing transferred.', self.normal_color)
 
         if self.working_img_data['img-cells']:
-            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-cells']), tri_vet_inds)
+            res_pnts = self.transfer_pnt(np.asarray(self.working_img_data['img-cells']), tri_locator)
             self.working_atlas_data['atlas-cells'] = res_pnts.tolist()
             self.working_atlas_data['cell_count'] = self.working_img_data['cell_count'].copy()
             self.working_atlas_data['cell_size'] = self.working_img_data['cell_size'].copy()
@@ -2716,16 +2710,8 @@ class HERBS(QMainWindow, FORM_Main):
         if self.working_img_data['img-virus'] is not None:
             input_virus_img = self.working_img_data['img-virus'].copy()
             img_wrap = np.zeros((self.atlas_view.slice_size[0], self.atlas_view.slice_size[1]), np.float32)
-
-            for i in range(len(tri_vet_inds)):
-                da_inds = tri_vet_inds[i]
-                t2 = [self.atlas_tri_data[da_inds[0]], self.atlas_tri_data[da_inds[1]],
-                      self.atlas_tri_data[da_inds[2]]]
-                t1 = [self.histo_tri_data[da_inds[0]], self.histo_tri_data[da_inds[1]],
-                      self.histo_tri_data[da_inds[2]]]
-                t1 = np.reshape(t1, (3, 2))
-                t2 = np.reshape(t2, (3, 2))
-                warp_triangle(input_virus_img, img_wrap, t1, t2, False)
+            warp_image_by_triangles(input_virus_img, self.histo_tri_data, self.atlas_tri_data, tri_vet_inds,
+                                    self.atlas_view.slice_size, out=img_wrap)
 
             temp_pnts = np.where(img_wrap != 0)
             res_pnts = np.stack([temp_pnts[1], temp_pnts[0]], axis=1) + 0.5
@@ -2756,14 +2742,12 @@ class HERBS(QMainWindow, FORM_Main):
         self.cell_img = np.zeros((self.image_view.img_size[0], self.image_view.img_size[1], 3))
         self.probe_img = np.zeros((self.image_view.img_size[0], self.image_view.img_size[1], 3))
         self.delete_all_atlas_layer()
-        self.action_list = []
-        self.action_id = 0
+        self.action_history.clear()
 
 
     def img_stacks_clicked(self, pos):
         x = pos[0]
         y = pos[1]
-        print(self.image_view.img_stacks.image_list[0].image[int(y), int(x)])
         if self.image_view.image_file is None:
             return
         # ------------------------- pencil
@@ -2835,10 +2819,10 @@ class HERBS(QMainWindow, FORM_Main):
                     res = cv2.resize(vis_img, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
                     self.layer_ctrl.layer_list[self.layer_ctrl.current_layer_index[0]].set_thumbnail_data(res)
                     # save action
-                    current_data = {'data': self.working_img_data[da_link].copy()}
+                    current_data = {'data': self.working_img_data[da_link]}
                     self.save_current_action('eraser_btn', da_link, current_data, res)
                 elif da_link == 'img-process':
-                    temp = self.image_view.processing_img.copy()
+                    temp = self.image_view.processing_img
                     dst = cv2.bitwise_and(temp, temp, mask=mask_img)
                     if self.image_view.image_file.pixel_type != 'rgb24':
                         channel_hsv = self.image_view.image_file.hsv_colors
@@ -2850,7 +2834,7 @@ class HERBS(QMainWindow, FORM_Main):
                     self.layer_ctrl.layer_list[self.layer_ctrl.current_layer_index[0]].set_thumbnail_data(res)
                     self.image_view.img_stacks.set_data(dst)
                     self.image_view.processing_img = dst
-                    current_data = {'data': self.image_view.processing_img.copy()}
+                    current_data = {'data': self.image_view.processing_img}
                     self.save_current_action('eraser_btn', da_link, current_data, res)
                 else:
                     if not self.working_img_data[da_link]:
@@ -2901,24 +2885,24 @@ class HERBS(QMainWindow, FORM_Main):
                         return
                     # save action
                     if da_link == 'img-cells':
-                        current_data = {'data': self.working_img_data[da_link].copy(),
+                        current_data = {'data': self.working_img_data[da_link],
                                         'size': self.working_img_data['cell_size'],
                                         'symbol': self.working_img_data['cell_symbol'],
                                         'index': self.working_img_data['cell_layer_index'],
                                         'count': self.working_img_data['cell_count']}
                     elif da_link == 'img-drawing':
-                        current_data = {'data': self.working_img_data[da_link].copy(),
+                        current_data = {'data': self.working_img_data[da_link],
                                         'closed': self.tool_box.is_closed}
                     else:
-                        current_data = {'data': self.working_img_data[da_link].copy()}
+                        current_data = {'data': self.working_img_data[da_link]}
                     self.save_current_action('eraser_btn', da_link, current_data, res)
         # ------------------------- magic wand
         elif self.tool_box.checkable_btn_dict['magic_wand_btn'].isChecked():
             tol_val = float(self.tool_box.magic_tol_val.text())
             if self.image_view.processing_img is None:
-                src_img = self.image_view.current_img.copy()
+                src_img = self.image_view.current_img
             else:
-                src_img = self.image_view.processing_img.copy()
+                src_img = self.image_view.processing_img
 
             # if self.image_view.image_file.is_rgb:
             #     da_color = src_img[int(y), int(x)]
@@ -2958,7 +2942,7 @@ class HERBS(QMainWindow, FORM_Main):
             res = cv2.resize(temp, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
             self.layer_ctrl.master_layers(res, layer_type='img-mask', color=self.magic_wand_lut[1])
             # save action
-            current_data = {'data': self.working_img_data['img-mask'].copy()}
+            current_data = {'data': self.working_img_data['img-mask']}
             self.save_current_action('magic_wand_btn', 'img-mask', current_data, res)
 
         # ------------------------- lasso
@@ -3055,13 +3039,45 @@ class HERBS(QMainWindow, FORM_Main):
         else:
             return
 
-    def img_stacks_hovered(self, event):
+    def queue_hover(self, hover_handler, pos):
+        self.hover_pending[hover_handler] = QPointF(pos)
+        if not self.hover_timer.isActive():
+            self.hover_timer.start()
+
+    def process_hover(self):
+        hover_pending = self.hover_pending
+        self.hover_pending = {}
+        for hover_handler, pos in hover_pending.items():
+            hover_handler(pos)
+
+    def queue_navigation(self, navigation):
+        """
+        :param navigation: list of (page control, page number), only the last list is applied when the mouse rests
+        """
+        self.navigation_pending = navigation
+        self.navigation_timer.start()
+
+    def process_navigation(self):
+        navigation = self.navigation_pending
+        self.navigation_pending = []
+        for page_ctrl, page_number in navigation:
+            page_ctrl.set_val(page_number)
+
+    def img_stacks_hover_received(self, event):
         if event.isExit():
             return
         try:
             pos = (event.pos())
         except (IndexError, AttributeError):
             return
+        # pencil strokes keep every mouse position, only drawing them is coalesced
+        if not self.tool_box.checkable_btn_dict['eraser_btn'].isChecked() and \
+                not self.tool_box.checkable_btn_dict['ruler_btn'].isChecked() and \
+                self.tool_box.checkable_btn_dict['pencil_btn'].isChecked() and self.is_pencil_allowed:
+            self.working_img_data['img-drawing'].append([pos.x(), pos.y()])
+        self.queue_hover(self.img_stacks_hovered, pos)
+
+    def img_stacks_hovered(self, pos):
         y = pos.y()
         x = pos.x()
         if self.tool_box.checkable_btn_dict['eraser_btn'].isChecked():
@@ -3086,7 +3102,6 @@ class HERBS(QMainWindow, FORM_Main):
         # ------------------------ pencil
         elif self.tool_box.checkable_btn_dict['pencil_btn'].isChecked():
             if self.is_pencil_allowed:
-                self.working_img_data['img-drawing'].append([x, y])
                 self.image_view.img_stacks.image_dict['img-drawing'].setData(
                     np.asarray(self.working_img_data['img-drawing']))
         msg = 'Histological image coordinates: {}, {}'.format(round(x, 3), round(y, 3))
@@ -3112,7 +3127,7 @@ class HERBS(QMainWindow, FORM_Main):
                     self.working_img_data[da_link] = dst
                     vis_img = color_vis_img(dst, self.layer_ctrl.layer_color[self.layer_ctrl.current_layer_index[0]])
                     res = cv2.resize(vis_img, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
-                    current_data = {'data': self.working_img_data[da_link].copy()}
+                    current_data = {'data': self.working_img_data[da_link]}
                     self.save_current_action('delete', da_link, current_data, res)
                 elif da_link == 'img-process':
                     dst = cv2.bitwise_and(self.image_view.processing_img, self.image_view.processing_img, mask=mask)
@@ -3125,7 +3140,7 @@ class HERBS(QMainWindow, FORM_Main):
                     else:
                         input_img = dst.copy()
                     res = cv2.resize(input_img, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
-                    current_data = {'data': self.image_view.processing_img.copy()}
+                    current_data = {'data': self.image_view.processing_img}
                     self.save_current_action('delete', da_link, current_data, res)
                 else:
                     msg = 'Lasso Tool only works on process layer, slice layer and mask layer.'
@@ -3136,9 +3151,9 @@ class HERBS(QMainWindow, FORM_Main):
                     return
                 mask = self.working_img_data['img-mask'].copy()
                 mask = 255 - mask * 255
-                temp = self.image_view.processing_img.copy()
+                temp = self.image_view.processing_img
                 dst = cv2.bitwise_and(temp, temp, mask=mask)
-                input_img = dst.copy()
+                input_img = dst
                 self.image_view.img_stacks.set_data(dst)
                 self.image_view.processing_img = dst
                 if self.image_view.image_file.pixel_type != 'rgb24':
@@ -3147,7 +3162,7 @@ class HERBS(QMainWindow, FORM_Main):
                     input_img = cv2.normalize(img_temp, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
                 res = cv2.resize(input_img, self.image_view.tb_size, interpolation=cv2.INTER_AREA)
                 self.remove_single_link_related('img-mask')
-                current_data = {'data': self.image_view.processing_img.copy()}
+                current_data = {'data': self.image_view.processing_img}
                 self.save_current_action('delete', da_link, current_data, res)
 
             self.layer_ctrl.layer_list[self.layer_ctrl.current_layer_index[0]].set_thumbnail_data(res)
@@ -3159,42 +3174,37 @@ class HERBS(QMainWindow, FORM_Main):
         if ind < da_num:
             return
 
+        da_new_pnt = self.image_view.img_stacks.image_dict['tri_pnts'].data['pos'][ind].copy()
         if self.a2h_transferred:
-            old_pnts = self.histo_tri_data.copy()
             new_pnts = self.histo_tri_data.copy()
-            da_new_pnt = self.image_view.img_stacks.image_dict['tri_pnts'].data['pos'][ind].copy()
             new_pnts[ind] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
-
-            img_overlay = self.image_view.img_stacks.image_dict['img-overlay'].image.copy()
-            img_wrap = img_overlay.copy()
-
-            img_size = img_wrap.shape[:2]
-            rect = (0, 0, img_size[1], img_size[0])
-
-            subdiv = cv2.Subdiv2D(rect)
-            for p in new_pnts:
-                subdiv.insert(p)
-
-            tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
-            for i in range(len(tri_vet_inds)):
-                da_inds = tri_vet_inds[i]
-                # if ind not in da_inds:
-                #     continue
-                t1 = [old_pnts[da_inds[0]], old_pnts[da_inds[1]], old_pnts[da_inds[2]]]
-                t2 = [new_pnts[da_inds[0]], new_pnts[da_inds[1]], new_pnts[da_inds[2]]]
-                t1 = np.reshape(t1, (3, 2))
-                t2 = np.reshape(t2, (3, 2))
-                warp_triangle(img_overlay, img_wrap,  t1, t2, True)
-            self.image_view.img_stacks.image_dict['img-overlay'].setImage(img_wrap)
+            if self.histo_drag_warp is None:
+                self.histo_drag_warp = TriangleDragWarp(self.overlay_img, self.atlas_tri_data, self.histo_tri_data,
+                                                        self.working_img_data['img-overlay'], self.histo_rect)
+            preview_img = self.histo_drag_warp.move(new_pnts)
+            self.set_drag_warp_image(self.image_view.img_stacks.image_dict['img-overlay'], preview_img,
+                                     self.image_view.img_size)
             self.histo_tri_data = new_pnts
         else:
-            da_new_pnt = self.image_view.img_stacks.image_dict['tri_pnts'].data['pos'][ind].copy()
             self.histo_tri_data[ind] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
         self.histo_tri_inside_data[ind - da_num] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
         self.working_img_text[ind - da_num].setPos(da_new_pnt[0], da_new_pnt[1])
         if self.tool_box.triang_vis_btn.isChecked():
             self.update_histo_tri_lines()
 
+    def hist_window_tri_pnts_released(self, ev_obj):
+        if self.histo_drag_warp is None:
+            return
+        img_wrap = self.histo_drag_warp.finish()
+        self.histo_drag_warp = None
+        self.set_drag_warp_image(self.image_view.img_stacks.image_dict['img-overlay'], img_wrap,
+                                 self.image_view.img_size)
+
+    def set_drag_warp_image(self, image_item, img, full_size):
+        # the preview image has a lower resolution while dragging, stretch it over the full image
+        image_item.setImage(img)
+        image_item.setRect(QRectF(0, 0, full_size[1], full_size[0]))
+
     def img_probe_pnts_clicked(self, points, ev):
         if not self.tool_box.checkable_btn_dict['eraser_btn'].isChecked() or not self.working_img_data['img-probe']:
             return
@@ -3311,17 +3321,15 @@ class HERBS(QMainWindow, FORM_Main):
         if self.atlas_view.coronal_rotated:
             da_pnt = np.dot(self.atlas_view.c_rotm_2d, (da_pnt - o_rot)) + o_rot
 
-        da_label = self.atlas_view.cimg.label_img.image.copy()
-        da_id = da_label[int(y), int(x)]
+        da_id = self.atlas_view.cimg.label_img.image[int(y), int(x)]
 
         vox_val = self.atlas_view.cimg.img.image[int(y), int(x)]
 
         if vox_val != 0:
             coords = np.round((da_pnt - np.ravel(self.atlas_view.Bregma)) * self.atlas_view.vox_size_um, 2)
-            da_vec = self.atlas_view.cimg.img.image[:, int(da_pnt[1])]
-            valid_inds = np.where(da_vec != 0)[0]
-            # self.atlas_view.cimg.image_dict['atlas-probe'].setData(pos=[[x, valid_inds[0]]])
-            dv_val = np.round((valid_inds[0] - da_pnt[0]) * self.atlas_view.vox_size_um, 2)
+            surface_ind = self.atlas_view.get_surface_top(da_pnt)
+            # self.atlas_view.cimg.image_dict['atlas-probe'].setData(pos=[[x, surface_ind]])
+            dv_val = np.round((surface_ind - da_pnt[0]) * self.atlas_view.vox_size_um, 2)
             pstr = 'Atlas voxel:({}, {}, {}), ML:{}um, AP:{}um, DV:{}um w.r.t Bregma, DV:{}um w.r.t Surface: {} '.format(
                 int(da_pnt[1]), int(da_pnt[2]), int(self.atlas_view.atlas_size[0] - da_pnt[0]),
                 coords[1], coords[2], -coords[0], dv_val, self.atlas_view.label_tree.describe(da_id))
@@ -3335,8 +3343,8 @@ class HERBS(QMainWindow, FORM_Main):
                 self.atlas_view.himg.v_line.setPos(c_id)
                 self.atlas_view.himg.h_line.setPos(x)
 
-                self.atlas_view.spage_ctrl.set_val(x)
-                self.atlas_view.hpage_ctrl.set_val(self.atlas_view.atlas_size[0] - int(y))
+                self.queue_navigation([(self.atlas_view.spage_ctrl, x),
+                                       (self.atlas_view.hpage_ctrl, self.atlas_view.atlas_size[0] - int(y))])
         else:
             self.print_message('', self.normal_color)
 
@@ -3370,17 +3378,15 @@ class HERBS(QMainWindow, FORM_Main):
         if self.atlas_view.sagital_rotated:
             da_pnt = o_rot + np.dot(self.atlas_view.s_rotm_2d, (da_pnt - o_rot))
 
-        da_label = self.atlas_view.simg.label_img.image.copy()
-        da_id = da_label[int(y), int(x)]
+        da_id = self.atlas_view.simg.label_img.image[int(y), int(x)]
 
         vox_val = self.atlas_view.simg.img.image[int(y), int(x)]
 
         if vox_val != 0:
             coords = np.round((da_pnt - np.ravel(self.atlas_view.Bregma)) * self.atlas_view.vox_size_um, 2)
-            da_vec = self.atlas_view.simg.img.image[:, int(da_pnt[2])]
-            valid_inds = np.where(da_vec != 0)[0]
-            # self.atlas_view.simg.image_dict['atlas-probe'].setData(pos=[[x, valid_inds[0]]])
-            dv_val = np.round((valid_inds[0] - da_pnt[0]) * self.atlas_view.vox_size_um, 2)
+            surface_ind = self.atlas_view.get_surface_top(da_pnt)
+            # self.atlas_view.simg.image_dict['atlas-probe'].setData(pos=[[x, surface_ind]])
+            dv_val = np.round((surface_ind - da_pnt[0]) * self.atlas_view.vox_size_um, 2)
             pstr = 'Atlas voxel:({}, {}, {}), ML:{}um, AP:{}um, DV:{}um w.r.t Bregma, DV:{}um w.r.t Surface: {} '.format(
                 int(da_pnt[1]), int(da_pnt[2]), int(self.atlas_view.atlas_size[0] - da_pnt[0]),
                 coords[1], coords[2], -coords[0], dv_val, self.atlas_view.label_tree.describe(da_id))
@@ -3394,8 +3400,8 @@ class HERBS(QMainWindow, FORM_Main):
                 self.atlas_view.himg.v_line.setPos(x)
                 self.atlas_view.himg.h_line.setPos(s_id)
 
-                self.atlas_view.cpage_ctrl.set_val(x)
-                self.atlas_view.hpage_ctrl.set_val(self.atlas_view.atlas_size[0] - int(y))
+                self.queue_navigation([(self.atlas_view.cpage_ctrl, x),
+                                       (self.atlas_view.hpage_ctrl, self.atlas_view.atlas_size[0] - int(y))])
         else:
             self.print_message('', self.normal_color)
 
@@ -3429,18 +3435,16 @@ class HERBS(QMainWindow, FORM_Main):
         if self.atlas_view.horizontal_rotated:
             da_pnt = o_rot + np.dot(self.atlas_view.h_rotm_2d, (da_pnt - o_rot))
 
-        da_label = self.atlas_view.himg.label_img.image.copy()
-        da_id = da_label[int(y), int(x)]
+        da_id = self.atlas_view.himg.label_img.image[int(y), int(x)]
 
         vox_val = self.atlas_view.himg.img.image[int(y), int(x)]
 
         if vox_val != 0:
             coords = np.round((da_pnt - np.ravel(self.atlas_view.Bregma)) * self.atlas_view.vox_size_um, 2)
-            da_vec = self.atlas_view.atlas_data[:, int(da_pnt[1]), int(da_pnt[2])]
-            valid_inds = np.where(da_vec != 0)[0]
-            # self.atlas_view.cimg.image_dict['atlas-probe'].setData(pos=[[int(y), valid_inds[0]]])
-            # self.atlas_view.simg.image_dict['atlas-probe'].setData(pos=[[int(x), valid_inds[0]]])
-            dv_val = np.round((valid_inds[0] - h_id) * self.atlas_view.vox_size_um, 2)
+            surface_ind = self.atlas_view.get_surface_top(da_pnt)
+            # self.atlas_view.cimg.image_dict['atlas-probe'].setData(pos=[[int(y), surface_ind]])
+            # self.atlas_view.simg.image_dict['atlas-probe'].setData(pos=[[int(x), surface_ind]])
+            dv_val = np.round((surface_ind - h_id) * self.atlas_view.vox_size_um, 2)
             pstr = 'Atlas voxel:({}, {}, {}), ML:{}um, AP:{}um, DV:{}um w.r.t. Bregma, DV:{}um w.r.t Surface: {} '.format(
                 int(da_pnt[1]), int(da_pnt[2]), int(self.atlas_view.atlas_size[0] - da_pnt[0]),
                 coords[1], coords[2], -coords[0], dv_val, self.atlas_view.label_tree.describe(da_id))
@@ -3454,8 +3458,7 @@ class HERBS(QMainWindow, FORM_Main):
                 self.atlas_view.simg.v_line.setPos(x)
                 self.atlas_view.simg.h_line.setPos(h_id)
 
-                self.atlas_view.cpage_ctrl.set_val(int(x))
-                self.atlas_view.spage_ctrl.set_val(int(y))
+                self.queue_navigation([(self.atlas_view.cpage_ctrl, int(x)), (self.atlas_view.spage_ctrl, int(y))])
         else:
             self.print_message('', self.normal_color)
 
@@ -3536,7 +3539,7 @@ class HERBS(QMainWindow, FORM_Main):
                 else:
                     return
             self.layer_ctrl.layer_list[self.layer_ctrl.current_layer_index[0]].set_thumbnail_data(res)
-            current_data = {'data': self.working_atlas_data[da_link].copy()}
+            current_data = {'data': self.working_atlas_data[da_link]}
             self.save_current_action('eraser_btn', da_link, current_data, res)
         # ------------------------- lasso
         elif self.tool_box.checkable_btn_dict['lasso_btn'].isChecked():
@@ -3626,7 +3629,7 @@ class HERBS(QMainWindow, FORM_Main):
             res = cv2.resize(self.working_atlas_data['atlas-mask'],
                              self.atlas_view.slice_tb_size, interpolation=cv2.INTER_AREA)
             self.layer_ctrl.master_layers(res, layer_type='atlas-mask', color=self.magic_wand_lut[1])
-            current_data = {'data': self.working_atlas_data['atlas-mask'].copy()}
+            current_data = {'data': self.working_atlas_data['atlas-mask']}
             self.save_current_action('magic_wand_btn', 'atlas-mask', current_data, res)
         # ------------------------- bregma picker
         elif self.actionBregma_Picker.isChecked():
@@ -3676,7 +3679,7 @@ class HERBS(QMainWindow, FORM_Main):
                 self.atlas_view.processing_slice = dst
                 res = cv2.resize(dst, self.atlas_view.slice_tb_size, interpolation=cv2.INTER_AREA)
             self.layer_ctrl.layer_list[self.layer_ctrl.current_layer_index[0]].set_thumbnail_data(res)
-            current_data = {'data': self.working_atlas_data[da_link].copy()}
+            current_data = {'data': self.working_atlas_data[da_link]}
             self.save_current_action('delete', da_link, current_data, res)
         else:
             return
@@ -3688,66 +3691,32 @@ class HERBS(QMainWindow, FORM_Main):
         da_num = (self.np_onside - 1) * 4
         if ind < da_num:
             return
+        da_new_pnt = self.atlas_view.working_atlas.image_dict['tri_pnts'].data['pos'][ind].copy()
         if self.h2a_transferred:
-            old_pnts = self.atlas_tri_data.copy()
-            new_pnts = self.atlas_tri_data.copy()
-            da_new_pnt = self.atlas_view.working_atlas.image_dict['tri_pnts'].data['pos'][ind].copy()
+            new_pnts = list(self.atlas_tri_data)
             new_pnts[ind] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
-            print(self.atlas_tri_data[ind])
-            print(da_new_pnt)
-
-
-            input_img = self.overlay_img.copy()
-            img_wrap = np.zeros((self.atlas_view.slice_size[0], self.atlas_view.slice_size[1], input_img.shape[2]),
-                                np.float32)
-
-            subdiv = cv2.Subdiv2D(self.atlas_rect)
-            for p in self.atlas_tri_data:
-                subdiv.insert(p)
-
-            tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
-            for i in range(len(tri_vet_inds)):
-                da_inds = tri_vet_inds[i]
-                t1 = [self.atlas_tri_data[da_inds[0]], self.atlas_tri_data[da_inds[1]],
-                      self.atlas_tri_data[da_inds[2]]]
-                t2 = [new_pnts[da_inds[0]], new_pnts[da_inds[1]],
-                      new_pnts[da_inds[2]]]
-                t1 = np.reshape(t1, (3, 2))
-                t2 = np.reshape(t2, (3, 2))
-                warp_triangle(input_img, img_wrap, t1, t2, True)
-
-            #
-
-            # # img_overlay = self.atlas_view.working_atlas.overlay_img.image.copy()
-            # img_wrap = img_overlay.copy()
-            #
-            # img_size = img_wrap.shape[:2]
-            # rect = (0, 0, img_size[1], img_size[0])
-            #
-            # subdiv = cv2.Subdiv2D(rect)
-            # for p in new_pnts:
-            #     subdiv.insert(p)
-            #
-            # tri_vet_inds = get_vertex_ind_in_triangle(subdiv)
-            # for i in range(len(tri_vet_inds)):
-            #     da_inds = tri_vet_inds[i]
-            #     if ind not in da_inds:
-            #         continue
-            #     t1 = [old_pnts[da_inds[0]], old_pnts[da_inds[1]], old_pnts[da_inds[2]]]
-            #     t2 = [new_pnts[da_inds[0]], new_pnts[da_inds[1]], new_pnts[da_inds[2]]]
-            #     t1 = np.reshape(t1, (3, 2))
-            #     t2 = np.reshape(t2, (3, 2))
-            #     warp_triangle(img_overlay, img_wrap,  t1, t2, True)
-            self.atlas_view.working_atlas.image_dict['atlas-overlay'].setImage(img_wrap)
-            # self.atlas_tri_data = new_pnts
+            if self.atlas_drag_warp is None:
+                self.atlas_drag_warp = TriangleDragWarp(self.overlay_img, self.histo_tri_data, self.atlas_tri_data,
+                                                        self.working_atlas_data['atlas-overlay'], self.atlas_rect)
+            preview_img = self.atlas_drag_warp.move(new_pnts)
+            self.set_drag_warp_image(self.atlas_view.working_atlas.image_dict['atlas-overlay'], preview_img,
+                                     self.atlas_view.slice_size)
+            self.atlas_tri_data = new_pnts
         else:
-            da_new_pnt = self.atlas_view.working_atlas.image_dict['tri_pnts'].data['pos'][ind].copy()
             self.atlas_tri_data[ind] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
         self.atlas_tri_inside_data[ind - da_num] = [int(da_new_pnt[0]), int(da_new_pnt[1])]
         self.working_atlas_text[ind - da_num].setPos(da_new_pnt[0], da_new_pnt[1])
         if self.tool_box.triang_vis_btn.isChecked():
             self.update_atlas_tri_lines()
 
+    def atlas_window_tri_pnts_released(self, ev_obj):
+        if self.atlas_drag_warp is None:
+            return
+        img_wrap = self.atlas_drag_warp.finish()
+        self.atlas_drag_warp = None
+        self.set_drag_warp_image(self.atlas_view.working_atlas.image_dict['atlas-overlay'], img_wrap,
+                                 self.atlas_view.slice_size)
+
     def atlas_window_tri_pnts_clicked(self, ev):
         print(self.atlas_tri_data)
         if not self.tool_box.checkable_btn_dict['eraser_btn'].isChecked():
@@ -3888,8 +3857,11 @@ class HERBS(QMainWindow, FORM_Main):
         self.atlas_view.himg.label_img.setLookupTable(lut=lut)
 
         valid_id = list(self.small_mesh_list.keys())
+        region_index = self.atlas_view.label_tree.region_index
         for label_id in valid_id:
-            col_to_set = lut[int(label_id)] / 255
+            if int(label_id) not in region_index:
+                continue
+            col_to_set = lut[region_index[int(label_id)]] / 255
             self.small_mesh_list[label_id].setColor((col_to_set[0], col_to_set[1], col_to_set[2], col_to_set[3]))
 
     # ------------------------------------------------------------------
@@ -4189,10 +4161,12 @@ class HERBS(QMainWindow, FORM_Main):
                     self.print_message('Can not merge probe with only one point.', self.error_message_color)
                     return
         label_data = np.transpose(self.atlas_view.atlas_label, (1, 2, 0))[:, :, ::-1]
+        info_list = calculate_probes_info(data, label_data, self.atlas_view.region_info,
+                                          self.atlas_view.vox_size_um, self.probe_type,
+                                          self.atlas_view.origin_3d, self.site_face,
+                                          top_map=self.atlas_view.get_column_top_map())
         for i in range(len(data)):
-            info_dict = calculate_probe_info(data[i], label_data, self.atlas_view.label_info,
-                                             self.atlas_view.vox_size_um, self.probe_type,
-                                             self.atlas_view.origin_3d, self.site_face)
+            info_dict = info_list[i]
             self.object_ctrl.add_object(obj_names[i], 'merged probe',
                                         object_data=info_dict, object_mode=self.obj_display_mode)
 
@@ -4207,7 +4181,7 @@ class HERBS(QMainWindow, FORM_Main):
         label_data = np.transpose(self.atlas_view.atlas_label, (1, 2, 0))[:, :, ::-1]
 
         for i in range(len(data)):
-            info_dict = calculate_virus_info(data[i], label_data, self.atlas_view.label_info, self.atlas_view.origin_3d)
+            info_dict = calculate_virus_info(data[i], label_data, self.atlas_view.region_info, self.atlas_view.origin_3d)
             self.object_ctrl.add_object(obj_names[i], 'merged virus',
                                         object_data=info_dict, object_mode=self.obj_display_mode)
 
@@ -4220,10 +4194,11 @@ class HERBS(QMainWindow, FORM_Main):
             return
         data, obj_names = self.object_ctrl.merge_pieces('cells piece')
         label_data = np.transpose(self.atlas_view.atlas_label, (1, 2, 0))[:, :, ::-1]
+        depth_data, depth_scale = self.atlas_view.get_surface_distance_data()
 
         for i in range(len(data)):
-            info_dict = calculate_cells_info(data[i], label_data, self.atlas_view.label_info,
-                                             self.atlas_view.origin_3d)
+            info_dict = calculate_cells_info(data[i], label_data, self.atlas_view.region_info,
+                                             self.atlas_view.origin_3d, depth_data, depth_scale)
             self.object_ctrl.add_object(obj_names[i], 'merged cells',
                                         object_data=info_dict, object_mode=self.obj_display_mode)
 
@@ -4354,6 +4329,9 @@ class HERBS(QMainWindow, FORM_Main):
                 except (IOError, OSError, IndexError, AttributeError):
                     self.print_message('Load TIF file failed.', self.error_message_color)
                     return
+                if image_file.is_error:
+                    self.print_message(image_file.error_msg, self.error_message_color)
+                    return
                 if image_file.is_rgb:
                     self.tool_box.cell_count_label_list[0].setVisible(True)
                     self.tool_box.cell_count_val_list[0].setVisible(True)
@@ -4508,12 +4486,14 @@ class HERBS(QMainWindow, FORM_Main):
 
         self.print_message('Brain mesh is Loaded.', self.normal_color)
 
-        for id in unique_label:
+        label_index = np.ravel(self.atlas_view.label_info['index']).astype(int)
+        label_rows, label_found = get_label_rows(label_index, np.ravel(unique_label))
+        for i, id in enumerate(np.ravel(unique_label)):
             id = int(id)
             if id == 0:
                 continue
-            if id in self.atlas_view.label_info['index']:
-                color_to_set = self.atlas_view.label_info['color'][(self.atlas_view.label_info['index'] == id)][0] / 255
+            if label_found[i]:
+                color_to_set = np.ravel(self.atlas_view.label_info['color'][label_rows[i]]) / 255
                 mesh = gl.GLMeshItem(meshdata=small_meshdata_list[str(id)], smooth=True,
                                      color=(color_to_set[0], color_to_set[1], color_to_set[2], 0.8), shader='balloon')
                 mesh.setGLOptions('opaque')
@@ -4556,6 +4536,8 @@ class HERBS(QMainWindow, FORM_Main):
         if not da_atlas.success:
             self.statusbar.showMessage(da_atlas.msg)
             return
+        elif da_atlas.msg is not None:
+            self.print_message(da_atlas.msg, self.error_message_color)
         else:
             self.print_message('Atlas loaded successfully.', self.normal_color)
 
@@ -4592,16 +4574,57 @@ class HERBS(QMainWindow, FORM_Main):
         segmentation_data = np.transpose(da_atlas.segmentation_data, [2, 0, 1])[::-1, :, :]
         unique_label = da_atlas.unique_label
 
-        s_boundary = np.transpose(da_atlas.boundary['s_contour'], [2, 0, 1])[::-1, :, :]
-        c_boundary = np.transpose(da_atlas.boundary['c_contour'], [2, 0, 1])[::-1, :, :]
-        h_boundary = np.transpose(da_atlas.boundary['h_contour'], [2, 0, 1])[::-1, :, :]
-
-        boundary = {'s_contour': s_boundary, 'c_contour': c_boundary, 'h_contour': h_boundary}
+        # missing contour volumes are computed per slice by the atlas view
+        boundary = {}
+        for da_key in da_atlas.boundary.keys():
+            boundary[da_key] = np.transpose(da_atlas.boundary[da_key], [2, 0, 1])[::-1, :, :]
 
         self.set_volume_atlas_to_view(atlas_data, segmentation_data, atlas_info, label_info, boundary)
 
         self.set_volume_atlas_3d(unique_label, meshdata, small_meshdata_list)
 
+        if da_atlas.surface_missing:
+            self.fill_surface_store(atlas_folder)
+
+    def fill_surface_store(self, atlas_folder):
+        # stores made before the surface arrays existed get them in the background, the atlas view searches the
+        # volume columns until they are ready
+        if self.surface_thread is not None:
+            self.surface_pending_path = atlas_folder
+            return
+        self.print_message('Adding the brain surface maps to the atlas store...', self.normal_color)
+        self.surface_thread = QThread()
+        self.surface_worker = SurfaceStoreWorker(atlas_folder)
+        self.surface_worker.moveToThread(self.surface_thread)
+        self.surface_thread.started.connect(self.surface_worker.run)
+        self.surface_worker.finished.connect(self.surface_store_filled)
+        self.surface_worker.error_occur.connect(self.surface_store_failed)
+        self.surface_thread.finished.connect(self.surface_thread_finished)
+        self.surface_thread.start()
+
+    def surface_store_filled(self):
+        self.surface_thread.quit()
+        atlas_folder = self.surface_worker.atlas_folder
+        if self.current_atlas == 'volume' and atlas_folder == self.volume_atlas_path:
+            self.atlas_view.set_surface_store(load_surface_store(atlas_folder))
+        self.print_message('Brain surface maps are added to the atlas store.', self.normal_color)
+
+    def surface_store_failed(self, msg):
+        self.surface_thread.quit()
+        self.print_message(msg, self.error_message_color)
+
+    def surface_thread_finished(self):
+        self.surface_worker.deleteLater()
+        self.surface_thread.deleteLater()
+        self.surface_thread = None
+        self.surface_worker = None
+        # an atlas loaded while the previous one was filled
+        if self.surface_pending_path is not None:
+            atlas_folder = self.surface_pending_path
+            self.surface_pending_path = None
+            if atlas_folder == self.volume_atlas_path:
+                self.fill_surface_store(atlas_folder)
+
     # ------------------------------------------------------------------
     #
     #                       Atlas Loader
@@ -4830,7 +4853,7 @@ class HERBS(QMainWindow, FORM_Main):
             if layer_link == 'img-process':
                 if 'rgb' in self.image_view.image_file.pixel_type:
                     print('rgb')
-                    image_to_be_saved = self.image_view.processing_img.copy()
+                    image_to_be_saved = self.image_view.processing_img
                     if self.image_view.image_file.pixel_type != 'rgb24':
                         image_to_be_saved = cv2.normalize(image_to_be_saved, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
                 else:
@@ -2,8 +2,12 @@ import os
 import cv2
 import tifffile
 import colorsys
+import threading
 import numpy as np
 import imagecodecs
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+from .decode_cache import TileCache
 
 
 # image_file_path = '/Users/jingyig/Work/Kavli/Data/HERBS_DATA/test_image_type/image_0195.tif'
@@ -76,100 +80,408 @@ class ImageReader(object):
 # image_file_path = '/Users/jingyig/Work/Kavli/Data/HERBS_DATA/test_image_type/image_0195.tif'
 
 
+# TIFF files are opened lazily: series are scenes, the pyramid levels of a series are its levels and the pages
+# along the other axes (Z, T, ...) are the pages of a scene. Uncompressed pages are memory mapped, compressed pages
+# only decode the tiles or strips covering a requested region, so big BigTIFF and OME-TIFF scans are never read
+# as a whole.
+
+default_channel_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 0, 255), (0, 255, 255), (255, 255, 0)]
+
+
+def get_ome_channel_info(tif, image_index=0):
+    """
+    :param tif: opened tifffile.TiffFile
+    :param image_index: index of the OME image, the same as the index of the series
+    :return: channel names and rgb colors from the OME metadata, empty lists if not given
+    """
+    names = []
+    colors = []
+    if not tif.is_ome:
+        return names, colors
+    try:
+        root = ElementTree.fromstring(tif.ome_metadata)
+    except ElementTree.ParseError:
+        return names, colors
+    images = [element for element in root.iter() if element.tag.split('}')[-1] == 'Image']
+    if len(images) > 0:
+        if image_index >= len(images):
+            return names, colors
+        root = images[image_index]
+    for element in root.iter():
+        if element.tag.split('}')[-1] != 'Channel':
+            continue
+        names.append(element.get('Name'))
+        color = element.get('Color')
+        if color is None:
+            colors.append(None)
+        else:
+            # OME colors are signed 32 bit RGBA
+            color = int(color) & 0xffffffff
+            colors.append(((color >> 24) & 255, (color >> 16) & 255, (color >> 8) & 255))
+    return names, colors
+
+
+def read_tiff_page_region(tif, page, rect, read_lock):
+    """
+    :param tif: opened tifffile.TiffFile
+    :param page: page of the file
+    :param rect: (row_start, row_end, col_start, col_end)
+    :param read_lock: lock of the file handle
+    :return: region of the page, (rows, cols, samples)
+    """
+    r0, r1, c0, c1 = rect
+    if not isinstance(page, tifffile.TiffPage):
+        # light-weight frame of a multi-page file, read its tags
+        with read_lock:
+            page = page.aspage()
+    if page.is_memmappable:
+        page_data = np.memmap(tif.filehandle.path, dtype=np.dtype(tif.byteorder + page.dtype.char), mode='r',
+                              offset=page.dataoffsets[0], shape=page.shape)
+        return np.array(page_data[r0:r1, c0:c1]).reshape(r1 - r0, c1 - c0, -1)
+    if page.planarconfig != 1 or page.imagedepth > 1 or len(page.chunked) != 2:
+        with read_lock:
+            page_data = page.asarray()
+        return page_data[r0:r1, c0:c1].reshape(r1 - r0, c1 - c0, -1)
+
+    chunk_rows, chunk_cols = page.chunks[:2]
+    n_chunk_cols = page.chunked[1]
+    res = np.zeros((r1 - r0, c1 - c0, page.samplesperpixel), page.dtype)
+    for chunk_row in range(r0 // chunk_rows, (r1 - 1) // chunk_rows + 1):
+        for chunk_col in range(c0 // chunk_cols, (c1 - 1) // chunk_cols + 1):
+            chunk_ind = chunk_row * n_chunk_cols + chunk_col
+            data = None
+            if page.databytecounts[chunk_ind] > 0:
+                with read_lock:
+                    tif.filehandle.seek(page.dataoffsets[chunk_ind])
+                    data = tif.filehandle.read(page.databytecounts[chunk_ind])
+            chunk = page.decode(data, chunk_ind, jpegtables=page.jpegtables)[0]
+            chunk = chunk.reshape(chunk.shape[-3:])
+            cr0 = chunk_row * chunk_rows
+            cc0 = chunk_col * chunk_cols
+            sr0, sr1 = max(cr0, r0), min(cr0 + chunk.shape[0], r1)
+            sc0, sc1 = max(cc0, c0), min(cc0 + chunk.shape[1], c1)
+            res[sr0 - r0:sr1 - r0, sc0 - c0:sc1 - c0] = chunk[sr0 - cr0:sr1 - cr0, sc0 - cc0:sc1 - cc0]
+    return res
+
+
+class TIFFSceneArray(object):
+    def __init__(self, reader, scene_index, page_index=0):
+        """
+        One page of a TIFF series as a multi-resolution array, with the same interface as CZISceneArray.
+
+        :param reader: TIFFReader of the file
+        :param scene_index: index of the series
+        :param page_index: index of the page along the non-channel axes
+        """
+        self.reader = reader
+        self.scene_index = scene_index
+        self.page_index = page_index
+        self.levels = reader.tif.series[scene_index].levels
+        self.n_levels = len(self.levels)
+        self.n_channels = reader.series_info[scene_index]['n_channels']
+        self.is_rgb = reader.series_info[scene_index]['is_rgb']
+
+    def get_level_shape(self, level):
+        return self.reader.get_level_info(self.levels[level])['image_shape']
+
+    def get_level(self, scale):
+        """
+        :return: coarsest level with at least the resolution of scale
+        """
+        full_width = self.get_level_shape(0)[1]
+        level = 0
+        for i in range(1, self.n_levels):
+            if self.get_level_shape(i)[1] >= scale * full_width:
+                level = i
+        return level
+
+    def read_region(self, level, rect=None):
+        """
+        :param level: pyramid level
+        :param rect: (row_start, row_end, col_start, col_end) in pixels of the level, the whole level if None
+        :return: image of the region, (rows, cols, n_channels)
+        """
+        level_shape = self.get_level_shape(level)
+        if rect is None:
+            rect = (0, level_shape[0], 0, level_shape[1])
+        rect = (max(rect[0], 0), min(rect[1], level_shape[0]), max(rect[2], 0), min(rect[3], level_shape[1]))
+        pages = [self.levels[level].pages[ind] for ind in self.reader.get_page_indices(self.levels[level],
+                                                                                     self.page_index)]
+        channels = [read_tiff_page_region(self.reader.tif, page, rect, self.reader.read_lock) for page in pages]
+        img = np.concatenate(channels, axis=2)
+        if self.is_rgb:
+            img = img[:, :, :3]
+        return img
+
+    def read_scaled(self, scale):
+        """
+        :return: the whole page at any scale, resized from the nearest finer level
+        """
+        level = self.get_level(scale)
+        img = self.read_region(level)
+        full_shape = self.get_level_shape(0)
+        out_size = (max(int(round(full_shape[1] * scale)), 1), max(int(round(full_shape[0] * scale)), 1))
+        if out_size != (img.shape[1], img.shape[0]):
+            img = cv2.resize(img, out_size, interpolation=cv2.INTER_AREA).reshape(out_size[1], out_size[0], -1)
+        return img
+
+
+class TIFFPageStack(object):
+    def __init__(self, reader, scene_index, scale):
+        """
+        Pages of a TIFF series read on access, indexed like a (pages, rows, cols) volume.
+        """
+        self.reader = reader
+        self.scene_index = scene_index
+        self.scale = scale
+        full_shape = reader.get_scene_array(scene_index).get_level_shape(0)
+        self.shape = (reader.series_info[scene_index]['n_pages'], max(int(round(full_shape[0] * scale)), 1),
+                      max(int(round(full_shape[1] * scale)), 1))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        img = TIFFSceneArray(self.reader, self.scene_index, int(key[0])).read_scaled(self.scale)
+        if img.shape[2] == 1:
+            img = img[:, :, 0]
+        return img[key[1:]]
+
+    def __deepcopy__(self, memo):
+        # read-only view of the file
+        return self
+
+
 class TIFFReader(object):
-    def __init__(self, image_file_path):
+    def __init__(self, image_file_path, max_display_pixels=8192 * 8192):
+        """
+        :param image_file_path: path of the TIFF file
+        :param max_display_pixels: scenes with more pixels are shown at a lower scale
+        """
         self.is_czi = False
         self.file_name_list = [image_file_path[:-4]]
         if self.file_name_list[0][-1] == '.':
             self.file_name_list[0] = self.file_name_list[0][:-1]
+        self.max_display_pixels = max_display_pixels
 
-        da_file = tifffile.TiffFile(image_file_path)
-        self.n_scenes = len(da_file.series)
-        self.n_pages = len(da_file.pages)
-        self.pixel_type = da_file.pages[0].dtype
+        self.tif = tifffile.TiffFile(image_file_path)
+        self.read_lock = threading.Lock()
+        self.n_scenes = len(self.tif.series)
 
         self.scaling_val = None
 
-        self.hsv_colors = []
         self.gamma_val = []
         self.data = {}
         self.scale = {}
 
-        if self.pixel_type == 'uint8':
-            self.pixel_type = 'rgb24'
-            self.level = 255
-            self.data_type = 'uint8'
-            self.is_rgb = True
-            self.n_channels = 3
-        elif self.pixel_type == 'uint16':
-            self.pixel_type = 'gray16'
-            self.level = 65535
-            self.data_type = 'uint16'
-            self.is_rgb = False
-            self.n_channels = 1
-        else:
-            print('please contact maintainer.')
-
-        if self.is_rgb:
-            self.rgb_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
-            self.channel_name = ['Red', 'Green', 'Blue']
-            for i in range(3):
-                chsv = colorsys.rgb_to_hsv(self.rgb_colors[i][0], self.rgb_colors[i][1], self.rgb_colors[i][2])
-                hsv_color = (chsv[0], chsv[1], chsv[2] / 255)
-                self.hsv_colors.append(hsv_color)
+        # series of one file can differ in pixel type and channels, the attributes follow the scene shown
+        self.series_info = [self.get_series_info(i) for i in range(self.n_scenes)]
+        self.is_error = False
+        self.error_msg = None
+        for i in range(self.n_scenes):
+            if self.series_info[i]['level'] is None:
+                self.is_error = True
+                self.error_msg = 'TIFF images with {} pixels (scene {}) are not supported.'.format(
+                    self.series_info[i]['dtype'], i + 1)
+                return
+        self.set_series_info(0)
+
+        self.scene_arrays = {}
+        self.read_data(scene_index=0)
+
+    def get_series_info(self, scene_index):
+        """
+        :return: dict with the pixel type, level, data type, channels and colors of a series, level is None if the
+                 pixel type is not supported
+        """
+        series = self.tif.series[scene_index]
+        level_info = self.get_level_info(series)
+        n_samples = level_info['n_samples']
+        info = {'dtype': series.dtype, 'n_pages': level_info['n_pages'], 'is_rgb': n_samples in [3, 4],
+                'pixel_type': None, 'level': None, 'data_type': None}
+        if series.dtype == 'uint8':
+            info['pixel_type'] = 'rgb24' if info['is_rgb'] else 'gray8'
+            info['level'] = 255
+            info['data_type'] = 'uint8'
+        elif series.dtype == 'uint16':
+            info['pixel_type'] = 'rgb48' if info['is_rgb'] else 'gray16'
+            info['level'] = 65535
+            info['data_type'] = 'uint16'
+
+        if info['is_rgb']:
+            info['n_channels'] = 3
+            info['rgb_colors'] = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+            info['channel_name'] = ['Red', 'Green', 'Blue']
         else:
-            self.rgb_colors = [(128, 128, 128)]
-            chsv = colorsys.rgb_to_hsv(self.rgb_colors[0][0], self.rgb_colors[0][1], self.rgb_colors[0][2])
-            hsv_color = (chsv[0], chsv[1], chsv[2] / 255)
-            self.hsv_colors.append(hsv_color)
-            self.channel_name = ['Gray']
-
-        if da_file.is_bigtiff:
-            if self.n_scenes > 1 or self.n_pages == 1:
-                print('test multi series')
+            n_channels = level_info['n_channels'] * n_samples
+            info['n_channels'] = n_channels
+            if n_channels == 1:
+                info['rgb_colors'] = [(128, 128, 128)]
+                info['channel_name'] = ['Gray']
             else:
-                self.data['scene 0'] = da_file.asarray()
-                self.scale['scene 0'] = 100
-        else:
-            if self.n_scenes > 1 or self.n_pages > 1:
-                print('test multi series')
+                info['rgb_colors'] = [default_channel_colors[i % len(default_channel_colors)]
+                                      for i in range(n_channels)]
+                info['channel_name'] = ['Channel {}'.format(i + 1) for i in range(n_channels)]
+            ome_names, ome_colors = get_ome_channel_info(self.tif, scene_index)
+            for i in range(min(n_channels, len(ome_names))):
+                if ome_names[i] is not None:
+                    info['channel_name'][i] = ome_names[i]
+                if ome_colors[i] is not None:
+                    info['rgb_colors'][i] = ome_colors[i]
+        info['hsv_colors'] = []
+        for i in range(info['n_channels']):
+            chsv = colorsys.rgb_to_hsv(info['rgb_colors'][i][0], info['rgb_colors'][i][1], info['rgb_colors'][i][2])
+            info['hsv_colors'].append((chsv[0], chsv[1], chsv[2] / 255))
+        return info
+
+    def set_series_info(self, scene_index):
+        info = self.series_info[scene_index]
+        self.pixel_type = info['pixel_type']
+        self.level = info['level']
+        self.data_type = info['data_type']
+        self.is_rgb = info['is_rgb']
+        self.n_pages = info['n_pages']
+        self.n_channels = info['n_channels']
+        self.rgb_colors = list(info['rgb_colors'])
+        self.channel_name = list(info['channel_name'])
+        self.hsv_colors = list(info['hsv_colors'])
+
+    def get_level_info(self, level):
+        """
+        :param level: series or pyramid level of the file
+        :return: dict with 'image_shape' (rows, cols), 'n_samples', 'n_channels', 'n_pages' and the shape and axes
+                 of the page axes ('page_shape', 'page_axes')
+        """
+        axes = level.axes
+        shape = level.shape
+        n_samples = 1
+        if axes[-1] == 'S':
+            n_samples = shape[-1]
+            axes = axes[:-1]
+            shape = shape[:-1]
+        page_axes = axes[:-2]
+        page_shape = shape[:-2]
+        n_channels = 1
+        n_pages = 1
+        for i in range(len(page_axes)):
+            if page_axes[i] == 'C':
+                n_channels = page_shape[i]
             else:
-                img_data = da_file.asarray()
-                if len(img_data.shape) == 2:
-                    img_data = [img_data]
-                    img_data = np.dstack(img_data)
-                self.data['scene 0'] = img_data
-                self.scale['scene 0'] = 100
-
-        da_file.close()
-
-        # for tag in da_file.pages[0].tags:
-        #     tag_name, tag_value = tag.name, tag.value
-        #     print(tag_name, tag_value)
-
-
+                n_pages *= page_shape[i]
+        return {'image_shape': tuple(shape[-2:]), 'n_samples': n_samples, 'n_channels': n_channels,
+                'n_pages': n_pages, 'page_shape': page_shape, 'page_axes': page_axes}
+
+    def get_page_indices(self, level, page_index):
+        """
+        :return: indices in level.pages of all channels of one page
+        """
+        level_info = self.get_level_info(level)
+        page_axes = level_info['page_axes']
+        page_shape = level_info['page_shape']
+        if len(page_axes) == 0:
+            return [0]
+        other_shape = [page_shape[i] for i in range(len(page_axes)) if page_axes[i] != 'C']
+        other_pos = np.unravel_index(page_index, other_shape) if other_shape else ()
+        page_indices = []
+        for channel in range(level_info['n_channels']):
+            pos = []
+            other_ind = 0
+            for i in range(len(page_axes)):
+                if page_axes[i] == 'C':
+                    pos.append(channel)
+                else:
+                    pos.append(int(other_pos[other_ind]))
+                    other_ind += 1
+            page_indices.append(int(np.ravel_multi_index(pos, page_shape)))
+        return page_indices
+
+    def get_scene_array(self, scene_index, page_index=0):
+        if page_index != 0:
+            return TIFFSceneArray(self, scene_index, page_index)
+        if scene_index not in self.scene_arrays:
+            self.scene_arrays[scene_index] = TIFFSceneArray(self, scene_index)
+        return self.scene_arrays[scene_index]
+
+    def get_display_scale(self, scene_index):
+        full_shape = self.get_scene_array(scene_index).get_level_shape(0)
+        n_pixels = full_shape[0] * full_shape[1]
+        if n_pixels <= self.max_display_pixels:
+            return 1
+        return float(np.sqrt(self.max_display_pixels / n_pixels))
+
+    def read_data(self, scale=None, scene_index=None):
+        """
+        Read a scene, only the scene shown is kept in self.data. Multi-page scenes are kept as a TIFFPageStack which
+        reads the pages when they are shown.
+
+        :param scale: scale of the image, scenes up to max_display_pixels are read at full resolution if None
+        :param scene_index: index of the scene
+        """
+        if scene_index is None:
+            scene_index = 0
+        if scale is None:
+            scale = self.get_display_scale(scene_index)
+        self.data.clear()
+        self.scale.clear()
+        self.set_series_info(scene_index)
+        da_key = 'scene %d' % scene_index
+        if self.n_pages > 1:
+            self.data[da_key] = TIFFPageStack(self, scene_index, scale)
+        else:
+            self.data[da_key] = self.get_scene_array(scene_index).read_scaled(scale)
+        self.scale[da_key] = scale
 
 
+def read_folder_image(file_path):
+    """
+    :param file_path: path of the image
+    :return: RGB image
+    """
+    if file_path[-4:].lower() in ['.bmp', '.jpg', '.png', 'jpeg']:
+        data = cv2.imread(file_path)
+        img_data = cv2.cvtColor(data, cv2.COLOR_BGR2RGB)
+    else:
+        img_data = tifffile.imread(file_path)
+    return img_data
 
 
 class ImagesReader(object):
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, cache_size=1024 * 1024 * 1024, n_threads=4):
+        """
+        Images of a folder as scenes. File names are indexed up front, images are decoded when they are shown (the
+        neighbours in the background) through an LRU cache.
+
+        :param folder_path: folder of the images
+        :param cache_size: maximum number of bytes of the decoded images kept in memory
+        :param n_threads: number of threads decoding images
+        """
         if os.path.exists(folder_path):
-            all_files_in_folder = os.listdir(folder_path)
+            all_files_in_folder = sorted(os.listdir(folder_path))
         else:
             return
 
         self.is_czi = False
         self.is_rgb = True
         self.n_channels = 3
+        self.n_pages = 1
         self.level = 255
+        self.pixel_type = 'rgb24'
         self.data_type = 'uint8'
-        self.hsv_colors = [(0, 255, 255), (120, 255, 255), (240, 255, 255)]
+        self.scaling_val = None
         self.rgb_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
         self.channel_name = ['Red', 'Green', 'Blue']
+        self.hsv_colors = []
+        for i in range(3):
+            chsv = colorsys.rgb_to_hsv(self.rgb_colors[i][0], self.rgb_colors[i][1], self.rgb_colors[i][2])
+            hsv_color = (chsv[0], chsv[1], chsv[2] / 255)
+            self.hsv_colors.append(hsv_color)
+        self.gamma_val = []
         self.file_name_list = []
+        self.file_path_list = []
         self.data = {}
-        scene_id = 0
+        self.scale = {}
 
         for i in range(len(all_files_in_folder)):
             da_image_file = all_files_in_folder[i]
@@ -179,18 +491,65 @@ class ImagesReader(object):
 
             file_type = da_image_file[-4:]
             if file_type in ['.bmp', '.jpg', '.png', 'jpeg', '.tif', '.pdf']:
-                self.file_name_list.append(da_file_name)
                 da_file_path = os.path.join(folder_path, da_image_file)
+                self.file_name_list.append(da_file_name)
+                self.file_path_list.append(da_file_path)
 
-                if file_type in ['.bmp', '.jpg', '.png', 'jpeg']:
-                    data = cv2.imread(da_file_path)
-                    img_data = cv2.cvtColor(data, cv2.COLOR_BGR2RGB)
-                else:
-                    print('TIFF file is testing')
-                    img_data = tifffile.imread(da_file_path)
-
-                self.data['scene %d' % scene_id] = img_data
-
-                scene_id += 1
+        self.n_scenes = len(self.file_path_list)
+        self.image_cache = TileCache(cache_size)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.decode_pool = ThreadPoolExecutor(max_workers=n_threads)
 
-        self.n_scenes = len(self.data)
+        if self.n_scenes == 0:
+            return
+        self.read_data(scene_index=0)
+
+    def close(self):
+        """
+        Drop the background decodes which have not started, called when the images are replaced.
+        """
+        self.decode_pool.shutdown(wait=False, cancel_futures=True)
+        with self.pending_lock:
+            self.pending.clear()
+
+    def decode_image(self, scene_index):
+        img_data = read_folder_image(self.file_path_list[scene_index])
+        self.image_cache.put(scene_index, img_data)
+        with self.pending_lock:
+            self.pending.pop(scene_index, None)
+        return img_data
+
+    def submit_decode(self, scene_index):
+        with self.pending_lock:
+            if scene_index in self.pending or self.image_cache.get(scene_index) is not None:
+                return
+            self.pending[scene_index] = self.decode_pool.submit(self.decode_image, scene_index)
+
+    def get_image(self, scene_index):
+        img_data = self.image_cache.get(scene_index)
+        if img_data is not None:
+            return img_data
+        with self.pending_lock:
+            future = self.pending.get(scene_index)
+        if future is not None:
+            return future.result()
+        return self.decode_image(scene_index)
+
+    def read_data(self, scale=None, scene_index=None):
+        """
+        Decode one image, only the image shown is kept in self.data, the previous and next images are decoded in
+        the background.
+
+        :param scale: not used, the images are shown at full resolution
+        :param scene_index: index of the image
+        """
+        if scene_index is None:
+            scene_index = 0
+        self.data.clear()
+        self.scale.clear()
+        self.data['scene %d' % scene_index] = self.get_image(scene_index)
+        self.scale['scene %d' % scene_index] = 1
+        for ind in [scene_index + 1, scene_index - 1]:
+            if 0 <= ind < self.n_scenes:
+                self.submit_decode(ind)
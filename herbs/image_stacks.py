@@ -1,6 +1,7 @@
 import colorsys
 import os
 import sys
+import cv2
 import numpy as np
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -16,16 +17,28 @@ class ClickableImage(pg.ImageItem):
         mouseHovered = pyqtSignal(object)  # id
         mouseClicked = pyqtSignal(object)  # id
 
-    def __init__(self):
+    def __init__(self, fill_color=None):
+        """
+        :param fill_color: if given, the image only gives the size and is painted as a rect of this color
+        """
         self._sigprox = ClickableImage.SignalProxy()
         self.mouseHovered = self._sigprox.mouseHovered
         self.mouseClicked = self._sigprox.mouseClicked
 
         pg.ImageItem.__init__(self)
 
+        self.fill_color = fill_color
         self.setAcceptHoverEvents(True)
         # self.setOpts(axisOrder='row-major')
 
+    def paint(self, p, *args):
+        if self.fill_color is None:
+            pg.ImageItem.paint(self, p, *args)
+            return
+        if self.image is None:
+            return
+        p.fillRect(self.boundingRect(), fn.mkColor(self.fill_color))
+
     def set_data(self, hist_image_data, scale=None):
         # self.label_data = label
         self.hist_data = hist_image_data
@@ -194,7 +207,20 @@ class ImageStacks(pg.GraphicsLayoutWidget):
         self.vb.setAcceptHoverEvents(True)
         # self.vb.enableAutoRange(enable=False)
 
-        self.base_layer = ClickableImage()
+        # level of detail, images larger than lod_min_size are shown from a pyramid (level k is 1/2^k of the
+        # image), only the tiles of the level matching the zoom which cover the view are given to the channel items
+        self.lod_min_size = 4096
+        self.lod_tile_size = 512
+        self.pyramid = []
+        self.lod_key = None
+        self.lod_timer = QTimer()
+        self.lod_timer.setSingleShot(True)
+        self.lod_timer.timeout.connect(self.update_lod)
+        self.vb.sigRangeChanged.connect(self.view_changed)
+        self.vb.sigResized.connect(self.view_changed)
+
+        # the base layer only gives the size of the image for the mouse events, it is never rendered pixel by pixel
+        self.base_layer = ClickableImage(fill_color='k')
         self.base_layer.mouseClicked.connect(self.mouse_clicked)
         self.base_layer.mouseHovered.connect(self.mouse_hovered)
 
@@ -267,12 +293,73 @@ class ImageStacks(pg.GraphicsLayoutWidget):
         if scale is not None:
             self.resetTransform()
             self.scale(*scale)
-        base_img = np.zeros(data.shape[:2], 'uint8')
-        self.base_layer.setImage(base_img)
+        base_img = np.broadcast_to(np.zeros((1, 1), 'uint8'), data.shape[:2])
+        self.base_layer.setImage(base_img, autoLevels=False, levels=(0, 1))
+        self.pyramid = [data]
+        self.lod_key = None
+        if self.use_lod():
+            self.update_lod()
+        else:
+            for i in range(self.data.shape[2]):
+                self.image_list[i].setImage(self.data[:, :, i], autoLevels=False)
+                self.image_list[i].resetTransform()
         for i in range(self.data.shape[2]):
-            self.image_list[i].setImage(self.data[:, :, i], autoLevels=False)
             self.image_list[i].setVisible(True)
 
+    def use_lod(self):
+        return self.data is not None and max(self.data.shape[:2]) > self.lod_min_size
+
+    def get_n_levels(self):
+        n_levels = 1
+        while max(self.data.shape[:2]) / 2 ** (n_levels - 1) > self.lod_tile_size:
+            n_levels += 1
+        return n_levels
+
+    def get_level(self, level):
+        # each level is made once from the level above it
+        while len(self.pyramid) <= level:
+            upper = self.pyramid[-1]
+            size = ((upper.shape[1] + 1) // 2, (upper.shape[0] + 1) // 2)
+            lower = cv2.resize(upper, size, interpolation=cv2.INTER_AREA)
+            if lower.ndim == 2:
+                lower = lower[:, :, np.newaxis]
+            self.pyramid.append(lower)
+        return self.pyramid[level]
+
+    def view_changed(self):
+        if self.use_lod():
+            self.lod_timer.start(30)
+
+    def update_lod(self):
+        if not self.use_lod():
+            return
+        view_rect = self.vb.viewRect()
+        view_width = max(self.vb.width(), 1)
+        img_per_screen = max(view_rect.width() / view_width, 1)
+        level = int(np.clip(np.floor(np.log2(img_per_screen)), 0, self.get_n_levels() - 1))
+        level_img = self.get_level(level)
+        scale_r = self.data.shape[0] / level_img.shape[0]
+        scale_c = self.data.shape[1] / level_img.shape[1]
+
+        # whole tiles around the view, small pans inside the same tiles do not upload anything
+        tile = self.lod_tile_size
+        r0 = int(np.clip(np.floor(view_rect.top() / scale_r / tile) * tile, 0, level_img.shape[0]))
+        r1 = int(np.clip(np.ceil(view_rect.bottom() / scale_r / tile) * tile, 0, level_img.shape[0]))
+        c0 = int(np.clip(np.floor(view_rect.left() / scale_c / tile) * tile, 0, level_img.shape[1]))
+        c1 = int(np.clip(np.ceil(view_rect.right() / scale_c / tile) * tile, 0, level_img.shape[1]))
+        if r1 <= r0 or c1 <= c0:
+            return
+        lod_key = (level, r0, r1, c0, c1)
+        if lod_key == self.lod_key:
+            return
+        self.lod_key = lod_key
+
+        tiles_img = level_img[r0:r1, c0:c1]
+        rect = QRectF(c0 * scale_c, r0 * scale_r, (c1 - c0) * scale_c, (r1 - r0) * scale_r)
+        for i in range(self.data.shape[2]):
+            self.image_list[i].setImage(tiles_img[:, :, i], autoLevels=False)
+            self.image_list[i].setRect(rect)
+
     def set_lut(self, lut_list, bit_level):
         for i in range(self.data.shape[2]):
             self.image_list[i].setLevels(levels=(0, bit_level))
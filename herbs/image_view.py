@@ -17,7 +17,7 @@ import scipy.ndimage as ndi
 from .image_stacks import ImageStacks
 from .image_curves import CurveWidget, ChannelSelector
 from .uuuuuu import hsv2rgb, gamma_line, color_img, make_color_lut, get_corner_line_from_rect, \
-    rotate, rotate_bound, get_tb_size
+    rotate, rotate_bound, get_tb_size, get_read_only_view
 
 
 sidebar_button_style = '''
@@ -249,6 +249,8 @@ class ImageView(QObject):
                 self.channel_visible[i] = False
                 self.img_stacks.image_list[i].clear()
                 self.chn_widget_list[i].setVisible(False)
+            if hasattr(self.image_file, 'close'):
+                self.image_file.close()
             self.image_file = None
             self.color_lut_list.clear()
             self.original_lut_list.clear()
@@ -259,15 +261,16 @@ class ImageView(QObject):
         if self.image_file.n_pages > 1:
             self.page_ctrl.set_max(self.image_file.n_pages - 1)
             self.page_ctrl.setVisible(True)
-            self.volume_img = copy.deepcopy(self.image_file.data['scene 0'])
+            # the pixel buffers of the file are shared read-only, tools which change pixels make new arrays
+            self.volume_img = get_read_only_view(self.image_file.data['scene 0'])
             init_page_number = int(0.5 * self.image_file.n_pages)
             self.page_ctrl.set_val(init_page_number)
-            temp_data = self.volume_img[init_page_number, :, :].copy()
+            temp_data = self.volume_img[init_page_number, :, :]
             temp_data = [temp_data]
             self.current_img = np.dstack(temp_data)
         else:
             self.volume_img = None
-            self.current_img = copy.deepcopy(self.image_file.data['scene 0'])
+            self.current_img = get_read_only_view(self.image_file.data['scene 0'])
 
         self.current_scale = self.image_file.scale['scene 0']
 
@@ -290,6 +293,14 @@ class ImageView(QObject):
         # set data to image stacks
         self.set_data_to_img_stacks()
         self.get_corner_and_lines()
+        self.prefetch_neighbour_scenes()
+
+    def prefetch_neighbour_scenes(self):
+        # decode the previous and next scenes in the background while the current one is shown
+        if self.image_file is None or not self.image_file.is_czi or self.image_file.n_scenes == 1:
+            return
+        scene_index = self.scene_slider.value()
+        self.image_file.prefetch_scenes(self.current_scale, [scene_index + 1, scene_index - 1])
 
     def set_channel_widgets(self):
         # set color and names to channels
@@ -307,10 +318,19 @@ class ImageView(QObject):
             self.channel_visible[i] = True
             self.color_combo_index[i] = self.chn_widget_list[i].color_combo.currentIndex()
 
+    def reset_channel_widgets(self, n_old_channels):
+        for i in range(n_old_channels):
+            self.chn_widget_list[i].delete_item()
+            self.chn_widget_list[i].setVisible(False)
+            self.channel_color[i] = None
+            self.channel_visible[i] = False
+        self.color_lut_list.clear()
+        self.original_lut_list.clear()
+        self.set_channel_widgets()
+
     def set_curve_widgets(self):
         self.curve_widget.setEnabled(True)
-        img_layers = self.current_img.copy()
-        self.curve_widget.set_data(img_layers, self.image_file.rgb_colors, self.image_file.level)
+        self.curve_widget.set_data(self.current_img, self.image_file.rgb_colors, self.image_file.level)
 
     def channel_color_changed(self, col, ind):
         da_lut = make_color_lut(col, self.curve_widget.gray_max + 1)
@@ -356,7 +376,7 @@ class ImageView(QObject):
 
     def image_page_changed(self, page_number):
         self.display_img_index = page_number
-        temp_data = self.volume_img[page_number, :, :].copy()
+        temp_data = self.volume_img[page_number, :, :]
         temp_data = [temp_data]
         self.current_img = np.dstack(temp_data)
         self.img_stacks.set_data(self.current_img)
@@ -368,21 +388,31 @@ class ImageView(QObject):
         self.scene_label.setText('{}/{}'.format(scene_index + 1, self.image_file.n_scenes))
         with pg.BusyCursor():
             self.clear_image_stacks()
+            n_old_channels = self.image_file.n_channels
+            old_channel_info = (self.image_file.n_channels, self.image_file.level, self.image_file.hsv_colors,
+                                self.image_file.channel_name)
             if 'scene {}'.format(scene_index) not in list(self.image_file.data.keys()):
-                scale = self.scale_slider.value()
-                scale_val = scale * 0.01
+                if self.image_file.is_czi:
+                    scale_val = self.scale_slider.value() * 0.01
+                else:
+                    # other files choose their display scale
+                    scale_val = None
                 self.image_file.read_data(scale_val, scene_index=scene_index)
-            self.current_img = copy.deepcopy(self.image_file.data['scene {}'.format(scene_index)])
+            self.current_img = get_read_only_view(self.image_file.data['scene {}'.format(scene_index)])
             self.current_scale = self.image_file.scale['scene {}'.format(scene_index)]
 
-            if self.current_scale != self.scale_slider.value() * 0.01:
+            if self.image_file.is_czi and self.current_scale != self.scale_slider.value() * 0.01:
                 self.scale_slider.setValue(self.current_scale * 100)
 
             self.img_size = self.current_img.shape[:2]
-            for i in range(self.image_file.n_channels):
+            for i in range(max(n_old_channels, self.image_file.n_channels)):
                 self.img_stacks.image_list[i].clear()
             self.img_stacks.image_dict['tri_pnts'].set_range(self.img_size[1], self.img_size[0])
 
+            # scenes of a TIFF file can have their own channels
+            if old_channel_info != (self.image_file.n_channels, self.image_file.level, self.image_file.hsv_colors,
+                                    self.image_file.channel_name):
+                self.reset_channel_widgets(n_old_channels)
             self.channel_selector_reset()
             self.curve_widget.curve_plot.reset_plot()
 
@@ -390,6 +420,7 @@ class ImageView(QObject):
             self.img_stacks.set_lut(self.original_lut_list, self.image_file.level)
             self.get_corner_and_lines()
             self.set_curve_widgets()
+            self.prefetch_neighbour_scenes()
             # reset gamma and channels and black/white slider
 
     def scale_value_changed(self):
@@ -406,7 +437,7 @@ class ImageView(QObject):
             scene_index = self.scene_slider.value()
             with pg.BusyCursor():
                 self.image_file.read_data(scale_val, scene_index)
-                self.current_img = copy.deepcopy(self.image_file.data['scene %d' % scene_index])
+                self.current_img = get_read_only_view(self.image_file.data['scene %d' % scene_index])
                 self.current_scale = self.image_file.scale['scene {}'.format(scene_index)]
 
                 self.img_size = self.current_img.shape[:2]
@@ -415,6 +446,7 @@ class ImageView(QObject):
                 self.img_stacks.image_dict['tri_pnts'].set_range(self.img_size[1], self.img_size[0])
                 self.set_data_to_img_stacks()
                 self.get_corner_and_lines()
+            self.prefetch_neighbour_scenes()
 
     def image_curve_changed(self, ev):
         if self.current_img is None:
@@ -575,8 +607,7 @@ class ImageView(QObject):
         # if self.image_file.is_rgb:
         #     self.current_img = cv2.flip(self.current_img, 0)
         # else:
-        for i in range(self.image_file.n_channels):
-            self.current_img[:, :, i] = cv2.flip(self.current_img[:, :, i], 0)
+        self.current_img = np.ascontiguousarray(self.current_img[::-1])
         self.clear_image_stacks()
         self.img_size = self.current_img.shape[:2]
         self.img_stacks.image_dict['tri_pnts'].set_range(self.img_size[1], self.img_size[0])
@@ -588,8 +619,7 @@ class ImageView(QObject):
         # if self.image_file.is_rgb:
         #     self.current_img = cv2.flip(self.current_img, 1)
         # else:
-        for i in range(self.image_file.n_channels):
-            self.current_img[:, :, i] = cv2.flip(self.current_img[:, :, i], 1)
+        self.current_img = np.ascontiguousarray(self.current_img[:, ::-1])
         self.clear_image_stacks()
         self.img_stacks.set_data(self.current_img)
         self.img_size = self.current_img.shape[:2]
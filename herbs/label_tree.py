@@ -46,6 +46,206 @@ class SignalBlock(object):
         self.signal.connect(self.slot)
         
 
+class LabelTreeModel(QAbstractItemModel):
+    """
+    Tree of the atlas structures, nodes are kept in flat lists (node i is the i-th label), so building the model
+    is one pass over the labels and no Qt item or widget is made per structure.
+    """
+    sigCheckChanged = pyqtSignal(object)  # node
+    sigColorChanged = pyqtSignal(object)  # node
+
+    def __init__(self, parent=None):
+        QAbstractItemModel.__init__(self, parent)
+        self.label_ids = []
+        self.names = []
+        self.acronyms = []
+        self.parent_node = []
+        self.children = {-1: []}
+        self.row_in_parent = []
+        self.colors = np.zeros((0, 4), 'uint8')
+        self.default_colors = np.zeros((0, 4), 'uint8')
+        self.check_states = []
+        self.node_by_id = {}
+
+    def set_labels(self, label_data):
+        self.beginResetModel()
+        n_labels = len(label_data['index'])
+        self.label_ids = list(label_data['index'])
+        self.names = [str(name) for name in label_data['label']]
+        self.acronyms = [str(acronym) for acronym in label_data['abbrev']]
+        self.parent_node = []
+        self.children = {-1: []}
+        self.row_in_parent = []
+        self.node_by_id = {}
+        for i in range(n_labels):
+            # a parent only counts if it comes before its child in the label list
+            parent_node = self.node_by_id.get(label_data['parent'][i], -1)
+            self.parent_node.append(parent_node)
+            self.row_in_parent.append(len(self.children[parent_node]))
+            self.children[parent_node].append(i)
+            self.children[i] = []
+            self.node_by_id[self.label_ids[i]] = i
+        self.colors = np.zeros((n_labels, 4), 'uint8')
+        if n_labels != 0:
+            self.colors[:, :3] = np.asarray(list(label_data['color']))[:, :3]
+        self.colors[:, 3] = 255
+        self.default_colors = self.colors.copy()
+        self.check_states = [Qt.Unchecked] * n_labels
+        self.endResetModel()
+
+    def clear(self):
+        self.set_labels({'index': [], 'parent': [], 'color': [], 'label': [], 'abbrev': []})
+
+    def get_subtree(self, node):
+        nodes = [node]
+        i = 0
+        while i < len(nodes):
+            nodes.extend(self.children[nodes[i]])
+            i += 1
+        return nodes
+
+    def get_node(self, index):
+        return index.internalId() if index.isValid() else -1
+
+    def get_index(self, node, column=0):
+        return self.createIndex(self.row_in_parent[node], column, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        children = self.children.get(self.get_node(parent), [])
+        if row < 0 or row >= len(children) or column < 0 or column >= 3:
+            return QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent_node = self.parent_node[index.internalId()]
+        if parent_node < 0:
+            return QModelIndex()
+        return self.get_index(parent_node)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        return len(self.children.get(self.get_node(parent), []))
+
+    def columnCount(self, parent=QModelIndex()):
+        return 3
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return ['id', 'name', 'color'][section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        elif index.column() == 2:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalId()
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return self.acronyms[node]
+            if column == 1:
+                return self.names[node]
+        elif role == Qt.CheckStateRole and column == 0:
+            return self.check_states[node]
+        elif role in [Qt.EditRole, Qt.UserRole] and column == 2:
+            return QColor(*[int(val) for val in self.colors[node]])
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        if role == Qt.CheckStateRole and index.column() == 0:
+            self.set_check_state(index.internalId(), value)
+            self.sigCheckChanged.emit(index.internalId())
+            return True
+        if role == Qt.EditRole and index.column() == 2:
+            self.set_color(index.internalId(), value)
+            self.sigColorChanged.emit(index.internalId())
+            return True
+        return False
+
+    def emit_subtree_changed(self, node, column):
+        # one signal per row block instead of one per node
+        self.dataChanged.emit(self.get_index(node, column), self.get_index(node, column))
+        for parent_node in self.get_subtree(node):
+            children = self.children[parent_node]
+            if len(children) != 0:
+                self.dataChanged.emit(self.get_index(children[0], column), self.get_index(children[-1], column))
+
+    def set_check_state(self, node, check_state, recursive=True):
+        nodes = self.get_subtree(node) if recursive else [node]
+        for da_node in nodes:
+            self.check_states[da_node] = check_state
+        self.emit_subtree_changed(node, 0)
+        return nodes
+
+    def reset_colors(self):
+        self.colors[:] = self.default_colors
+        if len(self.children[-1]) != 0:
+            self.emit_subtree_changed(self.children[-1][0], 2)
+            for node in self.children[-1][1:]:
+                self.emit_subtree_changed(node, 2)
+
+    def set_color(self, node, color, recursive=True):
+        color = pg.mkColor(color)
+        nodes = self.get_subtree(node) if recursive else [node]
+        self.colors[nodes] = [color.red(), color.green(), color.blue(), color.alpha()]
+        self.emit_subtree_changed(node, 2)
+        return nodes
+
+
+class ColorSwatchDelegate(QStyledItemDelegate):
+    """
+    Paints the label colors as swatches, a color button (and its dialog) is only made for the label being edited.
+    """
+    def paint(self, painter, option, index):
+        if index.column() != 2:
+            QStyledItemDelegate.paint(self, painter, option, index)
+            return
+        rect = option.rect.adjusted(6, 3, -6, -3)
+        painter.save()
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(pg.mkBrush('w'))
+        painter.drawRect(rect)
+        painter.setBrush(QBrush(Qt.DiagCrossPattern))
+        painter.drawRect(rect)
+        painter.setBrush(pg.mkBrush(index.data(Qt.UserRole)))
+        painter.drawRect(rect)
+        painter.restore()
+
+    def createEditor(self, parent, option, index):
+        btn = pg.ColorButton(parent, color=index.data(Qt.UserRole))
+        btn.sigColorChanged.connect(self.color_selected)
+        btn.colorDialog.rejected.connect(lambda: self.closeEditor.emit(btn))
+        QTimer.singleShot(0, btn.selectColor)
+        return btn
+
+    def setEditorData(self, editor, index):
+        editor.setColor(index.data(Qt.UserRole), finished=False)
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.color(), Qt.EditRole)
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
+
+    def color_selected(self, btn):
+        self.commitData.emit(btn)
+        self.closeEditor.emit(btn)
+
+
 class LabelTree(QWidget):
 
     class SignalProxy(QObject):
@@ -71,19 +271,21 @@ class LabelTree(QWidget):
 
         self.label_level = None
         self.current_lut = None
-        self.root_item = []
-        self.root_acronym = []
-        
-        self.tree = QTreeWidget(self)
+        self.region_ids = None
+        self.region_index = {}
+
+        self.model = LabelTreeModel(self)
+        self.model.sigCheckChanged.connect(self.item_change)
+        self.model.sigColorChanged.connect(self.item_color_changed)
+        self.tree = QTreeView(self)
+        self.tree.setModel(self.model)
+        self.tree.setItemDelegate(ColorSwatchDelegate(self.tree))
+        self.tree.setUniformRowHeights(True)
+        self.tree.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.tree.clicked.connect(self.tree_clicked)
         self.layout.addWidget(self.tree)
-        self.tree.header().setResizeMode(QHeaderView.ResizeToContents)
-        self.tree.headerItem().setText(0, "id")
-        self.tree.headerItem().setText(1, "name")
-        self.tree.headerItem().setText(2, "color")
-        self.labels_by_id = {}
-        self.labels_by_acronym = {}
+        self.tree.header().setSectionResizeMode(QHeaderView.ResizeToContents)
         self.checked = set()
-        self.tree.itemChanged.connect(self.item_change)
 
         self.layout.addSpacing(10)
         self.reset_btn = QPushButton('Reset colors')
@@ -91,131 +293,94 @@ class LabelTree(QWidget):
         self.layout.addWidget(self.reset_btn)
         self.reset_btn.clicked.connect(self.reset_colors)
     
-    def set_labels(self, label_data):
+    def set_labels(self, label_data, region_ids):
+        """
+        :param label_data: label information of the atlas
+        :param region_ids: region index -> structure id table, the lookup tables are indexed by region index
+        """
         self._block_signals = True
         try:
             if self.current_lut is not None:
                 self.clear_labels()
 
-            n_labels = len(label_data['index'])
-            self.label_level = np.max([ind for ind in label_data['index'] if ind not in label_data['parent']])
+            self.region_ids = np.ravel(region_ids).astype(int)
+            self.region_index = {label_id: ind for ind, label_id in enumerate(self.region_ids.tolist())}
+            self.label_level = len(self.region_ids) - 1
+            self.model.set_labels(label_data)
             self.current_lut = np.zeros((self.label_level + 1, 4), 'i')
-            for i in range(n_labels):
-                label_id = label_data['index'][i]
-                parent = label_data['parent'][i]
-                color = label_data['color'][i]
-                if label_id <= self.label_level:
-                    self.current_lut[label_id] = np.array([color[0], color[1], color[2], 255])
-                da_color = QColor(color[0], color[1], color[2]).name(QColor.HexRgb)
-                da_color = da_color.split('#')[1]
-                name = label_data['label'][i]
-                acronym = label_data['abbrev'][i]
-                if parent < 0:
-                    parent = -1
-                    self.root_acronym.append(acronym.encode())
-                rec = (label_id, parent, name.encode(), acronym.encode(), da_color.encode())
-                self.add_label(*rec)
-            for i in range(len(self.root_acronym)):
-                self.root_item.append(self.labels_by_acronym[self.root_acronym[i]]['item'])
+            self.update_lut(range(len(self.model.label_ids)))
         finally:
             self._block_signals = False
         self.labels_changed.emit()
 
-    def add_label(self, label_id, parent, name, acronym, color):
-        item = QTreeWidgetItem([acronym.decode(), name.decode(), ''])
-        item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
-        item.setCheckState(0, Qt.Unchecked)
-        if parent in self.labels_by_id:
-            root = self.labels_by_id[parent]['item']
-        else:
-            root = self.tree.invisibleRootItem()
-    
-        root.addChild(item)
-        btn = pg.ColorButton(color=pg.mkColor(color.decode()))
-        btn.defaultColor = color.decode()
-        btn.id = label_id
-        self.tree.setItemWidget(item, 2, btn)
-    
-        self.labels_by_id[label_id] = {'item': item, 'btn': btn}
-        item.id = label_id
-        self.labels_by_acronym[acronym] = self.labels_by_id[label_id]
-    
-        btn.sigColorChanged.connect(self.item_color_changed)
+    def update_lut(self, nodes):
+        for node in nodes:
+            label_id = self.model.label_ids[node]
+            if label_id in self.region_index:
+                self.current_lut[self.region_index[label_id]] = self.model.colors[node]
 
     def clear_labels(self):
-        root = self.tree.invisibleRootItem()
-        for label_id in list(self.labels_by_id.keys()):
-            da_item = self.labels_by_id[label_id]['item']
-            (da_item.parent() or root).removeChild(da_item)
-
-    def item_change(self, item, col):
-        checked = item.checkState(0) == Qt.Checked
-        with SignalBlock(self.tree.itemChanged, self.item_change):
-            self.check_recursive(item, checked)
-    
+        self.model.clear()
+        self.checked.clear()
+
+    def tree_clicked(self, index):
+        # the color editor is only made for the clicked label
+        if index.column() == 2:
+            self.tree.edit(index)
+
+    def item_change(self, node):
+        checked = self.model.check_states[node] == Qt.Checked
+        for da_node in self.model.get_subtree(node):
+            label_id = self.model.label_ids[da_node]
+            if checked:
+                self.checked.add(label_id)
+            elif label_id in self.checked:
+                self.checked.remove(label_id)
+
         if not self._block_signals:
             self.labels_changed.emit()
 
-    def check_recursive(self, item, checked):
-        if checked:
-            self.checked.add(item.id)
-            item.setCheckState(0, Qt.Checked)
-        else:
-            if item.id in self.checked:
-                self.checked.remove(item.id)
-            item.setCheckState(0, Qt.Unchecked)
-    
-        for i in range(item.childCount()):
-            self.check_recursive(item.child(i), checked)
-
-    def item_color_changed(self, btn):
-        color = btn.color()
-        self.set_label_color(btn.id, color)
+    def item_color_changed(self, node):
+        self.update_lut(self.model.get_subtree(node))
+        self.label_color_changed.emit((self.model.label_ids[node], self.model.colors[node].astype(int)))
 
     def set_label_color(self, label_id, color, recursive=True, emit=True):
-        item = self.labels_by_id[label_id]['item']
-        btn = self.labels_by_id[label_id]['btn']
-        print(color)
-        rgb_color = (color.red(), color.green(), color.blue(), color.alpha())
-        self.current_lut[label_id] = np.array([rgb_color[0], rgb_color[1], rgb_color[2], rgb_color[3]])
-        with SignalBlock(btn.sigColorChanged, self.item_color_changed):
-            btn.setColor(color)
-        if recursive:
-            for i in range(item.childCount()):
-                ch = item.child(i)
-                self.set_label_color(ch.id, color, recursive=recursive, emit=False)
+        node = self.model.node_by_id[label_id]
+        self.update_lut(self.model.set_color(node, color, recursive))
         if emit:
-            self.label_color_changed.emit((label_id, self.current_lut[label_id]))
+            self.label_color_changed.emit((label_id, self.model.colors[node].astype(int)))
     
     def lookup_table(self):
         lut = np.zeros((self.label_level + 1, 4), dtype=np.ubyte)
         # print(lut.shape)
         for layer_id in self.checked:
-            if layer_id >= lut.shape[0]:
+            if layer_id not in self.region_index:
                 continue
-            lut[layer_id] = self.labels_by_id[layer_id]['btn'].color(mode='byte')
+            lut[self.region_index[layer_id]] = self.model.colors[self.model.node_by_id[layer_id]]
         return lut
 
     def reset_colors(self):
         try:
             self.blockSignals(True)
-            for k, v in self.labels_by_id.items():
-                self.set_label_color(k, v['btn'].defaultColor, recursive=False, emit=False)
+            self.model.reset_colors()
+            self.update_lut(range(len(self.model.label_ids)))
         finally:
             self.blockSignals(False)
             self.reset_labels.emit()
     
-    def describe(self, label_id):
+    def describe(self, region_index):
+        if region_index == 0 or self.region_ids is None or region_index >= len(self.region_ids):
+            return ''
+        label_id = int(self.region_ids[int(region_index)])
         if label_id == 0:
             return ''
         else:
-            if label_id not in self.labels_by_id:
+            if label_id not in self.model.node_by_id:
                 return "Unknown label: %d" % label_id
         descr = []
-        item = self.labels_by_id[label_id]['item']
-        name = str(item.text(1))
-        while item not in self.root_item:
-            # self.labels_by_acronym[b'Brain']['item'], self.labels_by_acronym[b'SpC']['item'], self.labels_by_acronym[b'IE']['item']
-            descr.insert(0, str(item.text(0)))
-            item = item.parent()
-        return '[%d]' % label_id + ' > '.join(descr) + "  :  " + name
\ No newline at end of file
+        node = self.model.node_by_id[label_id]
+        name = self.model.names[node]
+        while self.model.parent_node[node] >= 0:
+            descr.insert(0, self.model.acronyms[node])
+            node = self.model.parent_node[node]
+        return '[%d]' % label_id + ' > '.join(descr) + "  :  " + name
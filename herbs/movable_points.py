@@ -79,6 +79,7 @@ class TriangulationPoints(pg.GraphItem):
     mouseHovered = pyqtSignal(object)
     mouseDragged = pyqtSignal(object)
     mouseClicked = pyqtSignal(object)
+    mouseReleased = pyqtSignal(object)
 
     def __init__(self):
         self.dragPoint = None
@@ -118,6 +119,8 @@ class TriangulationPoints(pg.GraphItem):
 
             self.dragOffset = self.data['pos'][ind] - pos
         elif ev.isFinish():
+            if self.dragPoint is not None:
+                self.mouseReleased.emit((ev, self.dragPoint.data()[0]))
             self.dragPoint = None
             return
         else:
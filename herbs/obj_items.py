@@ -88,3 +88,120 @@ def render_small_volume(label_id, save_path, atlas_data, atlas_label, factor=2,
     outfile.close()
 
 
+
+
+def downsample_regions(atlas_data, atlas_label, factor=2):
+    """
+    Down-sample the atlas and label volume and find the bounding box of every region in one pass.
+
+    :param atlas_data: atlas volume
+    :param atlas_label: segmentation volume, same shape as atlas_data
+    :param factor: down-sampling factor
+    :return: small_atlas, small_label, dict of bounding boxes (tuple of slices) by label value
+    """
+    small_atlas = np.ascontiguousarray(atlas_data[::factor, ::factor, ::factor])
+    small_label = np.ascontiguousarray(atlas_label[::factor, ::factor, ::factor])
+
+    region_ids, compact_label = np.unique(small_label, return_inverse=True)
+    compact_label = compact_label.reshape(small_label.shape) + 1
+    region_boxes = ndi.find_objects(compact_label)
+    del compact_label
+    box_by_id = {int(region_ids[i]): region_boxes[i] for i in range(len(region_ids))}
+    return small_atlas, small_label, box_by_id
+
+
+def render_region_meshes(save_path, atlas_data, atlas_label, small_atlas, small_label, box_by_id, label_ids,
+                         region_ids=None, factor=2, level=0.1, progress=None):
+    """
+    Mesh the given regions inside their own bounding box, see render_small_volumes.
+
+    :param save_path: folder where '<label_id>.pkl' is written for each region
+    :param atlas_data: atlas volume
+    :param atlas_label: segmentation volume, same shape as atlas_data
+    :param small_atlas: down-sampled atlas volume from downsample_regions
+    :param small_label: down-sampled segmentation volume from downsample_regions
+    :param box_by_id: bounding boxes from downsample_regions
+    :param label_ids: structure ids to render
+    :param region_ids: region index -> structure id table when atlas_label holds region indices
+    :param factor: down-sampling factor
+    :param level: iso level relative to the maximum intensity inside the region
+    :param progress: optional callable receiving the fraction of processed regions
+    :return: dict of MeshData by str(label_id)
+    """
+    sigma = 2
+    pad = int(4 * sigma + 0.5)
+    small_shape = small_label.shape
+    full_shape = atlas_label.shape
+
+    small_mesh_list = {}
+    n_labels = len(label_ids)
+    for i in range(n_labels):
+        if progress is not None:
+            progress(i / n_labels)
+        label_id = int(label_ids[i])
+        if label_id == 0:
+            continue
+
+        label_value = label_id
+        if region_ids is not None:
+            pos = int(np.searchsorted(region_ids, label_id))
+            label_value = pos if pos < len(region_ids) and region_ids[pos] == label_id else -1
+
+        if label_value not in box_by_id:
+            # region is thinner than the sampling step, nothing survives the down-sampling
+            verts = np.zeros((0, 3))
+            faces = np.zeros((0, 3), dtype=np.uint32)
+        else:
+            box = box_by_id[label_value]
+            crop = tuple(slice(max(box[k].start - pad, 0), min(box[k].stop + pad, small_shape[k])) for k in range(3))
+            full_crop = tuple(slice(max((box[k].start - 1) * factor, 0), min(box[k].stop * factor, full_shape[k]))
+                              for k in range(3))
+            full_label = atlas_label[full_crop]
+            da_max = np.max(atlas_data[full_crop][full_label == label_value])
+
+            pimg = np.where(small_label[crop] == label_value, small_atlas[crop], 0).astype('float64')
+            verts, faces = pg.isosurface(ndi.gaussian_filter(pimg, (sigma, sigma, sigma)), da_max * level)
+            verts = verts + np.array([crop[0].start, crop[1].start, crop[2].start])
+
+        md = gl.MeshData(vertexes=verts * factor, faces=faces)
+
+        outfile = open(os.path.join(save_path, '{}.pkl'.format(label_id)), 'wb')
+        pickle.dump(md, outfile)
+        outfile.close()
+
+        small_mesh_list[str(label_id)] = md
+
+    if progress is not None:
+        progress(1)
+
+    return small_mesh_list
+
+
+def render_small_volumes(save_path, atlas_data, atlas_label, label_ids=None, factor=2, level=0.1, progress=None,
+                         region_ids=None):
+    """
+    Render the meshes of all brain regions from one pass over the label volume.
+
+    The down-sampled label volume is scanned once to find the bounding box of every region, each region is then
+    smoothed and meshed only inside its own box (padded by the support of the gaussian kernel), so the cost grows
+    with the size of the regions instead of labels x volume.
+
+    :param save_path: folder where '<label_id>.pkl' is written for each region
+    :param atlas_data: normalized atlas volume
+    :param atlas_label: segmentation volume, same shape as atlas_data
+    :param label_ids: region ids to render, default is all non-zero labels in the down-sampled volume
+    :param factor: down-sampling factor
+    :param level: iso level relative to the maximum intensity inside the region
+    :param progress: optional callable receiving the fraction of processed regions
+    :param region_ids: region index -> structure id table when atlas_label holds region indices
+    :return: dict of MeshData by str(label_id)
+    """
+    small_atlas, small_label, box_by_id = downsample_regions(atlas_data, atlas_label, factor)
+
+    if label_ids is None:
+        label_ids = np.asarray(sorted(box_by_id.keys()))
+        if region_ids is not None:
+            label_ids = np.asarray(region_ids)[label_ids]
+
+    return render_region_meshes(save_path, atlas_data, atlas_label, small_atlas, small_label, box_by_id, label_ids,
+                                region_ids=region_ids, factor=factor, level=level, progress=progress)
@@ -1,11 +1,17 @@
 import os
 from os.path import dirname, realpath, join
 import sys
+import multiprocessing
 
 from .herbsgui import main
 
 
 def run_herbs():
+    # the atlas processing workers are spawned and import __main__ again, a launch script without an
+    # if __name__ == '__main__' guard must not open the GUI in every worker
+    if multiprocessing.parent_process() is not None:
+        return
+    multiprocessing.freeze_support()
     current_wd = os.getcwd()
     script_dir = dirname(realpath(__file__))
     os.chdir(script_dir)
@@ -0,0 +1,235 @@
+import copy
+import zlib
+import numpy as np
+
+
+# The undo history keeps the last recorded state of every layer and stores each action as the difference to it:
+# raster layers (numpy arrays) only keep the changed rectangle before and after the action, zlib compressed,
+# point lists only keep the part after their common beginning. Old steps are dropped when the stored differences
+# and the last recorded states exceed the memory budget, not after a fixed number of steps.
+
+
+def same_item(item1, item2):
+    if item1 is item2:
+        return True
+    try:
+        return bool(item1 == item2)
+    except ValueError:
+        return np.array_equal(item1, item2)
+
+
+def get_changed_rect(data1, data2):
+    """
+    :return: bounding rect (row_start, row_end, col_start, col_end) of the pixels which differ, None if equal
+    """
+    diff = data1 != data2
+    while diff.ndim > 2:
+        diff = np.any(diff, axis=-1)
+    rows = np.where(np.any(diff, axis=1))[0]
+    if len(rows) == 0:
+        return None
+    cols = np.where(np.any(diff[rows[0]:rows[-1] + 1], axis=0))[0]
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def compress_array(data):
+    data = np.ascontiguousarray(data)
+    return zlib.compress(data.tobytes(), 1), data.dtype, data.shape
+
+
+def decompress_array(packed):
+    return np.frombuffer(zlib.decompress(packed[0]), dtype=packed[1]).reshape(packed[2])
+
+
+def get_list_size(data):
+    # rough size of a point list, the exact python object size does not matter for the budget
+    return 64 * len(data)
+
+
+def get_state_size(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, list):
+        return get_list_size(data)
+    return 64
+
+
+class UndoHistory(object):
+    def __init__(self, memory_budget=256 * 1024 * 1024):
+        """
+        :param memory_budget: maximum number of bytes used by the stored differences and the last recorded states
+        """
+        self.memory_budget = memory_budget
+        self.steps = []
+        self.position = 0
+        self.memory_used = 0
+        self.states = {}
+        self.thumbnails = {}
+
+    def clear(self):
+        self.steps = []
+        self.position = 0
+        self.memory_used = 0
+        self.states = {}
+        self.thumbnails = {}
+
+    def make_patch(self, state_key, data):
+        if isinstance(data, np.ndarray):
+            if state_key not in self.states:
+                self.states[state_key] = data.copy()
+                return None
+            last_data = self.states[state_key]
+            if last_data.shape != data.shape or last_data.dtype != data.dtype:
+                # shape changed, keep the whole arrays
+                patch = {'type': 'array', 'before': compress_array(last_data), 'after': compress_array(data)}
+                self.states[state_key] = data.copy()
+            else:
+                rect = get_changed_rect(last_data, data)
+                if rect is None:
+                    return None
+                r0, r1, c0, c1 = rect
+                patch = {'type': 'rect', 'rect': rect, 'before': compress_array(last_data[r0:r1, c0:c1]),
+                         'after': compress_array(data[r0:r1, c0:c1])}
+                last_data[r0:r1, c0:c1] = data[r0:r1, c0:c1]
+            patch['size'] = len(patch['before'][0]) + len(patch['after'][0])
+            return patch
+
+        if isinstance(data, list):
+            last_data = self.states.get(state_key, [])
+            n_same = 0
+            while n_same < min(len(last_data), len(data)) and same_item(last_data[n_same], data[n_same]):
+                n_same += 1
+            if n_same == len(last_data) and n_same == len(data):
+                return None
+            patch = {'type': 'list', 'start': n_same, 'before': copy.deepcopy(last_data[n_same:]),
+                     'after': copy.deepcopy(data[n_same:])}
+            patch['size'] = get_list_size(patch['before']) + get_list_size(patch['after'])
+            self.states[state_key] = last_data[:n_same] + copy.deepcopy(data[n_same:])
+            return patch
+
+        is_new = state_key not in self.states
+        last_data = self.states.get(state_key)
+        self.states[state_key] = copy.deepcopy(data)
+        if not is_new and same_item(last_data, data):
+            return None
+        return {'type': 'value', 'before': last_data, 'after': copy.deepcopy(data), 'size': 64}
+
+    def save(self, tool, layer_link, data, layer_tb):
+        """
+        Record one action, the steps which were undone before are dropped.
+
+        :param tool: tool of the action
+        :param layer_link: layer changed by the action
+        :param data: dict of the layer data after the action, numpy arrays for rasters, lists for points
+        :param layer_tb: thumbnail of the layer after the action
+        """
+        del self.steps[self.position:]
+
+        patches = {}
+        for key in data.keys():
+            patch = self.make_patch((layer_link, key), data[key])
+            if patch is not None:
+                patches[key] = patch
+        step = {'tool': tool, 'link': layer_link, 'patches': patches, 'keys': list(data.keys()),
+                'layer_before': self.thumbnails.get(layer_link), 'layer_after': layer_tb}
+        self.thumbnails[layer_link] = layer_tb
+        step['size'] = sum([patch['size'] for patch in patches.values()])
+        if layer_tb is not None:
+            step['size'] += np.asarray(layer_tb).nbytes
+        self.steps.append(step)
+        self.position = len(self.steps)
+        self.update_memory_used()
+
+        # keep at least the newest step
+        while self.memory_used > self.memory_budget and len(self.steps) > 1:
+            del self.steps[0]
+            self.position -= 1
+            self.drop_unused_states()
+            self.update_memory_used()
+
+    def update_memory_used(self):
+        self.memory_used = sum([step['size'] for step in self.steps]) + \
+                           sum([get_state_size(state) for state in self.states.values()])
+
+    def drop_unused_states(self):
+        # a layer without steps does not need its last state for undo, its next action starts a new history
+        links = set([step['link'] for step in self.steps])
+        for state_key in [key for key in self.states.keys() if key[0] not in links]:
+            del self.states[state_key]
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.steps)
+
+    def get_undo_link(self):
+        return self.steps[self.position - 1]['link'] if self.can_undo() else None
+
+    def get_redo_link(self):
+        return self.steps[self.position]['link'] if self.can_redo() else None
+
+    def apply_step(self, step, current_data, side):
+        """
+        :param current_data: dict of the current layer data, raster layers are patched in place when they match
+        :param side: 'before' to undo the step, 'after' to redo it
+        """
+        res_data = {}
+        for key in step['keys']:
+            state_key = (step['link'], key)
+            if key in step['patches']:
+                patch = step['patches'][key]
+                if patch['type'] == 'rect':
+                    r0, r1, c0, c1 = patch['rect']
+                    self.states[state_key][r0:r1, c0:c1] = decompress_array(patch[side])
+                elif patch['type'] == 'array':
+                    self.states[state_key] = decompress_array(patch[side]).copy()
+                elif patch['type'] == 'list':
+                    self.states[state_key] = self.states[state_key][:patch['start']] + copy.deepcopy(patch[side])
+                else:
+                    self.states[state_key] = copy.deepcopy(patch[side])
+
+            state = self.states.get(state_key)
+            da_current = current_data.get(key)
+            if key not in step['patches'] and da_current is not None:
+                # not changed by this step
+                res_data[key] = da_current
+            elif isinstance(state, np.ndarray):
+                # read-only arrays share the pixels of the opened image, they are never patched in place
+                if isinstance(da_current, np.ndarray) and da_current.flags.writeable and \
+                        da_current.shape == state.shape and da_current.dtype == state.dtype and \
+                        step['patches'][key]['type'] == 'rect':
+                    r0, r1, c0, c1 = step['patches'][key]['rect']
+                    da_current[r0:r1, c0:c1] = state[r0:r1, c0:c1]
+                    res_data[key] = da_current
+                else:
+                    res_data[key] = state.copy()
+            else:
+                res_data[key] = copy.deepcopy(state)
+        return res_data
+
+    def undo(self, current_data):
+        """
+        :param current_data: dict of the current data of the layer given by get_undo_link()
+        :return: dict with tool, link, data (layer data before the last action) and layer (thumbnail), None if no step
+        """
+        if not self.can_undo():
+            return None
+        self.position -= 1
+        step = self.steps[self.position]
+        self.thumbnails[step['link']] = step['layer_before']
+        res_data = self.apply_step(step, current_data, 'before')
+        return {'tool': step['tool'], 'link': step['link'], 'data': res_data, 'layer': step['layer_before']}
+
+    def redo(self, current_data):
+        """
+        :param current_data: dict of the current data of the layer given by get_redo_link()
+        :return: dict with tool, link, data (layer data after the action) and layer (thumbnail), None if no step
+        """
+        if not self.can_redo():
+            return None
+        step = self.steps[self.position]
+        self.position += 1
+        self.thumbnails[step['link']] = step['layer_after']
+        res_data = self.apply_step(step, current_data, 'after')
+        return {'tool': step['tool'], 'link': step['link'], 'data': res_data, 'layer': step['layer_after']}
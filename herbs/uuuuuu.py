@@ -5,9 +5,13 @@ import pandas as pd
 import cv2
 import pickle
 import colorsys
+from concurrent.futures import ThreadPoolExecutor
 import pyqtgraph as pg
+from numba import jit
 from scipy.interpolate import interp1d, splprep, splev
 
+from .atlas_store import save_store_array
+
 
 def check_loading_pickle_file(file_path):
     layer_dict, msg = None, None
@@ -149,57 +153,64 @@ def pandas_to_str(label_name, label_ano, length, channels):
     return df.to_string(col_space=30, justify="justify")
 
 
-def correct_start_pnt(label_data, start_pnt, start_vox, direction):
+def get_column_top(label_data, vox, top_map=None):
+    """
+    :param label_data: brain region segmentation, the last axis points up
+    :param vox: N x 3 voxels
+    :param top_map: optional pre-computed 2d map of the highest brain voxel of every column (-1 for empty columns),
+                    the columns are then read with one lookup instead of being searched
+    :return: index of the highest brain voxel in the column of every voxel, -1 for empty columns or columns outside
+             the volume
+    """
+    vox = np.reshape(np.asarray(vox).astype(int), (-1, 3))
+    inside = np.all(np.logical_and(vox[:, :2] >= 0, vox[:, :2] < label_data.shape[:2]), axis=1)
+    top = np.full(len(vox), -1)
+    if top_map is not None:
+        top[inside] = top_map[vox[inside, 0], vox[inside, 1]]
+        return top
+    columns = label_data[vox[inside, 0], vox[inside, 1], :] != 0
+    column_top = label_data.shape[2] - 1 - np.argmax(columns[:, ::-1], axis=1)
+    column_top[np.logical_not(np.any(columns, axis=1))] = -1
+    top[inside] = column_top
+    return top
+
+
+def correct_start_pnt(label_data, start_pnt, start_vox, direction, chunk_size=256, top_map=None):
+    """
+    Move the start point along the probe to the brain surface with one ray cast: the voxels along the ray are taken
+    in chunks and the first one which is the top brain voxel of its column is the entry point.
+
+    :param label_data: brain region segmentation
+    :param start_pnt: start point related to bregma
+    :param start_vox: start point in voxels
+    :param direction: direction of the probe
+    :param chunk_size: number of ray steps checked at once
+    :param top_map: optional map of the column tops, see get_column_top
+    :return: entry point related to bregma
+    """
     direction = direction / np.linalg.norm(direction)
-    check_vec = label_data[int(start_vox[0]), int(start_vox[1]), :]
-    top_vox = np.where(check_vec != 0)[0][-1]
-    check_vox = start_vox.astype(int)
-    if check_vox[2] < top_vox:
-        sign_flag = 1
-    elif check_vox[2] > top_vox:
-        sign_flag = -1
-    else:
-        sign_flag = 0
-
-    stop_steps = 0
-    while check_vox[2] != top_vox:
-        stop_steps += 1
-        temp = start_vox - sign_flag * stop_steps * direction
-        check_vox = temp.astype(int)
-        if np.any(check_vox) < 0:
-            print('something went wrong, please contact maintainer')
-            break
-        check_vec = label_data[check_vox[0], check_vox[1], :]
-        top_vox = np.where(check_vec != 0)[0]
-        if len(top_vox) == 0:
-            print('something went wrong, please contact maintainer')
-            break
-        else:
-            top_vox = top_vox[-1]
-
-    new_sp = start_pnt - sign_flag * stop_steps * direction
-
-    # if int(start_vox[2]) < top_vox:
-    #     for i in range(1000):
-    #         temp = start_vox - i * direction
-    #         check_vox = temp.astype(int)
-    #         new_sp = start_pnt - (i - 1) * direction
-    #         if label_data[check_vox[0], check_vox[1], check_vox[2]] == 0:
-    #             break
-    #         if i == 999:
-    #             print('something went wrong, please contact maintainer')
-    # elif int(start_vox[2]) > top_vox:
-    #     for i in range(1000):
-    #         temp = start_vox + i * direction
-    #         check_vox = temp.astype(int)
-    #         new_sp = start_pnt + (i - 1) * direction
-    #         if label_data[check_vox[0], check_vox[1], check_vox[2]] == 0:
-    #             break
-    #         if i == 999:
-    #             print('something went wrong, please contact maintainer')
-    # else:
-    #     new_sp = start_pnt
-    return new_sp
+    start_vox = np.asarray(start_vox, float)
+    top_vox = get_column_top(label_data, start_vox, top_map)[0]
+    if top_vox < 0:
+        print('something went wrong, please contact maintainer')
+        return start_pnt
+    sign_flag = np.sign(top_vox - int(start_vox[2]))
+    if sign_flag == 0:
+        return start_pnt
+
+    max_steps = 2 * int(np.sum(label_data.shape))
+    for first_step in range(1, max_steps + 1, chunk_size):
+        steps = np.arange(first_step, min(first_step + chunk_size, max_steps + 1))
+        ray_vox = (start_vox - sign_flag * steps[:, np.newaxis] * direction).astype(int)
+        top_vox = get_column_top(label_data, ray_vox, top_map)
+        stop = np.logical_or(ray_vox[:, 2] == top_vox, top_vox < 0)
+        if np.any(stop):
+            stop_ind = np.argmax(stop)
+            if top_vox[stop_ind] < 0:
+                print('something went wrong, please contact maintainer')
+            return start_pnt - sign_flag * steps[stop_ind] * direction
+    print('something went wrong, please contact maintainer')
+    return start_pnt
 
 
 def correct_end_point(sp, ep, direction, vox_size, tip_length, probe_type):
@@ -247,145 +258,165 @@ def get_probe_info(probe_type):
     return tip_length, channel_size, channel_number_in_banks
 
 
-def get_probe_sites(segmentation_data, sp, ep, probe_length_without_tip,
-                    direction, vox_size, probe_type, channel_size, bregma, site_face):
-    if probe_type != 2:
-        base_loc = np.array([-16, -8, 8, 16]) / vox_size
-
-        center_loc = []
-        da_loc = sp + direction * (probe_length_without_tip - 6) / vox_size
-
-        while da_loc[2] < sp[2]:
-            center_loc.append(da_loc)
-            da_loc = center_loc[-1] - direction * channel_size / vox_size
-
-        n_sites_row = len(center_loc)
-        print(n_sites_row)
-
-        sites_loc = []
-        zero_vec = np.zeros(4)
-        if check_parallel_to_z(sp, ep):
-            if site_face == 0:
-                # calculate for flat case
-                related_site_center = np.vstack([base_loc, zero_vec, zero_vec]).T
-                for i in range(n_sites_row):
-                    sites_loc.append(center_loc[i] + related_site_center)
-            else:
-                # calculate for side case
-                related_site_center = np.vstack([zero_vec, base_loc, zero_vec]).T
-                for i in range(n_sites_row):
-                    sites_loc.append(center_loc[i] + related_site_center)
+def get_probe_sites_loc(sp, ep, probe_length_without_tip, direction, vox_size, probe_type, channel_size,
+                        site_face):
+    """
+    :return: site locations related to bregma (n_sites_row, 4, 3), indices of the 2 recording sites of every row
+             (n_sites_row, 2)
+    """
+    base_loc = np.array([-16, -8, 8, 16]) / vox_size
+    first_loc = sp + direction * (probe_length_without_tip - 6) / vox_size
+    row_step = direction * channel_size / vox_size
+
+    # rows go up from the deepest one as long as they are below the start point
+    n_sites_row = 0
+    if first_loc[2] < sp[2] and row_step[2] < 0:
+        row_inds = np.arange(int(np.ceil((sp[2] - first_loc[2]) / -row_step[2])) + 1)
+        below = first_loc[2] - row_inds * row_step[2] < sp[2]
+        n_sites_row = len(below) if np.all(below) else int(np.argmin(below))
+    center_loc = first_loc - np.arange(n_sites_row)[:, np.newaxis] * row_step
+
+    zero_vec = np.zeros(4)
+    if check_parallel_to_z(sp, ep):
+        if site_face == 0:
+            # flat case
+            related_site_center = np.vstack([base_loc, zero_vec, zero_vec]).T
         else:
-            x_vec = np.array([1, 0, 0])
-            vec1 = ep - sp
-            vec2 = vec1.copy()
-            vec2[2] = 0
-            ang_alpha = angle_between_2vectors(vec2, x_vec)
-            ang_beta = angle_between_2vectors(vec1, vec2)
-            rot_m = np.dot(rotation_z(ang_alpha), rotation_y(ang_beta))
-
-            if site_face == 0:
-                # calculate for flat case
-                related_site_center = np.vstack([zero_vec, base_loc, zero_vec])
-                for i in range(n_sites_row):
-                    sites_loc.append(center_loc[i] + np.dot(rot_m, related_site_center).T)
-            else:
-                # calculate for side case
-                related_site_center = np.vstack([zero_vec, zero_vec, base_loc])
-                for i in range(n_sites_row):
-                    sites_loc.append(center_loc[i] + np.dot(rot_m, related_site_center).T)
-
-        sites_label = np.zeros((n_sites_row, 2), 'i')
-        for i in range(n_sites_row):
-            if probe_type == 0:
-                if np.mod(i, 2) == 0:
-                    valid_sites_index = np.array([1, 3])
-                else:
-                    valid_sites_index = np.array([0, 2])
-            else:
-                valid_sites_index = np.array([1, 3])
-
-            site_vox = sites_loc[i] + bregma
-            site_vox = site_vox.astype(int)
-            valid_vox = site_vox[valid_sites_index, :]
-            sites_label[i, 0] = segmentation_data[valid_vox[0][0], valid_vox[0][1], valid_vox[0][2]]
-            sites_label[i, 1] = segmentation_data[valid_vox[1][0], valid_vox[1][1], valid_vox[1][2]]
-
-        region_label = np.unique(sites_label).astype(int)
-        region_length = np.zeros(len(region_label))
-        region_channels = np.zeros(len(region_label))
-        for i in range(len(region_label)):
-            region_channels[i] = np.sum(sites_label == region_label[i])
-            region_length[i] = np.sum(sites_label == region_label[i]) * channel_size / 2
+            # side case
+            related_site_center = np.vstack([zero_vec, base_loc, zero_vec]).T
     else:
-        sites_loc = None
-        sites_label = None
-        region_label = None
-        region_length = None
-        region_channels = None
-        
-    return sites_loc, sites_label, region_label, region_length, region_channels
+        x_vec = np.array([1, 0, 0])
+        vec1 = ep - sp
+        vec2 = vec1.copy()
+        vec2[2] = 0
+        ang_alpha = angle_between_2vectors(vec2, x_vec)
+        ang_beta = angle_between_2vectors(vec1, vec2)
+        rot_m = np.dot(rotation_z(ang_alpha), rotation_y(ang_beta))
+        if site_face == 0:
+            related_site_center = np.dot(rot_m, np.vstack([zero_vec, base_loc, zero_vec])).T
+        else:
+            related_site_center = np.dot(rot_m, np.vstack([zero_vec, zero_vec, base_loc])).T
+    sites_loc = center_loc[:, np.newaxis, :] + related_site_center[np.newaxis, :, :]
 
+    # NP1.0 staggers the recording sites between the rows
+    valid_sites_index = np.tile(np.array([1, 3]), (n_sites_row, 1))
+    if probe_type == 0:
+        valid_sites_index[1::2] = np.array([0, 2])
+    return sites_loc, valid_sites_index
 
-def get_label_name(label_info, unique_label, sites_label):
-    label_names = []
-    label_acronym = []
-    label_color = []
-    left_sites_color = np.zeros((len(sites_label), 3), 'i')
-    right_sites_color = np.zeros((len(sites_label), 3), 'i')
-    for i in range(len(unique_label)):
-        if unique_label[i] == 0:
-            label_names.append(' ')
-            label_acronym.append(' ')
-            label_color.append((128, 128, 128))
-            cind = np.where(sites_label[:, 0] == unique_label[i])[0]
-            if len(cind) > 1:
-                left_sites_color[cind, 0] = 128
-                left_sites_color[cind, 1] = 128
-                left_sites_color[cind, 2] = 128
-            cind = np.where(sites_label[:, 1] == unique_label[i])[0]
-            if len(cind) > 1:
-                right_sites_color[cind, 0] = 128
-                right_sites_color[cind, 1] = 128
-                right_sites_color[cind, 2] = 128
-        else:
-            da_ind = np.where(np.ravel(label_info['index']) == unique_label[i])[0][0]
-            label_names.append(label_info['label'][da_ind])
-            label_acronym.append(label_info['abbrev'][da_ind])
-            label_color.append(label_info['color'][da_ind])
-            cind = np.where(sites_label[:, 0] == unique_label[i])[0]
-            if len(cind) > 1:
-                left_sites_color[cind, 0] = label_info['color'][da_ind][0]
-                left_sites_color[cind, 1] = label_info['color'][da_ind][1]
-                left_sites_color[cind, 2] = label_info['color'][da_ind][2]
-            cind = np.where(sites_label[:, 1] == unique_label[i])[0]
-            if len(cind) > 1:
-                right_sites_color[cind, 0] = label_info['color'][da_ind][0]
-                right_sites_color[cind, 1] = label_info['color'][da_ind][1]
-                right_sites_color[cind, 2] = label_info['color'][da_ind][2]
 
-    return label_names, label_acronym, label_color, left_sites_color, right_sites_color
+def get_sites_region_info(sites_label, channel_size):
+    region_label, region_channels = np.unique(sites_label, return_counts=True)
+    region_label = region_label.astype(int)
+    region_channels = region_channels.astype(float)
+    region_length = region_channels * channel_size / 2
+    return region_label, region_length, region_channels
 
 
-def block_same_label_one_side(sites_label_one_side, sites_color_one_side):
-    merged_labels = [sites_label_one_side[0]]
-    merged_colors = [sites_color_one_side[0]]
-    in_block_count = 1
-    block_count = []
-    for i in range(1, len(sites_label_one_side)):
-        if sites_label_one_side[i] == sites_label_one_side[i - 1]:
-            in_block_count += 1
-        else:
-            block_count.append(in_block_count)
-            in_block_count = 1
-            merged_labels.append(sites_label_one_side[i])
-            merged_colors.append(sites_color_one_side[i])
-        if i == len(sites_label_one_side) - 1:
-            block_count.append(in_block_count)
-    return merged_labels, merged_colors, block_count
+def get_label_rows(label_index, ids):
+    """
+    :param label_index: structure ids of the label tables (any order)
+    :param ids: structure ids to look up
+    :return: row of every id in the label tables, mask of the ids found
+    """
+    ids = np.asarray(ids).astype(int)
+    order = np.argsort(label_index, kind='stable')
+    pos = np.searchsorted(label_index[order], ids)
+    pos[pos == len(label_index)] = 0
+    rows = order[pos]
+    return rows, label_index[rows] == ids
+
+
+def make_region_info(label_info, region_ids):
+    """
+    Dense label tables indexed by region index (the voxel values of the atlas segmentation).
+
+    :param label_info: label information of the atlas, keyed by structure id
+    :param region_ids: region index -> structure id table of the atlas
+    :return: dict with 'index' (structure id), 'label', 'abbrev', 'color' and 'parent' (structure id) per region index,
+             'label_row' (row in the label tables, -1 if not found) per region index and the structure tree
+             ('tree_abbrev', 'tree_parent_row') per row of the label tables
+    """
+    region_ids = np.ravel(region_ids).astype(int)
+    n_regions = len(region_ids)
+    label_index = np.ravel(label_info['index']).astype(int)
+    n_labels = len(label_index)
+    label_pos, found = get_label_rows(label_index, region_ids)
+    found[region_ids == 0] = False
+
+    tree_names = np.empty(n_labels, dtype=object)
+    tree_names[:] = list(label_info['label'])
+    tree_abbrev = np.empty(n_labels, dtype=object)
+    tree_abbrev[:] = list(label_info['abbrev'])
+    tree_colors = np.asarray(label_info['color']).reshape(n_labels, -1)[:, :3]
+    tree_parents = np.ravel(label_info['parent']).astype('int64')
+
+    names = np.full(n_regions, ' ', dtype=object)
+    acronyms = np.full(n_regions, ' ', dtype=object)
+    colors = np.full((n_regions, 3), 128, 'i')
+    parents = np.full(n_regions, -1, 'int64')
+    names[found] = tree_names[label_pos[found]]
+    acronyms[found] = tree_abbrev[label_pos[found]]
+    colors[found] = tree_colors[label_pos[found]]
+    parents[found] = tree_parents[label_pos[found]]
+
+    # parent row of every label, -1 for the roots
+    tree_parent_row, parent_found = get_label_rows(label_index, tree_parents)
+    tree_parent_row[np.logical_not(parent_found)] = -1
+    region_info = {'index': region_ids, 'label': names, 'abbrev': acronyms, 'color': colors, 'parent': parents,
+                   'label_row': np.where(found, label_pos, -1), 'tree_abbrev': tree_abbrev,
+                   'tree_parent_row': tree_parent_row}
+    return region_info
+
+
+def get_region_ancestors(region_info, region_label, separator='/'):
+    """
+    :param region_info: dense label tables, see make_region_info
+    :param region_label: region indices
+    :param separator: separator between the acronyms of a path
+    :return: list of acronym paths from the root to every region, '' for regions without label
+    """
+    rows = region_info['label_row'][np.ravel(region_label).astype(int)]
+    parent_row = region_info['tree_parent_row']
+    paths = [[] for _ in range(len(rows))]
+    active = np.where(rows >= 0)[0]
+    cur = rows[active]
+    # walk up all regions at the same time, a broken tree (cycle) stops after len(parent_row) steps
+    for _ in range(len(parent_row)):
+        if len(active) == 0:
+            break
+        for i, acronym in zip(active.tolist(), region_info['tree_abbrev'][cur]):
+            paths[i].append(acronym)
+        cur = parent_row[cur]
+        keep = cur >= 0
+        active = active[keep]
+        cur = cur[keep]
+    return [separator.join(path[::-1]) for path in paths]
+
 
+def get_label_name(region_info, unique_label, sites_label):
+    """
+    :param region_info: dense label tables, see make_region_info
+    :param unique_label: region indices on the probe
+    :param sites_label: region index of every site, (n_sites_row, 2)
+    """
+    unique_label = np.ravel(unique_label).astype(int)
+    sites_label = np.asarray(sites_label).astype(int)
+    label_names = list(region_info['label'][unique_label])
+    label_acronym = list(region_info['abbrev'][unique_label])
+    label_color = [tuple(int(val) for val in color) for color in region_info['color'][unique_label]]
+    left_sites_color = region_info['color'][sites_label[:, 0]].astype('i')
+    right_sites_color = region_info['color'][sites_label[:, 1]].astype('i')
+    return label_names, label_acronym, label_color, left_sites_color, right_sites_color
 
 
+def block_same_label_one_side(sites_label_one_side, sites_color_one_side):
+    sites_label_one_side = np.ravel(sites_label_one_side)
+    block_start = np.concatenate([[0], np.where(np.diff(sites_label_one_side) != 0)[0] + 1]).astype(int)
+    merged_labels = list(sites_label_one_side[block_start])
+    merged_colors = [sites_color_one_side[ind] for ind in block_start]
+    block_count = np.diff(np.append(block_start, len(sites_label_one_side))).tolist()
+    return merged_labels, merged_colors, block_count
 
 
 def get_tilt_info(sp, ep):
@@ -418,46 +449,87 @@ def get_tilt_info(sp, ep):
     return ap_tilt, ml_tilt
 
 
-def calculate_probe_info(data, label_data, label_info, vxsize_um, probe_type, bregma, site_face):
+def get_probe_geometry(data, label_data, vxsize_um, probe_type, bregma, top_map=None):
     """
-
-    :param data: 3d coordinates for all the points
-    :param label_data: original brain region segmentation
-    :param label_info:
-    :param vxsize_um:
-    :param tip_length:
-    :param channel_size:
-    :param bregma:
-    :return:
+    :param data: 3d coordinates for all the points of one probe (shank)
+    :param top_map: optional map of the column tops, see get_column_top
+    :return: dict with the fitted line, the corrected insertion and terminus and the probe lengths
     """
     # find the best fit line of the given points
-    # direction is from ???
     # start_pnt and end_pnt are coordinates related to the given Bregma
     tip_length, channel_size, channel_number_in_banks = get_probe_info(probe_type)
     start_pnt, end_pnt, avg, direction = line_fit(data)
     start_vox = start_pnt + bregma
-    end_vox = end_pnt + bregma
-    ap_angle, ml_angle = get_angles(direction)
-    new_sp = correct_start_pnt(label_data, start_pnt, start_vox, direction)
-    new_start_vox = new_sp + bregma
-    # print('sp', start_pnt)
-    # print('sp_vox', start_vox)
-    # print('new_sp', new_sp)
-    # print('new_sp_vox', new_start_vox)
+    new_sp = correct_start_pnt(label_data, start_pnt, start_vox, direction, top_map=top_map)
     new_ep, probe_length_with_tip, probe_length_without_tip = correct_end_point(
         new_sp, end_pnt, direction, vxsize_um, tip_length, probe_type)
-    # print('ep', end_pnt)
-    # print('new_ep', new_ep)
-    # print(probe_length_with_tip)
-    # print(np.sqrt(np.sum((new_sp - new_ep) ** 2)) * vxsize_um)
-    new_end_vox = new_ep + bregma
-    new_end_vox = new_end_vox.astype(int)
-    # print(new_end_vox)
-
-    sites_loc, sites_label, region_label, region_length, region_channels = get_probe_sites(
-        label_data, new_sp, new_ep, probe_length_without_tip,
-        direction, vxsize_um, probe_type, channel_size, bregma, site_face)
-    # print(region_label, region_length, region_channels)
+    geometry = {'start_pnt': start_pnt, 'end_pnt': end_pnt, 'direction': direction, 'new_sp': new_sp,
+                'new_ep': new_ep, 'probe_length_with_tip': probe_length_with_tip,
+                'probe_length_without_tip': probe_length_without_tip, 'channel_size': channel_size}
+    return geometry
+
+
+def calculate_probes_info(data_list, label_data, region_info, vxsize_um, probe_type, bregma, site_face,
+                          top_map=None):
+    """
+    Probe information of several probes (or shanks of a multi-shank probe), the recording sites of all probes are
+    labelled with one gather into the segmentation.
+
+    :param data_list: list of 3d coordinates for all the points of every probe
+    :param label_data: brain region segmentation (region indices)
+    :param region_info: dense label tables, see make_region_info
+    :param vxsize_um: voxel size in um
+    :param probe_type: 0 - Neuropixels 1.0, 1 - Neuropixels 2.0, 2 - tetrode
+    :param bregma: bregma voxel
+    :param site_face: 0 - sites face the cutting plane, 1 - sites face the side
+    :param top_map: optional map of the column tops, see get_column_top
+    :return: list of probe info dicts
+    """
+    geometry_list = []
+    valid_loc_list = []
+    for data in data_list:
+        geometry = get_probe_geometry(data, label_data, vxsize_um, probe_type, bregma, top_map)
+        if probe_type != 2:
+            sites_loc, valid_sites_index = get_probe_sites_loc(
+                geometry['new_sp'], geometry['new_ep'], geometry['probe_length_without_tip'],
+                geometry['direction'], vxsize_um, probe_type, geometry['channel_size'], site_face)
+            geometry['sites_loc'] = sites_loc
+            valid_loc_list.append(np.take_along_axis(sites_loc, valid_sites_index[:, :, np.newaxis], axis=1))
+        geometry_list.append(geometry)
+
+    if valid_loc_list:
+        all_sites_label = get_region_label(np.concatenate(valid_loc_list).reshape(-1, 3), label_data, bregma)
+        split_inds = np.cumsum([len(valid_loc) for valid_loc in valid_loc_list])[:-1]
+        sites_label_list = [da_label.reshape(-1, 2).astype('i') for da_label in
+                            np.split(all_sites_label, 2 * split_inds)]
+    else:
+        sites_label_list = []
+
+    info_list = []
+    for i in range(len(data_list)):
+        geometry = geometry_list[i]
+        if probe_type != 2:
+            sites_loc = list(geometry['sites_loc'])
+            sites_label = sites_label_list[i]
+            region_label, region_length, region_channels = get_sites_region_info(
+                sites_label, geometry['channel_size'])
+        else:
+            sites_loc, sites_label, region_label, region_length, region_channels = None, None, None, None, None
+        info_list.append(make_probe_info_dict(data_list[i], geometry, region_info, vxsize_um, bregma, sites_loc,
+                                              sites_label, region_label, region_length, region_channels))
+    return info_list
+
+
+def make_probe_info_dict(data, geometry, region_info, vxsize_um, bregma, sites_loc, sites_label, region_label,
+                         region_length, region_channels):
+    start_pnt = geometry['start_pnt']
+    end_pnt = geometry['end_pnt']
+    direction = geometry['direction']
+    new_sp = geometry['new_sp']
+    new_ep = geometry['new_ep']
+    ap_angle, ml_angle = get_angles(direction)
+    new_start_vox = new_sp + bregma
+    new_end_vox = (new_ep + bregma).astype(int)
     enter_coords = new_sp * vxsize_um
     end_coords = new_ep * vxsize_um
 
@@ -465,10 +537,10 @@ def calculate_probe_info(data, label_data, label_info, vxsize_um, probe_type, br
     ap_tilt, ml_tilt = get_tilt_info(new_sp, new_ep)
 
     label_names, label_acronym, label_color, left_sites_color, right_sites_color = get_label_name(
-        label_info, region_label, sites_label)
-
-    # sites_color = [left_sites_color, right_sites_color]
-    # print(label_names, label_acronym, label_color, chn_line_color)
+        region_info, region_label, sites_label)
+    # results keep the structure ids of the atlas
+    sites_label = region_info['index'][sites_label].astype('i')
+    region_label = region_info['index'][region_label]
 
     left_merged_labels, left_merged_colors, left_block_count = block_same_label_one_side(
         sites_label[:, 0], left_sites_color)
@@ -479,12 +551,10 @@ def calculate_probe_info(data, label_data, label_info, vxsize_um, probe_type, br
     merged_colors = [left_merged_colors, right_merged_colors]
     block_count = [left_block_count, right_block_count]
 
-    # print(merged_labels, merged_colors, block_count)
-
     da_dict = {'object_name': 'probe', 'data': data, 'ap_tilt': ap_tilt, 'ml_tilt': ml_tilt,
                'insertion_coords_3d': start_pnt, 'terminus_coords_3d': end_pnt,
                'new_insertion_coords_3d': new_sp, 'new_terminus_coords_3d': new_ep,
-               'direction': direction, 'probe_length': probe_length_with_tip, 'dv': dv,
+               'direction': direction, 'probe_length': geometry['probe_length_with_tip'], 'dv': dv,
                'ap_angle': ap_angle, 'ml_angle': ml_angle,
                'insertion_coords': enter_coords, 'insertion_vox': new_start_vox,
                'terminus_coords': end_coords, 'terminus_vox': new_end_vox,
@@ -495,54 +565,91 @@ def calculate_probe_info(data, label_data, label_info, vxsize_um, probe_type, br
     return da_dict
 
 
+def calculate_probe_info(data, label_data, region_info, vxsize_um, probe_type, bregma, site_face, top_map=None):
+    """
+    :param data: 3d coordinates for all the points
+    :param label_data: brain region segmentation (region indices)
+    :param region_info: dense label tables, see make_region_info
+    :return: probe info dict, see calculate_probes_info
+    """
+    return calculate_probes_info([data], label_data, region_info, vxsize_um, probe_type, bregma, site_face,
+                                 top_map)[0]
+
+
 def get_region_label(data, label_data, bregma):
-    region_label = []
-    for i in range(len(data)):
-        temp = data[i] + bregma
-        temp = temp.astype(int)
-        region_label.append(label_data[temp[0], temp[1], temp[2]])
+    """
+    :param data: N x 3 coordinates related to bregma
+    :param label_data: brain region segmentation (region indices)
+    :param bregma: bregma voxel
+    :return: region index of every point, 0 (background) for points outside the volume
+    """
+    vox = (np.reshape(np.asarray(data, float), (-1, 3)) + bregma).astype(int)
+    inside = np.all(np.logical_and(vox >= 0, vox < label_data.shape), axis=1)
+    region_label = np.zeros(len(vox), label_data.dtype)
+    vox = vox[inside]
+    region_label[inside] = label_data[vox[:, 0], vox[:, 1], vox[:, 2]]
     return region_label
 
 
-def get_region_label_info(region_label, label_info):
-    unique_label = np.unique(region_label)
-    label_names = []
-    label_acronym = []
-    label_color = []
-    region_count = []
-    for i in range(len(unique_label)):
-        # print(unique_label[i])
-        if unique_label[i] == 0:
-            label_names.append(' ')
-            label_acronym.append(' ')
-            label_color.append((128, 128, 128))
-        else:
-            da_ind = np.where(label_info['index'] == unique_label[i])[0][0]
-            label_names.append(label_info['label'][da_ind])
-            label_acronym.append(label_info['abbrev'][da_ind])
-            label_color.append(label_info['color'][da_ind])
+def get_region_label_info(region_label, region_info):
+    region_label = np.ravel(region_label).astype(int)
+    region_count = np.bincount(region_label, minlength=len(region_info['index']))
+    unique_label = np.where(region_count != 0)[0]
+    label_names = list(region_info['label'][unique_label])
+    label_acronym = list(region_info['abbrev'][unique_label])
+    label_color = [tuple(int(val) for val in color) for color in region_info['color'][unique_label]]
+    region_count = region_count[unique_label].tolist()
+    return region_count, label_names, label_acronym, label_color
 
-        region_count.append(len(np.where(np.ravel(region_label) == unique_label[i])[0]))
 
-    return region_count, label_names, label_acronym, label_color
+def lookup_regions(data, label_data, region_info, bregma):
+    """
+    Map points to atlas regions in one pass: one gather into the segmentation, the per region tables from
+    get_region_label_info and table gathers per point.
+
+    :param data: N x 3 coordinates related to bregma
+    :param label_data: brain region segmentation (region indices)
+    :param region_info: dense label tables, see make_region_info
+    :param bregma: bregma voxel
+    :return: dict with 'region_label' (region index), 'structure_id' and 'acronym' per point and 'unique_label',
+             'unique_id', 'region_count', 'label_name', 'label_acronym', 'label_color', 'label_path' per region hit
+    """
+    region_label = get_region_label(data, label_data, bregma).astype(int)
+    region_count, label_name, label_acronym, label_color = get_region_label_info(region_label, region_info)
+    # same order as the tables of get_region_label_info
+    unique_label = np.unique(region_label)
+    res_dict = {'region_label': region_label, 'structure_id': region_info['index'][region_label],
+                'acronym': region_info['abbrev'][region_label],
+                'unique_label': unique_label, 'unique_id': region_info['index'][unique_label],
+                'region_count': region_count, 'label_name': label_name, 'label_acronym': label_acronym,
+                'label_color': label_color, 'label_path': get_region_ancestors(region_info, unique_label)}
+    return res_dict
 
 
-def calculate_virus_info(data, label_data, label_info, bregma):
-    region_label = get_region_label(data, label_data, bregma)
-    region_count, label_names, label_acronym, label_color = get_region_label_info(region_label, label_info)
+def calculate_virus_info(data, label_data, region_info, bregma):
+    regions = lookup_regions(data, label_data, region_info, bregma)
 
-    res_dict = {'object_name': 'virus', 'data': data, 'label_name': label_names,
-                'label_acronym': label_acronym, 'label_color': label_color}
+    res_dict = {'object_name': 'virus', 'data': data, 'label_name': regions['label_name'],
+                'label_acronym': regions['label_acronym'], 'label_color': regions['label_color'],
+                'label_path': regions['label_path']}
 
     return res_dict
 
 
-def calculate_cells_info(data, label_data, label_info, bregma):
-    region_label = get_region_label(data, label_data, bregma)
-    region_count, label_names, label_acronym, label_color = get_region_label_info(region_label, label_info)
-
-    res_dict = {'object_name': 'cell', 'data': data, 'label_name': label_names,
-                'label_acronym': label_acronym, 'label_color': label_color, 'region_count': region_count}
+def calculate_cells_info(data, label_data, region_info, bregma, depth_data=None, depth_scale=1.):
+    """
+    :param depth_data: optional signed distance to the brain surface volume, same orientation as label_data
+    :param depth_scale: um per stored unit of depth_data
+    :return: cell info dict, with 'surface_depth' (um, positive inside the brain) per cell if depth_data is given
+    """
+    regions = lookup_regions(data, label_data, region_info, bregma)
+
+    res_dict = {'object_name': 'cell', 'data': data, 'label_name': regions['label_name'],
+                'label_acronym': regions['label_acronym'], 'label_color': regions['label_color'],
+                'region_count': regions['region_count'], 'label_path': regions['label_path']}
+    if depth_data is not None:
+        vox = np.reshape(np.asarray(data, float), (-1, 3)) + bregma
+        res_dict['surface_depth'] = get_surface_distance(depth_data, vox, depth_scale)
     return res_dict
 
 
@@ -707,6 +814,17 @@ def create_other_size(image, file_name, dim, location):
     cv2.imwrite(os.path.join(location, file_name), cropped)
 
 
+def get_read_only_view(data):
+    """
+    :return: view of the array which can not be written, the pixel buffer is shared and never copied
+    """
+    if not isinstance(data, np.ndarray):
+        return data
+    view = data.view()
+    view.flags.writeable = False
+    return view
+
+
 def make_hist_data(image_data, max_val):
     hist_data_list = []
     for i in range(image_data.shape[2]):
@@ -811,6 +929,182 @@ def warp_points(pnts, t1, t2):
 
 
 
+def get_triangle_affine(src_pnts, dst_pnts, tri_vet_inds):
+    """
+    Affine coefficients of every triangle, mapping destination pixel coordinates back to source coordinates.
+
+    :param src_pnts: triangulation points in the source image, (n_points, 2) as (x, y)
+    :param dst_pnts: matching points in the destination image
+    :param tri_vet_inds: vertex indices of the triangles, (n_triangles, 3)
+    :return: coefficients (n_triangles, 3, 2), [x, y, 1] @ coef[i] gives the source (x, y) of triangle i;
+             valid, False for degenerated triangles
+    """
+    src_pnts = np.asarray(src_pnts, np.float64).reshape(-1, 2)
+    dst_pnts = np.asarray(dst_pnts, np.float64).reshape(-1, 2)
+    tri_vet_inds = np.asarray(tri_vet_inds, int).reshape(-1, 3)
+    dst_mat = np.concatenate([dst_pnts[tri_vet_inds], np.ones((len(tri_vet_inds), 3, 1))], axis=2)
+    valid = np.abs(np.linalg.det(dst_mat)) > 1e-6
+    coef = np.zeros((len(tri_vet_inds), 3, 2))
+    if np.any(valid):
+        coef[valid] = np.linalg.solve(dst_mat[valid], src_pnts[tri_vet_inds[valid]])
+    return coef, valid
+
+
+def fill_triangle_index(index_img, dst_pnts, tri_vet_inds, offset=(0, 0), tri_list=None):
+    """
+    Rasterize triangle indices into index_img, pixels outside all triangles are left untouched.
+
+    Pixel centers are tested against the triangle edges in fixed point integers, so neighbouring triangles
+    leave no gaps and the result does not depend on offset and the size of index_img, tiles rasterized
+    separately match the whole image rasterized at once.
+
+    :param index_img: int32 image, the region of the destination image starting at offset (x, y)
+    :param dst_pnts: triangulation points in the destination image
+    :param tri_vet_inds: vertex indices of the triangles
+    :param offset: destination coordinates (x, y) of index_img[0, 0]
+    :param tri_list: indices of the triangles to draw, all if None
+    """
+    dst_pnts = np.asarray(dst_pnts, np.float64).reshape(-1, 2)
+    tri_vet_inds = np.asarray(tri_vet_inds, int).reshape(-1, 3)
+    x_off, y_off = int(offset[0]), int(offset[1])
+    if tri_list is None:
+        tri_list = np.arange(len(tri_vet_inds))
+    # vertices with 4 fractional bits, pixel centers are at integer coordinates as in warpAffine
+    tri_pnts = np.round(dst_pnts[tri_vet_inds] * 16).astype(np.int64)
+    fill_triangle_pixels(index_img, tri_pnts, np.asarray(tri_list, np.int64), x_off, y_off)
+
+
+@jit(nopython=True, cache=True, nogil=True)
+def fill_triangle_pixels(index_img, tri_pnts, tri_list, x_off, y_off):
+    # the pixel centers of a triangle row by row, the edge tests of fill_triangle_index give the span of every row
+    h, w = index_img.shape
+    for i in tri_list:
+        da_pnts = tri_pnts[i]
+        x0 = max((min(da_pnts[0, 0], da_pnts[1, 0], da_pnts[2, 0]) + 15) // 16, x_off)
+        x1 = min(max(da_pnts[0, 0], da_pnts[1, 0], da_pnts[2, 0]) // 16 + 1, x_off + w)
+        y0 = max((min(da_pnts[0, 1], da_pnts[1, 1], da_pnts[2, 1]) + 15) // 16, y_off)
+        y1 = min(max(da_pnts[0, 1], da_pnts[1, 1], da_pnts[2, 1]) // 16 + 1, y_off + h)
+        # orientation of the triangle, edge functions are all >= 0 inside a counter clockwise triangle
+        area = (da_pnts[1, 0] - da_pnts[0, 0]) * (da_pnts[2, 1] - da_pnts[0, 1]) - \
+               (da_pnts[1, 1] - da_pnts[0, 1]) * (da_pnts[2, 0] - da_pnts[0, 0])
+        sign = -1 if area < 0 else 1
+        for y in range(y0, y1):
+            yy = y * 16
+            # every edge function is c - d * x in the pixel x of the row, solved in integers for the span of x
+            xa, xb = x0, x1
+            for j in range(3):
+                pa, pb = da_pnts[j], da_pnts[(j + 1) % 3]
+                c = sign * ((pb[0] - pa[0]) * (yy - pa[1]) + (pb[1] - pa[1]) * pa[0])
+                d = sign * (pb[1] - pa[1]) * 16
+                if d > 0:
+                    xb = min(xb, c // d + 1)
+                elif d < 0:
+                    xa = max(xa, -(c // -d))
+                elif c < 0:
+                    xb = xa
+            if xa < xb:
+                index_img[y - y_off, xa - x_off:xb - x_off] = i
+
+
+def warp_image_by_triangles(src_img, src_pnts, dst_pnts, tri_vet_inds, dst_size, out=None, tile_size=1024,
+                            n_threads=None, dst_rect=None):
+    """
+    Piecewise affine warp of src_img, the triangles of src_pnts are mapped onto the triangles of dst_pnts.
+
+    The triangulation is rasterized into dense source coordinate maps tile by tile and every tile is sampled with
+    one cv2.remap, so the cost only depends on the destination size, not on the number of triangles.
+
+    :param src_img: source image, 2d or 3d (channels last)
+    :param src_pnts: triangulation points in the source image, (n_points, 2) as (x, y)
+    :param dst_pnts: matching points in the destination image
+    :param tri_vet_inds: vertex indices of the triangles, (n_triangles, 3)
+    :param dst_size: (height, width) of the destination image
+    :param out: destination array, pixels outside all triangles keep their value, zeros of src_img.dtype if None
+    :param tile_size: tile edge length in pixels
+    :param n_threads: number of threads working on tiles, default is the number of cores
+    :param dst_rect: (x, y, width, height), only this part of out is warped, the whole image if None
+    :return: out
+    """
+    if out is None:
+        out = np.zeros(tuple(dst_size[:2]) + src_img.shape[2:], src_img.dtype)
+    if src_img.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        src_img = src_img.astype(np.float32)
+    src_h, src_w = src_img.shape[:2]
+    tri_vet_inds = np.asarray(tri_vet_inds, int).reshape(-1, 3)
+    if len(tri_vet_inds) == 0:
+        return out
+    coef, valid = get_triangle_affine(src_pnts, dst_pnts, tri_vet_inds)
+    # one flat table per coefficient, np.take on them is much faster than gathering (h, w, 3, 2) blocks
+    coef = [np.ascontiguousarray(coef[:, i, j], np.float32) for j in range(2) for i in range(3)]
+    dst_pnts = np.asarray(dst_pnts, np.float64).reshape(-1, 2)
+    tri_pnts = dst_pnts[tri_vet_inds]
+    tri_min = np.floor(np.min(tri_pnts, axis=1)).astype(int)
+    tri_max = np.ceil(np.max(tri_pnts, axis=1)).astype(int)
+
+    n_tri = len(tri_vet_inds)
+    # cv2.remap takes at most 4 channels at once
+    if src_img.ndim == 3 and src_img.shape[2] > 4:
+        channel_groups = [slice(i, i + 4) for i in range(0, src_img.shape[2], 4)]
+    else:
+        channel_groups = [slice(None)]
+
+    if dst_rect is None:
+        dst_rect = (0, 0, out.shape[1], out.shape[0])
+    x_start, y_start = max(int(dst_rect[0]), 0), max(int(dst_rect[1]), 0)
+    x_end = min(int(dst_rect[0] + dst_rect[2]), out.shape[1])
+    y_end = min(int(dst_rect[1] + dst_rect[3]), out.shape[0])
+
+    def warp_tile(y0, x0):
+        y1 = min(y0 + tile_size, y_end)
+        x1 = min(x0 + tile_size, x_end)
+        tri_list = np.where(valid & (tri_min[:, 0] < x1) & (tri_max[:, 0] >= x0) &
+                            (tri_min[:, 1] < y1) & (tri_max[:, 1] >= y0))[0]
+        if len(tri_list) == 0:
+            return
+        index_img = np.full((y1 - y0, x1 - x0), n_tri, np.int32)
+        fill_triangle_index(index_img, dst_pnts, tri_vet_inds, (x0, y0), tri_list)
+        inside = index_img != n_tri
+        all_inside = np.all(inside)
+        if not all_inside and not np.any(inside):
+            return
+        index_img = index_img.astype(np.intp)
+        xx = np.arange(x0, x1, dtype=np.float32)[np.newaxis, :]
+        yy = np.arange(y0, y1, dtype=np.float32)[:, np.newaxis]
+        maps = []
+        for i, lim in enumerate([src_w - 1, src_h - 1]):
+            da_map = np.take(coef[3 * i], index_img, mode='clip')
+            da_map *= xx
+            da_temp = np.take(coef[3 * i + 1], index_img, mode='clip')
+            da_temp *= yy
+            da_map += da_temp
+            da_map += np.take(coef[3 * i + 2], index_img, mode='clip')
+            maps.append(np.clip(da_map, 0, lim, out=da_map))
+        map_x, map_y = maps
+        tile_out = out[y0:y1, x0:x1]
+        for group in channel_groups:
+            warped = cv2.remap(src_img[..., group], map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            da_out = tile_out[..., group]
+            if warped.ndim < da_out.ndim:
+                warped = warped[..., np.newaxis]
+            if all_inside:
+                da_out[:] = warped
+            else:
+                mask = inside if da_out.ndim == 2 else inside[..., np.newaxis]
+                np.copyto(da_out, warped, casting='unsafe', where=mask)
+
+    # tiles write disjoint parts of out, numpy and OpenCV release the GIL for the heavy parts
+    tile_starts = [(y0, x0) for y0 in range(y_start, y_end, tile_size) for x0 in range(x_start, x_end, tile_size)]
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    if n_threads <= 1 or len(tile_starts) == 1:
+        for y0, x0 in tile_starts:
+            warp_tile(y0, x0)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(lambda val: warp_tile(*val), tile_starts))
+    return out
+
+
 # calculate delanauy triangle
 def calculateDelaunayTriangles(rect, points):
     # create subdiv
@@ -863,59 +1157,261 @@ def get_vertex_ind_in_triangle(subdiv):
     return tri_vet_inds
 
 
-def get_pnts_triangle_ind(tri_vet_inds, tri_data, size, pnts):
-    # import cv2
-    # import numpy as np
-    # img_rec = (0, 0, 100, 200)
-    # da_triangle = np.array([[0, 0], [0, 50], [100, 100]])
-    # size = (200, 100)
-    # pnts = np.array([[0, 1], [0, 2], [60, 200]])
-
-    update_pnts = pnts.copy()
-    n_pnts = len(pnts)
-    loc = np.zeros(n_pnts)
-    loc[:] = np.nan
-    da_order = []
-
-    ct_list = []
-    for i in range(len(tri_vet_inds)):
-        da_inds = tri_vet_inds[i]
-        da_triangle = np.array([tri_data[da_inds[0]], tri_data[da_inds[1]], tri_data[da_inds[2]]])
-        mask = np.zeros(size, dtype=np.uint8)
-        cv2.fillPoly(mask, pts=[da_triangle], color=255)
-        ct, hc = cv2.findContours(image=mask, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_NONE)
-        ct_list.append(ct[0])
-
-        # range_y = (np.min(da_triangle[:, 1]), np.max(da_triangle[:, 1]))
-        # range_x = (np.min(da_triangle[:, 0]), np.max(da_triangle[:, 0]))
-        #
-        # valid_pnts_ind = [ind for ind in range(n_pnts) if range_x[0] <= pnts[ind][0] <= range_x[1] and range_y[0] <= pnts[ind][1] <= range_y[1]]
-        # valid_pnts_ind = [ind for ind in valid_pnts_ind if ind not in da_order]
-        # valid_pnts = pnts[valid_pnts_ind]
-        # for j in range(len(valid_pnts)):
-        #     res = cv2.pointPolygonTest(ct_list[i], (int(pnts[j][0]), int(pnts[j][1])), True)
-        #     if res >= 0:
-        #         loc.append(i)
-        #         da_order.append(valid_pnts_ind[j])
-
-    #     temp = np.zeros(len(update_pnts))
-    #
-    #
-    # for i in range(len(tri_vet_inds)):
-    #     da_
-    #
-    for i in range(len(pnts)):
-        for j in range(len(ct_list)):
-            da_ct = ct_list[j]
-            res = cv2.pointPolygonTest(da_ct, (int(pnts[i][0]), int(pnts[i][1])), False)
-            if res >= 0:
-                loc[i] = j
+@jit(nopython=True, cache=True, nogil=True)
+def find_index_triangles(pnts, scale, index_img, origin, inv_mat, tol, tri_ind):
+    # candidate triangle of the nearest index pixel, then of its 8 neighbours, see TriangleLocator.find_triangles
+    h, w = index_img.shape
+    offsets = np.array([[0, 0], [-1, 0], [1, 0], [0, -1], [0, 1], [-1, -1], [1, -1], [-1, 1], [1, 1]])
+    for n in range(len(pnts)):
+        pix_x = int(np.round(pnts[n, 0] * scale))
+        pix_y = int(np.round(pnts[n, 1] * scale))
+        for k in range(len(offsets)):
+            candidate = index_img[min(max(pix_y + offsets[k, 1], 0), h - 1), min(max(pix_x + offsets[k, 0], 0), w - 1)]
+            if candidate < 0:
+                continue
+            dx = pnts[n, 0] - origin[candidate, 0]
+            dy = pnts[n, 1] - origin[candidate, 1]
+            l0 = inv_mat[candidate, 0, 0] * dx + inv_mat[candidate, 0, 1] * dy
+            l1 = inv_mat[candidate, 1, 0] * dx + inv_mat[candidate, 1, 1] * dy
+            if l0 >= -tol and l1 >= -tol and 1 - l0 - l1 >= -tol:
+                tri_ind[n] = candidate
                 break
 
 
-    return loc
+@jit(nopython=True, cache=True, nogil=True)
+def search_triangles(pnts, rest_inds, tri_list, origin, inv_mat, tol, tri_ind):
+    # the first triangle of tri_list holding the point, for the points the index image did not place
+    for n in rest_inds:
+        for candidate in tri_list:
+            dx = pnts[n, 0] - origin[candidate, 0]
+            dy = pnts[n, 1] - origin[candidate, 1]
+            l0 = inv_mat[candidate, 0, 0] * dx + inv_mat[candidate, 0, 1] * dy
+            l1 = inv_mat[candidate, 1, 0] * dx + inv_mat[candidate, 1, 1] * dy
+            if l0 >= -tol and l1 >= -tol and l0 + l1 <= 1 + tol:
+                tri_ind[n] = candidate
+                break
 
 
+@jit(nopython=True, cache=True, nogil=True)
+def triangle_barycentric(pnts, tri_ind, origin, inv_mat, bary):
+    for n in range(len(pnts)):
+        candidate = tri_ind[n]
+        dx = pnts[n, 0] - origin[candidate, 0]
+        dy = pnts[n, 1] - origin[candidate, 1]
+        bary[n, 0] = inv_mat[candidate, 0, 0] * dx + inv_mat[candidate, 0, 1] * dy
+        bary[n, 1] = inv_mat[candidate, 1, 0] * dx + inv_mat[candidate, 1, 1] * dy
+        bary[n, 2] = 1 - bary[n, 0] - bary[n, 1]
+
+
+class TriangleLocator(object):
+    def __init__(self, tri_data, tri_vet_inds, size, max_pixels=4194304):
+        """
+        Point location in a triangulation, built once and queried with whole batches of points.
+
+        The triangle indices are rasterized into an index image (down-scaled to at most max_pixels for very big
+        images), a point looks up its candidate triangle there and only points near a triangle edge are checked
+        against all triangles.
+
+        :param tri_data: triangulation points, (n_points, 2) as (x, y)
+        :param tri_vet_inds: vertex indices of the triangles, (n_triangles, 3)
+        :param size: (height, width) of the image holding the triangulation
+        :param max_pixels: maximum number of pixels of the index image
+        """
+        self.tri_data = np.asarray(tri_data, np.float64).reshape(-1, 2)
+        self.tri_vet_inds = np.asarray(tri_vet_inds, int).reshape(-1, 3)
+        tri_pnts = self.tri_data[self.tri_vet_inds]
+        # barycentric coordinates: (l0, l1) = inv([p0 - p2, p1 - p2]) (p - p2), l2 = 1 - l0 - l1
+        edge_mat = np.stack([tri_pnts[:, 0] - tri_pnts[:, 2], tri_pnts[:, 1] - tri_pnts[:, 2]], axis=2)
+        self.valid = np.abs(np.linalg.det(edge_mat)) > 1e-9
+        self.inv_mat = np.zeros(edge_mat.shape)
+        if np.any(self.valid):
+            self.inv_mat[self.valid] = np.linalg.inv(edge_mat[self.valid])
+        self.origin = tri_pnts[:, 2]
+
+        self.scale = min(1., np.sqrt(max_pixels / float(max(size[0] * size[1], 1))))
+        index_shape = (max(int(np.ceil(size[0] * self.scale)), 1), max(int(np.ceil(size[1] * self.scale)), 1))
+        self.index_img = np.full(index_shape, -1, np.int32)
+        fill_triangle_index(self.index_img, self.tri_data * self.scale, self.tri_vet_inds,
+                            tri_list=np.where(self.valid)[0])
+
+    def barycentric(self, pnts, tri_ind):
+        """
+        :param pnts: (n, 2) points
+        :param tri_ind: (n, ) triangle index of every point
+        :return: (n, 3) barycentric coordinates of the points in their triangles
+        """
+        bary = np.empty((len(pnts), 3))
+        triangle_barycentric(np.asarray(pnts, np.float64), np.asarray(tri_ind, np.int64), self.origin, self.inv_mat,
+                             bary)
+        return bary
+
+    def find_triangles(self, pnts, tol=1e-6):
+        pnts = np.asarray(pnts, np.float64).reshape(-1, 2)
+        tri_ind = np.full(len(pnts), -1, int)
+        if len(pnts) == 0 or len(self.tri_vet_inds) == 0:
+            return tri_ind
+
+        # the nearest pixel first, points near an edge also try the triangles of the neighbouring pixels
+        find_index_triangles(pnts, self.scale, self.index_img, self.origin, self.inv_mat, tol, tri_ind)
+        rest_inds = np.where(tri_ind < 0)[0]
+        if len(rest_inds) == 0:
+            return tri_ind
+
+        # test the rest against all triangles
+        search_triangles(pnts, rest_inds, np.where(self.valid)[0], self.origin, self.inv_mat, tol, tri_ind)
+        return tri_ind
+
+    def locate(self, pnts):
+        """
+        Find the triangle of every point. Like the old contour test, a point just outside the triangulation still
+        belongs to the triangle holding its truncated (int) coordinates, e.g. pixel centers of the last image row.
+
+        :param pnts: (n, 2) points as (x, y)
+        :return: triangle index of every point (-1 outside the triangulation), (n, 3) barycentric coordinates of the
+                 points (nan outside)
+        """
+        pnts = np.asarray(pnts, np.float64).reshape(-1, 2)
+        tri_ind = self.find_triangles(pnts)
+        outside = tri_ind < 0
+        if np.any(outside):
+            tri_ind[outside] = self.find_triangles(np.trunc(pnts[outside]))
+
+        located = tri_ind >= 0
+        if np.all(located):
+            return tri_ind, self.barycentric(pnts, tri_ind)
+        bary = np.full((len(pnts), 3), np.nan)
+        bary[located] = self.barycentric(pnts[located], tri_ind[located])
+        return tri_ind, bary
+
+    def transfer(self, pnts, target_tri_data):
+        """
+        Map points into the matching triangulation of another image.
+
+        :param pnts: (n, 2) points as (x, y)
+        :param target_tri_data: triangulation points of the other image, same order as tri_data
+        :return: (n, 2) mapped points, nan for points outside the triangulation
+        """
+        tri_ind, bary = self.locate(pnts)
+        target_tri_data = np.asarray(target_tri_data, np.float64).reshape(-1, 2)
+        # outside points have nan barycentric coordinates and end up as nan
+        tri_ind = np.maximum(tri_ind, 0)
+        res_pnts = np.zeros((len(tri_ind), 2))
+        for i in range(3):
+            vet_inds = np.take(self.tri_vet_inds[:, i], tri_ind)
+            for j in range(2):
+                res_pnts[:, j] += bary[:, i] * np.take(target_tri_data[:, j], vet_inds)
+        return res_pnts
+
+
+def get_delaunay_vertex_inds(rect, pnts):
+    subdiv = cv2.Subdiv2D(rect)
+    for p in pnts:
+        subdiv.insert((int(p[0]), int(p[1])))
+    return get_vertex_ind_in_triangle(subdiv)
+
+
+def get_triangles_rect(pnts, tri_vet_inds, tri_list):
+    """
+    :return: bounding rect (x, y, width, height) of the listed triangles, with one pixel margin, None if no triangle
+    """
+    if len(tri_list) == 0:
+        return None
+    tri_pnts = np.asarray(pnts, np.float64).reshape(-1, 2)[np.asarray(tri_vet_inds)[tri_list]].reshape(-1, 2)
+    x0, y0 = np.floor(np.min(tri_pnts, axis=0)).astype(int) - 1
+    x1, y1 = np.ceil(np.max(tri_pnts, axis=0)).astype(int) + 2
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def union_rect(rect1, rect2):
+    if rect1 is None:
+        return rect2
+    if rect2 is None:
+        return rect1
+    x0, y0 = min(rect1[0], rect2[0]), min(rect1[1], rect2[1])
+    x1 = max(rect1[0] + rect1[2], rect2[0] + rect2[2])
+    y1 = max(rect1[1] + rect1[3], rect2[1] + rect2[3])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+class TriangleDragWarp(object):
+    def __init__(self, src_img, src_pnts, dst_pnts, dst_img, rect, max_preview_pixels=1048576):
+        """
+        Incremental piecewise affine warp while a triangulation point is dragged.
+
+        Every move only re-warps the triangles which changed, inside their bounding rect, into a preview image of at
+        most max_preview_pixels. finish() does one full resolution pass over everything touched during the drag.
+
+        :param src_img: image to warp, in the space of src_pnts
+        :param src_pnts: triangulation points in the source image
+        :param dst_pnts: triangulation points in the destination image when the drag starts
+        :param dst_img: current full resolution warp result, updated in place by finish()
+        :param rect: rect of the destination triangulation, (x, y, width, height) as for cv2.Subdiv2D
+        :param max_preview_pixels: maximum number of pixels of the preview image
+        """
+        self.src_img = src_img
+        self.src_pnts = np.array(src_pnts, np.float64).reshape(-1, 2)
+        self.dst_pnts = np.array(dst_pnts, np.float64).reshape(-1, 2)
+        self.dst_img = dst_img
+        self.rect = rect
+        self.tri_vet_inds = get_delaunay_vertex_inds(rect, self.dst_pnts)
+
+        dst_size = dst_img.shape[:2]
+        self.scale = min(1., np.sqrt(max_preview_pixels / float(dst_size[0] * dst_size[1])))
+        if self.scale < 1:
+            preview_size = (max(int(round(dst_size[1] * self.scale)), 1), max(int(round(dst_size[0] * self.scale)), 1))
+            self.preview_img = cv2.resize(dst_img, preview_size, interpolation=cv2.INTER_AREA)
+        else:
+            self.preview_img = dst_img.copy()
+        self.dirty_rect = None
+
+    def move(self, dst_pnts):
+        """
+        :param dst_pnts: triangulation points in the destination image after the last move
+        :return: preview image, it covers the whole destination image at a lower resolution while dragging
+        """
+        # copy, the caller usually keeps moving the same point array
+        dst_pnts = np.array(dst_pnts, np.float64).reshape(-1, 2)
+        tri_vet_inds = get_delaunay_vertex_inds(self.rect, dst_pnts)
+        moved = np.any(dst_pnts != self.dst_pnts, axis=1)
+        old_keys = set([tuple(sorted(val)) for val in self.tri_vet_inds])
+        new_keys = set([tuple(sorted(val)) for val in tri_vet_inds])
+        old_changed = [i for i, val in enumerate(self.tri_vet_inds)
+                       if tuple(sorted(val)) not in new_keys or np.any(moved[val])]
+        new_changed = [i for i, val in enumerate(tri_vet_inds)
+                       if tuple(sorted(val)) not in old_keys or np.any(moved[val])]
+        changed_rect = union_rect(get_triangles_rect(self.dst_pnts, self.tri_vet_inds, old_changed),
+                                  get_triangles_rect(dst_pnts, tri_vet_inds, new_changed))
+        self.dst_pnts = dst_pnts
+        self.tri_vet_inds = tri_vet_inds
+        if changed_rect is None:
+            return self.preview_img
+        self.dirty_rect = union_rect(self.dirty_rect, changed_rect)
+
+        preview_rect = (int(np.floor(changed_rect[0] * self.scale)), int(np.floor(changed_rect[1] * self.scale)),
+                        int(np.ceil(changed_rect[2] * self.scale)) + 1, int(np.ceil(changed_rect[3] * self.scale)) + 1)
+        self.warp_rect(self.preview_img, dst_pnts * self.scale, preview_rect)
+        return self.preview_img
+
+    def warp_rect(self, out, dst_pnts, rect):
+        x0, y0 = max(rect[0], 0), max(rect[1], 0)
+        out[y0:rect[1] + rect[3], x0:rect[0] + rect[2]] = 0
+        warp_image_by_triangles(self.src_img, self.src_pnts, dst_pnts, self.tri_vet_inds, out.shape[:2], out=out,
+                                dst_rect=rect)
+
+    def finish(self):
+        """
+        :return: full resolution destination image, re-warped where the drag changed the triangulation
+        """
+        if self.dirty_rect is not None:
+            self.warp_rect(self.dst_img, self.dst_pnts, self.dirty_rect)
+        return self.dst_img
+
+
+def get_pnts_triangle_ind(tri_vet_inds, tri_data, size, pnts):
+    tri_ind = TriangleLocator(tri_data, tri_vet_inds, size).locate(pnts)[0]
+    loc = tri_ind.astype(float)
+    loc[tri_ind < 0] = np.nan
+    return loc
 
 
 def get_sides_points(img_size):
@@ -1007,37 +1503,258 @@ def get_corner_line_from_rect(rect):
 
 
 def make_label_rgb_img(label_img, lut):
-    fimg = np.dstack([label_img, label_img, label_img])
-    unique_label = np.unique(label_img).astype(int)
-    for ind in np.unique(unique_label):
-        if ind == 0:
-            continue
-        loc = np.where(label_img == ind)
-        print(lut[ind])
-        fimg[loc[0], loc[1], 0] = lut[ind][0]
-        fimg[loc[0], loc[1], 1] = lut[ind][1]
-        fimg[loc[0], loc[1], 2] = lut[ind][2]
+    label_img = np.asarray(label_img).astype(int)
+    fimg = np.asarray(lut)[label_img, :3]
+    fimg[label_img == 0] = 0
     return fimg.astype('uint8')
 
 
+def mark_label_edges(label_data, axes, out=None):
+    """
+    Mark the non-zero voxels whose label differs from one of their direct neighbours along the given axes.
+
+    Voxels on the border of the array are compared with a zero background, this gives the same pixels as tracing
+    every label with cv2.findContours (RETR_TREE, CHAIN_APPROX_NONE), at a cost independent of the label count.
+
+    :param label_data: nd label array
+    :param axes: axes to compare neighbours along
+    :param out: optional bool array of the same shape to write into
+    :return: bool array
+    """
+    if out is None:
+        out = np.zeros(label_data.shape, bool)
+    for ax in axes:
+        lower = [slice(None)] * label_data.ndim
+        upper = [slice(None)] * label_data.ndim
+        lower[ax] = slice(0, -1)
+        upper[ax] = slice(1, None)
+        lower = tuple(lower)
+        upper = tuple(upper)
+        diff = label_data[lower] != label_data[upper]
+        out[lower] |= diff
+        out[upper] |= diff
+        first = [slice(None)] * label_data.ndim
+        last = [slice(None)] * label_data.ndim
+        first[ax] = 0
+        last[ax] = -1
+        out[tuple(first)] = True
+        out[tuple(last)] = True
+    out &= label_data != 0
+    return out
+
+
 def make_contour_img(lable_img):
-    unique_label = np.unique(lable_img).astype('int')
-    img_size = lable_img.shape
-    contour_img = np.zeros(img_size, 'uint8')
-    for label_ind in unique_label:
-        if label_ind == 0:
-            continue
-        temp = np.zeros(img_size, 'uint8')
-        temp[lable_img == label_ind] = 1
-        ct, hc = cv2.findContours(image=temp, mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_NONE)
-        for j in range(len(ct)):
-            da_contour = ct[j].copy()
-            da_shp = da_contour.shape
-            da_contour = np.reshape(da_contour, (da_shp[0], da_shp[2]))
-            contour_img[da_contour[:, 1], da_contour[:, 0]] = 1
+    contour_img = mark_label_edges(lable_img, (0, 1)).astype('uint8')
     return contour_img
 
 
+def get_oblique_grid(origin, vectors, shape, step=1):
+    """
+    Volume coordinates of the pixels of an oblique slice, same sampling as fn.affineSlice.
+
+    :param origin: volume coordinates of the pixel (0, 0)
+    :param vectors: two 3d vectors, one pixel step along the rows and the columns of the slice
+    :param shape: shape of the slice
+    :param step: sample every step pixels, 2 gives a coarse preview of a quarter of the pixels
+    :return: float32 array (3, n_rows, n_cols)
+    """
+    origin = np.asarray(origin, 'float32')[:, np.newaxis, np.newaxis]
+    row_vector = np.asarray(vectors[0], 'float32')[:, np.newaxis, np.newaxis]
+    col_vector = np.asarray(vectors[1], 'float32')[:, np.newaxis, np.newaxis]
+    rows = np.arange(0, shape[0], step, dtype='float32')[np.newaxis, :, np.newaxis]
+    cols = np.arange(0, shape[1], step, dtype='float32')[np.newaxis, np.newaxis, :]
+    return origin + row_vector * rows + col_vector * cols
+
+
+def sample_oblique_slice(atlas_data, atlas_label, grid):
+    """
+    Sample the intensity (trilinear) and the label (nearest) volumes on the same grid in one pass.
+
+    :param atlas_data: intensity volume
+    :param atlas_label: label volume, same shape as atlas_data
+    :param grid: float32 array (3, n_rows, n_cols) from get_oblique_grid
+    :return: intensity slice (dtype of atlas_data, float32 for float volumes), label slice, points outside are 0
+    """
+    vol_shape = np.array(atlas_data.shape)[:, np.newaxis, np.newaxis]
+    base = np.floor(grid)
+    frac = grid - base
+    base = base.astype(np.intp)
+
+    # np.rint rounds halves to even like the nearest sampling of fn.affineSlice
+    near = np.rint(grid).astype(np.intp)
+    valid = np.all((near >= 0) & (near < vol_shape), axis=0)
+    label = np.zeros(grid.shape[1:], atlas_label.dtype)
+    label[valid] = atlas_label[near[0][valid], near[1][valid], near[2][valid]]
+
+    # like fn.affineSlice, a point with any coordinate outside [0, shape - 1] is 0, no partial border weights
+    inside = np.all((grid >= 0) & (grid <= vol_shape - 1), axis=0)
+    base = np.minimum(base[:, inside], vol_shape[:, :, 0] - 2).clip(0)
+    frac = grid[:, inside] - base
+    values = np.zeros(len(frac[0]), 'float32')
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)[:, np.newaxis]
+        index = np.minimum(base + corner, vol_shape[:, :, 0] - 1)
+        weight = np.prod(np.where(corner, frac, 1 - frac), axis=0)
+        values += weight * atlas_data[index[0], index[1], index[2]]
+    intensity = np.zeros(grid.shape[1:], 'float32')
+    intensity[inside] = values
+    if np.issubdtype(atlas_data.dtype, np.integer):
+        intensity = np.round(intensity).astype(atlas_data.dtype)
+    return intensity, label
+
+
+def make_label_boundary(segmentation_data, axis, chunk_size=64, progress=None, out=None, start=0, stop=None):
+    """
+    Boundary volume for the slices cut perpendicular to axis, same as calling make_contour_img on every slice.
+
+    :param segmentation_data: 3d label volume
+    :param axis: 0 - sagittal, 1 - coronal, 2 - horizontal (processing order)
+    :param chunk_size: number of slices compared in one go, bounds the temporary memory
+    :param progress: optional callable receiving the fraction of processed slices
+    :param out: optional volume (e.g. a store memory map) to write into, same shape as segmentation_data
+    :param start: first slice along axis to process
+    :param stop: end of the slices along axis to process, default is all
+    :return: int32 array with 1 on the boundary, or out
+    """
+    in_plane_axes = tuple(ax for ax in range(3) if ax != axis)
+    if stop is None:
+        stop = segmentation_data.shape[axis]
+    n_slices = stop - start
+    if out is None:
+        out = np.zeros(segmentation_data.shape, 'i')
+    for chunk_start in range(start, stop, chunk_size):
+        if progress is not None:
+            progress((chunk_start - start) / n_slices)
+        da_slice = [slice(None)] * 3
+        da_slice[axis] = slice(chunk_start, min(chunk_start + chunk_size, stop))
+        da_slice = tuple(da_slice)
+        out[da_slice] = mark_label_edges(segmentation_data[da_slice], in_plane_axes)
+    if progress is not None:
+        progress(1)
+    return out
+
+
+def make_surface_map(segmentation_data, axis, chunk_size=16):
+    """
+    First and last in-brain (non-zero) voxel along every ray parallel to axis.
+
+    :param segmentation_data: 3d label volume
+    :param axis: axis of the rays
+    :param chunk_size: number of slices handled at once, along the first axis which is not the ray axis
+    :return: int32 array (2,) + shape of the other two axes, first and last index along axis, -1 for rays which
+             miss the brain
+    """
+    other_axes = [ax for ax in range(3) if ax != axis]
+    n_ray = segmentation_data.shape[axis]
+    surface_map = np.full((2, ) + tuple(segmentation_data.shape[ax] for ax in other_axes), -1, 'int32')
+    for start in range(0, segmentation_data.shape[other_axes[0]], chunk_size):
+        da_slice = [slice(None)] * 3
+        da_slice[other_axes[0]] = slice(start, start + chunk_size)
+        inside = np.moveaxis(segmentation_data[tuple(da_slice)] != 0, axis, -1)
+        hit = np.any(inside, axis=-1)
+        first = np.argmax(inside, axis=-1)
+        last = n_ray - 1 - np.argmax(inside[..., ::-1], axis=-1)
+        surface_map[0, start:start + chunk_size] = np.where(hit, first, -1)
+        surface_map[1, start:start + chunk_size] = np.where(hit, last, -1)
+    return surface_map
+
+
+@jit(nopython=True, cache=True)
+def squared_distance_lines(lines):
+    # 1d squared euclidean distance transform (Felzenszwalb and Huttenlocher) of every row, in place, the rows hold 0
+    # on the features and a big value elsewhere
+    n_lines, n = lines.shape
+    v = np.zeros(n, np.int64)
+    z = np.zeros(n + 1, np.float64)
+    f = np.zeros(n, np.float64)
+    for line in range(n_lines):
+        for q in range(n):
+            f[q] = lines[line, q]
+        k = 0
+        v[0] = 0
+        z[0] = -np.inf
+        z[1] = np.inf
+        for q in range(1, n):
+            s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2. * q - 2. * v[k])
+            while s <= z[k]:
+                k -= 1
+                s = ((f[q] + q * q) - (f[v[k]] + v[k] * v[k])) / (2. * q - 2. * v[k])
+            k += 1
+            v[k] = q
+            z[k] = s
+            z[k + 1] = np.inf
+        k = 0
+        for q in range(n):
+            while z[k + 1] < q:
+                k += 1
+            lines[line, q] = (q - v[k]) * (q - v[k]) + f[v[k]]
+
+
+def transform_distance_axis(data, axis):
+    moved = np.ascontiguousarray(np.moveaxis(data, axis, -1), 'float64')
+    lines = moved.reshape(-1, moved.shape[-1])
+    squared_distance_lines(lines)
+    return np.moveaxis(lines.reshape(moved.shape), -1, axis)
+
+
+def make_surface_distance(segmentation_data, out, temp, scale=0.125, chunk_size=16, progress=None):
+    """
+    Signed euclidean distance of every voxel to the brain surface (the in-brain voxels next to the background),
+    positive inside the brain. The transform is separable, so it runs over slabs and never holds the whole volume.
+
+    :param segmentation_data: 3d label volume
+    :param out: int16 volume (e.g. a store memory map) receiving distance / scale in voxels
+    :param temp: float32 volume of the same shape for the squared distances of the first two passes
+    :param scale: voxels per stored unit
+    :param chunk_size: number of slices handled at once
+    :param progress: optional callable receiving the fraction of the work done
+    :return: out
+    """
+    n0, n1, n2 = segmentation_data.shape
+    big = float(3 * max(n0, n1, n2) ** 2 + 1)
+    # passes along the last two axes, slabs along the first axis (with one slice around for the surface)
+    for start in range(0, n0, chunk_size):
+        if progress is not None:
+            progress(0.5 * start / n0)
+        stop = min(start + chunk_size, n0)
+        halo_start = max(start - 1, 0)
+        halo_stop = min(stop + 1, n0)
+        surface = mark_label_edges(segmentation_data[halo_start:halo_stop] != 0, (0, 1, 2))
+        # the halo slices only give the neighbours, their own marks are dropped
+        surface = surface[start - halo_start:stop - halo_start]
+        slab = np.where(surface, 0., big)
+        slab = transform_distance_axis(slab, 2)
+        slab = transform_distance_axis(slab, 1)
+        temp[start:stop] = slab
+    # pass along the first axis, slabs along the second axis
+    max_val = np.iinfo(np.int16).max
+    for start in range(0, n1, chunk_size):
+        if progress is not None:
+            progress(0.5 + 0.5 * start / n1)
+        stop = min(start + chunk_size, n1)
+        slab = transform_distance_axis(temp[:, start:stop], 0)
+        distance = np.sqrt(np.minimum(slab, big - 1)) / scale
+        distance[segmentation_data[:, start:stop] == 0] *= -1
+        out[:, start:stop] = np.clip(np.round(distance), -max_val, max_val).astype('int16')
+    if progress is not None:
+        progress(1)
+    return out
+
+
+def get_surface_distance(distance_data, vox, scale=0.125):
+    """
+    :param distance_data: signed distance volume, see make_surface_distance
+    :param vox: N x 3 voxels
+    :param scale: voxels per stored unit
+    :return: distance to the brain surface in voxels (positive inside the brain), nan outside the volume
+    """
+    vox = np.reshape(np.asarray(vox).astype(int), (-1, 3))
+    inside = np.all(np.logical_and(vox >= 0, vox < distance_data.shape), axis=1)
+    distance = np.full(len(vox), np.nan)
+    distance[inside] = distance_data[vox[inside, 0], vox[inside, 1], vox[inside, 2]] * scale
+    return distance
+
+
 def get_tri_lines(rect, pnts):
     subdiv = cv2.Subdiv2D(rect)
     for p in pnts:
@@ -1302,35 +2019,17 @@ def obj_data_to_mesh3d(filename):
 
 
 def make_atlas_label_contour(atlas_folder, segmentation_data):
-    sagital_contour_img = np.zeros(segmentation_data.shape, 'i')
-    coronal_contour_img = np.zeros(segmentation_data.shape, 'i')
-    horizontal_contour_img = np.zeros(segmentation_data.shape, 'i')
-
     # pre-process boundary
-    for i in range(len(segmentation_data)):
-        da_slice = segmentation_data[i, :, :].copy()
-        contour_img = make_contour_img(da_slice)
-        sagital_contour_img[i, :, :] = contour_img
-
-    for i in range(segmentation_data.shape[1]):
-        da_slice = segmentation_data[:, i, :].copy()
-        contour_img = make_contour_img(da_slice)
-        coronal_contour_img[:, i, :] = contour_img
-
-    for i in range(segmentation_data.shape[2]):
-        da_slice = segmentation_data[:, :, i].copy()
-        contour_img = make_contour_img(da_slice)
-        horizontal_contour_img[:, :, i] = contour_img
+    sagital_contour_img = make_label_boundary(segmentation_data, 0)
+    coronal_contour_img = make_label_boundary(segmentation_data, 1)
+    horizontal_contour_img = make_label_boundary(segmentation_data, 2)
 
     boundary = {'s_contour': sagital_contour_img,
                 'c_contour': coronal_contour_img,
                 'h_contour': horizontal_contour_img}
 
-    bnd = {'data': boundary}
-
-    outfile_ct = open(os.path.join(atlas_folder, 'contour_pre_made.pkl'), 'wb')
-    pickle.dump(bnd, outfile_ct)
-    outfile_ct.close()
+    for da_key in list(boundary.keys()):
+        save_store_array(atlas_folder, da_key, boundary[da_key])
 
     return boundary
 